@@ -0,0 +1,241 @@
+################################################################
+# arqmath_eval.py
+#
+# Evaluation driver for ARQMath runs: each retrieval pipeline is
+# run once over the topics, results are kept in memory, and graded
+# (nDCG) and binarized (P@10, MAP) metrics are computed from the
+# same run and reported in a single table.
+#
+# Topics may be passed through a pipeline in batches, with results
+# written to a TREC run file as each batch completes (optionally one
+# topic at a time, with latency percentiles per topic reported).
+# Pipelines may also be run in parallel (one JVM per worker
+# process), by pipeline and/or batch of topics.
+#
+# Binarized metrics use the full qrels with a relevance threshold
+# (e.g., P(rel=2)@10), which gives the same scores as evaluating
+# against qrels thresholded at REL_THRESHOLD.
+################################################################
+
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyterrier as pt
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from tqdm import tqdm
+from pyterrier.measures import *
+
+# Constants
+REL_THRESHOLD=2  # ARQMath convention, treat '2' in 0-3 scale as 'relevant' for binary relevance metrics
+
+# ( measure, column name ) pairs; "'" appended to names for prime metrics
+ARQMATH_METRICS = [
+    ( nDCG, 'nDCG' ),
+    ( P(rel=REL_THRESHOLD)@10, 'P@10' ),
+    ( AP(rel=REL_THRESHOLD), 'MAP' ),
+]
+
+LATENCY_PERCENTILES = [ 50, 90, 99 ]
+# Result columns kept in memory for evaluation when retrieving in batches
+EVAL_COLUMNS = [ 'qid', 'docno', 'score', 'rank' ]
+
+################################################################
+# Retrieval
+################################################################
+# Runs are ( name, results, latencies ), with one latency (ms) per topic. Topics
+# retrieved together are each assigned the batch time / number of topics (enough for
+# the mean); latency percentiles are only reported when topics are timed singly.
+def retrieve_run( pipeline, query_df, per_topic=False ):
+    # Returns ( results, latencies ); with per_topic, each topic is passed through the
+    # pipeline (and timed) on its own
+    if per_topic and len( query_df ) > 1:
+        parts = [ retrieve_run( pipeline, query_df.iloc[ row : row + 1 ] ) for row in range( len( query_df ) ) ]
+        return ( pd.concat( [ results for ( results, _ ) in parts ], ignore_index=True ),
+                np.concatenate( [ latencies for ( _, latencies ) in parts ] ) )
+
+    start = time.time()
+    results = pipeline.transform( query_df )
+    elapsed = 1000 * ( time.time() - start )
+
+    return ( results, np.full( len( query_df ), elapsed / max( len( query_df ), 1 ) ) )
+
+def write_trec_run( results, out_file, run_name ):
+    # Append results in TREC format ( qid Q0 docno rank score run_name )
+    trec_rows = results[ [ 'qid', 'docno', 'rank', 'score' ] ].copy()
+    trec_rows.insert( 1, 'Q0', 'Q0' )
+    trec_rows[ 'run_name' ] = run_name
+    trec_rows.to_csv( out_file, sep=' ', header=False, index=False )
+
+def retrieve_run_batched( pipeline, query_df, batch_size, run_file=None, run_name='run', per_topic=False ):
+    # Pass topics through the pipeline batch_size at a time, timing each batch (with
+    # per_topic, one topic at a time within each batch, to time each topic); results are
+    # appended to run_file (if given) after each batch. Returns ( results, latencies ).
+    parts = []
+    latencies = []
+    out_file = open( run_file, 'w' ) if run_file else None
+    try:
+        for first in tqdm( range( 0, len( query_df ), batch_size ), desc=run_name, unit='batch' ):
+            ( results, batch_latencies ) = retrieve_run( pipeline, query_df.iloc[ first : first + batch_size ], per_topic )
+            latencies.append( batch_latencies )
+            if out_file:
+                write_trec_run( results, out_file, run_name )
+                out_file.flush()
+            parts.append( results[ [ column for column in EVAL_COLUMNS if column in results.columns ] ] )
+    finally:
+        if out_file:
+            out_file.close()
+
+    if not parts:
+        return ( pd.DataFrame( columns=EVAL_COLUMNS ), np.zeros( 0 ) )
+    return ( pd.concat( parts, ignore_index=True ), np.concatenate( latencies ) )
+
+def retrieve_runs( pipelines, query_df, names, verbose=True, batch_size=None, run_dir=None, per_topic=False ):
+    # Run each pipeline once; returns [ ( name, results, latencies ) ]. With batch_size,
+    # topics are retrieved in batches, and written to <run_dir>/<name>.res if run_dir is given
+    # (per_topic: see retrieve_run_batched).
+    runs = []
+    for ( pipeline, name ) in zip( pipelines, names ):
+        if verbose:
+            print("  Retrieving: " + name )
+        if batch_size:
+            run_file = os.path.join( run_dir, name + '.res' ) if run_dir else None
+            ( results, latencies ) = retrieve_run_batched( pipeline, query_df, batch_size, run_file, name, per_topic )
+        else:
+            ( results, latencies ) = retrieve_run( pipeline, query_df )
+        runs.append( ( name, results, latencies ) )
+
+    return runs
+
+################################################################
+# Parallel retrieval
+################################################################
+# Pipelines hold JVM objects, and cannot be passed to other processes. Each
+# worker starts its own JVM and builds the pipelines itself, by calling
+# build( *build_args ) (a module-level function returning ( pipelines, names ),
+# as generate_weighting_experiment does).
+WORKER_PIPELINES = None
+
+def init_retrieval_worker( build, build_args ):
+    global WORKER_PIPELINES
+    if not pt.started():
+        pt.init()
+    ( WORKER_PIPELINES, _ ) = build( *build_args )
+
+def retrieve_group( pipeline_ids, queries ):
+    # Run pipelines that share first-stage engines (e.g., cached BM25 retrievers) in the
+    # same worker, one after another, so that later pipelines reuse the cached results
+    return [ retrieve_run( WORKER_PIPELINES[ pipeline_id ], queries ) for pipeline_id in pipeline_ids ]
+
+def split_topics( query_df, topic_batches ):
+    batches = np.array_split( np.arange( len( query_df ) ), max( 1, min( topic_batches, len( query_df ) ) ) )
+    return [ query_df.iloc[ rows ] for rows in batches ]
+
+def retrieve_runs_parallel( build, build_args, query_df, names, workers, topic_batches=1, groups=None ):
+    # Run ( pipeline group, topic batch ) tasks in a pool of worker processes; results
+    # for each pipeline are put back together in topic order. groups: lists of pipeline
+    # ids run together (default: one group per pipeline)
+    batches = split_topics( query_df, topic_batches )
+    groups = groups or [ [ pipeline_id ] for pipeline_id in range( len( names ) ) ]
+    context = get_context( 'spawn' )  # a JVM cannot be shared with forked processes
+    print("  Retrieving " + str( len( names ) ) + " pipelines (" + str( len( groups ) ) + " groups) x " + 
+            str( len( batches ) ) + " topic batches with " + str( workers ) + " workers..." )
+
+    runs = []
+    with ProcessPoolExecutor( max_workers=workers, mp_context=context,
+            initializer=init_retrieval_worker, initargs=( build, build_args ) ) as pool:
+        group_futures = [ [ pool.submit( retrieve_group, group, batch ) for batch in batches ] for group in groups ]
+        parts_by_pipeline = {}
+        for ( group, futures ) in zip( groups, group_futures ):
+            batch_parts = [ future.result() for future in futures ]
+            for ( position, pipeline_id ) in enumerate( group ):
+                parts_by_pipeline[ pipeline_id ] = [ parts[ position ] for parts in batch_parts ]
+
+        for ( pipeline_id, name ) in enumerate( names ):
+            parts = parts_by_pipeline[ pipeline_id ]
+            results = pd.concat( [ results for ( results, _ ) in parts ], ignore_index=True )
+            latencies = np.concatenate( [ latencies for ( _, latencies ) in parts ] )
+            runs.append( ( name, results, latencies ) )
+
+    return runs
+
+################################################################
+# Evaluation
+################################################################
+def metric_columns( prime=True ):
+    # Map PyTerrier measure names to report column names
+    prime_string = "'" if prime else ''
+    return [ ( str( measure ), name.replace( '@', prime_string + '@' ) if '@' in name else name + prime_string )
+            for ( measure, name ) in ARQMATH_METRICS ]
+
+def evaluate_runs( runs, query_df, qrels_df, prime=True, baseline=None, percentiles=None, **kwargs ):
+    # Graded and binarized metrics for in-memory runs, in one table (with 'mrt', and
+    # per-topic latency percentiles if given, e.g., 'p90' ms).
+    # 'baseline' (index of a run) adds significance tests, as for pt.Experiment.
+    names = [ name for ( name, _, _ ) in runs ]
+    metrics = pt.Experiment(
+        [ results for ( _, results, _ ) in runs ],
+        query_df,
+        qrels_df,
+        eval_metrics=[ measure for ( measure, _ ) in ARQMATH_METRICS ],
+        names=names,
+        baseline=baseline,
+        **kwargs
+        )
+
+    # Rename metric columns (incl. baseline comparison columns, e.g., 'nDCG +')
+    renamed = {}
+    for column in metrics.columns:
+        for ( measure_name, name ) in metric_columns( prime ):
+            if column.startswith( measure_name ):
+                renamed[ column ] = name + column[ len( measure_name ): ]
+    metrics = metrics.rename( columns=renamed )
+
+    latencies = { name: run_latencies for ( name, _, run_latencies ) in runs }
+    metrics[ 'mrt' ] = metrics[ 'name' ].map( lambda name: np.mean( latencies[ name ] ) if len( latencies[ name ] ) else 0.0 )
+    for percentile in ( percentiles or [] ):
+        metrics[ 'p' + str( percentile ) ] = metrics[ 'name' ].map(
+                lambda name: np.percentile( latencies[ name ], percentile ) if len( latencies[ name ] ) else 0.0 )
+
+    return metrics
+
+def run_experiment( pipelines, query_df, qrels_df, names, prime=True, baseline=None,
+        batch_size=None, run_dir=None, per_topic=False, **kwargs ):
+    # Retrieve once per pipeline, then evaluate; returns ( metrics, runs ).
+    # Batches go through each pipeline whole, and mrt is taken from the time per batch.
+    # With batch_size and per_topic, topics are instead timed singly, and latency
+    # percentiles are also reported.
+    runs = retrieve_runs( pipelines, query_df, names, batch_size=batch_size, run_dir=run_dir, per_topic=per_topic )
+    percentiles = LATENCY_PERCENTILES if batch_size and per_topic else None
+    metrics = evaluate_runs( runs, query_df, qrels_df, prime, baseline, percentiles, **kwargs )
+
+    return ( metrics, runs )
+
+def run_parallel_experiment( build, build_args, query_df, qrels_df, names, workers, topic_batches=1,
+        prime=True, baseline=None, groups=None, **kwargs ):
+    # As run_experiment, with pipelines built and run in worker processes
+    # (groups: pipeline ids sharing first-stage engines, see retrieve_runs_parallel).
+    # Topic batches are timed as a whole, so latency percentiles are not reported.
+    runs = retrieve_runs_parallel( build, build_args, query_df, names, workers, topic_batches, groups )
+    metrics = evaluate_runs( runs, query_df, qrels_df, prime, baseline, **kwargs )
+
+    return ( metrics, runs )
+
+def report_results( metrics, top_k, prime ):
+    # Make clear what we're using!
+    prime_string = ''
+
+    if prime:
+        prime_string ="'"
+    print("[[ Evaluation  ]]")
+    print(" * Top-k hits evaluated: " + str(top_k ) )
+    print(" * Prime metrics ('): " + str(prime) )
+    print(" * Binarized relevance (P@10" + prime_string + ", MAP" + prime_string + "): relevance >= " + str( REL_THRESHOLD ) )
+    print(" * mrt: mean response time per query (ms); pNN: NNth percentile of time per topic, if reported")
+    print(" * !! Note that ARQMath uses prime metrics for official scores.")
+    print("\nResults")
+    print("----------------------------------------------------------")
+    print( metrics )
+
+    print("\ndone.")
@@ -10,13 +10,66 @@
 import pyterrier.io
 import os
 from bs4 import BeautifulSoup as bsoup
+from lxml import etree
 import sys
 import html
 import pandas as pd
+import numpy as np
 from index_arqmath import *
 
-def load_qrels( file_name ):
-    return pyterrier.io.read_qrels( file_name )
+TOPIC_COLUMNS = [ 'qid', 'query', 'title', 'body', 'tags', 'title_plain' ]
+# Increment when topic conversion changes (cached topic frames are rebuilt)
+TOPIC_CACHE_VERSION = 2
+
+################################################################
+# Cached topic and qrel frames
+################################################################
+# With a cache directory, converted topics and qrels are saved as pickled frames,
+# named by a hash of the source file (and for topics, of the LaTeX recoding settings
+# used for indexing, see doc_cache_settings), and read from there on later runs.
+def frame_cache_path( cache_dir, file_name, settings ):
+    ( name, _ ) = os.path.splitext( os.path.basename( file_name ) )
+    return os.path.join( cache_dir, name + '-' + file_hash( file_name )[:16] + '-' + settings + '.pkl' )
+
+def cached_frame( cache_dir, file_name, settings, read_frame ):
+    # read_frame( file_name ) is only called if no cache file exists
+    if cache_dir is None:
+        return read_frame( file_name )
+
+    cache_path = frame_cache_path( cache_dir, file_name, settings )
+    if os.path.exists( cache_path ):
+        return pd.read_pickle( cache_path )
+
+    frame = read_frame( file_name )
+    os.makedirs( cache_dir, exist_ok=True )
+    temp_path = cache_path + '.' + str( os.getpid() ) + '.tmp'
+    frame.to_pickle( temp_path )
+    os.replace( temp_path, cache_path )
+    return frame
+
+def load_qrels( file_name, cache_dir=None ):
+    return cached_frame( cache_dir, file_name, 'qrels', pyterrier.io.read_qrels )
+
+# Lookup table for assessed ( qid, docno ) pairs, built once per qrel file.
+# qids and docnos are mapped to integer codes via hashed pandas indices, and each
+# pair to a single int64 key ( qid code * number of docnos + docno code ).
+def qrel_key_table( qrel_df ):
+    qids = pd.Index( qrel_df[ 'qid' ].unique() )
+    docnos = pd.Index( qrel_df[ 'docno' ].unique() )
+    keys = qids.get_indexer( qrel_df[ 'qid' ] ).astype( np.int64 ) * len( docnos ) \
+            + docnos.get_indexer( qrel_df[ 'docno' ] )
+
+    return ( qids, docnos, np.unique( keys ) )
+
+# Boolean mask for rows of result_df whose ( qid, docno ) pair is assessed
+def assessed_mask( result_df, key_table ):
+    ( qids, docnos, keys ) = key_table
+    qid_codes = qids.get_indexer( result_df[ 'qid' ] )
+    docno_codes = docnos.get_indexer( result_df[ 'docno' ] )
+    hit_keys = qid_codes.astype( np.int64 ) * len( docnos ) + docno_codes
+
+    # Code -1 marks a qid/docno that does not appear in the qrels at all
+    return ( qid_codes >= 0 ) & ( docno_codes >= 0 ) & np.isin( hit_keys, keys )
 
 # HACK: modifying code from index file to work with topics, no outputs
 # Removes ids (which have no correspondence in index)
@@ -30,18 +83,24 @@ def replace_formulas( soup_tag ):
         del tag['id']
 
 
-def convert_topic( topic_tag ):
+def convert_topic( topic_tag, qpost_term=True ):
     # Topic number and tags
     topic_number = topic_tag['number']
     tags = ''
     if topic_tag.tags:
         tags = html.unescape( topic_tag.tags.get_text() )   
 
+    # DEBUG: Beautiful soup 'get_text()' removes all tags; use str for full trees
+    title_html = html.unescape( str( topic_tag('title')[0] ) )
+    body_html = html.unescape( str( topic_tag('question')[0] ) )
+
+    return convert_topic_fields( topic_number, title_html, body_html, tags, qpost_term )
+
+def convert_topic_fields( topic_number, title_html, body_html, tags, qpost_term=True ):
     # Convert fields to index representation
     # HACK: Removing dollar signs for formulas (appear absent in the index)
-    # DEBUG: Beautiful soup 'get_text()' removes all tags; use str for full trees
-    title_text =  html.unescape( str( topic_tag('title')[0] )).replace('$','')
-    body_text =   html.unescape( str( topic_tag('question')[0])).replace('$','')
+    title_text = title_html.replace('$','')
+    body_text = body_html.replace('$','')
 
     title_soup = bsoup( title_text,  'lxml')
     body_soup = bsoup( body_text, 'lxml')
@@ -56,28 +115,51 @@ def convert_topic( topic_tag ):
     # REWRITE punctuation/math before exporting
     # NOTE: To see original query, please consult original topics files
 
-    title_text = rewrite_symbols( title_soup.get_text(), latex_symbol_map )
-    body_text =  rewrite_symbols(body_soup.get_text(), latex_symbol_map )
+    title_text = translate_latex( title_soup.get_text() )
+    body_text =  translate_latex( body_soup.get_text() )
+
+    # NOTE: <title> content is not parsed as HTML by bsoup (formula <span> markup is
+    # left in title_text); title_plain is the title with its markup parsed and removed,
+    # as for post titles in the index (used by topic_queries.py)
+    plain_soup = bsoup( title_soup.get_text(), 'lxml' )
+    replace_formulas( plain_soup )
+    remove_tags( plain_soup, TAGS_TO_REMOVE )
+    title_plain = translate_latex( plain_soup.get_text() )
     
     # Save full query as TITLE field only (first version)
     # **IMPORTANT**: '- qpost' prepended so that Terrier returns only answer posts.
-    #   This can be removed if you want to see which questions match as well.
-    topic_text = '-qpost ' + title_text 
+    #   This can be removed if you want to see which questions match as well, or if
+    #   questions are removed after retrieval (qpost_term=False, see answer_engine).
+    topic_text = title_text
+    if qpost_term:
+        topic_text = '-qpost ' + title_text 
 
     # BUG: the output text does not contain the 'math' tokens for math tags present
     # in the indexed documents. Skipping for time (BM25 is a bag-of-words model).
-    return ( topic_number, topic_text, title_text, body_text, tags )
-
-def read_topic_file( file_name ):
-    with open( file_name ) as infile:
-        topic_soup = bsoup( infile, 'lxml' )
-        topic_tags = topic_soup('topic')
-
-        # Extract fields
-        tuples = [ convert_topic(tag) for tag in topic_tags ]
-        df = pd.DataFrame( tuples, columns= [  'qid', 'query','title','body','tags' ] )
-
-        return ( len( topic_tags ), df )
+    return ( topic_number, topic_text, title_text, body_text, tags, title_plain )
+
+def read_topic_tuples( file_name, qpost_term=True ):
+    # Streaming XML parse: one <Topic> element at a time, converted as by convert_topic
+    # (Title/Question hold escaped HTML, unescaped once by the XML parser)
+    for ( _, topic ) in etree.iterparse( file_name, events=( 'end', ), tag='Topic' ):
+        yield convert_topic_fields( topic.get( 'number' ),
+                '<title>' + ( topic.findtext( 'Title' ) or '' ) + '</title>',
+                '<question>' + ( topic.findtext( 'Question' ) or '' ) + '</question>',
+                html.unescape( topic.findtext( 'Tags' ) or '' ),
+                qpost_term )
+        topic.clear()
+
+def read_topic_frame( file_name, qpost_term=True ):
+    return pd.DataFrame( list( read_topic_tuples( file_name, qpost_term ) ), columns=TOPIC_COLUMNS )
+
+def read_topic_file( file_name, qpost_term=True, cache_dir=None ):
+    # Returns ( number of topics, topic frame ); with cache_dir, the converted
+    # topics are cached (see cached_frame)
+    settings = 'topics' + str( TOPIC_CACHE_VERSION ) + '-' + doc_cache_settings() + ( '-qpost' if qpost_term else '' )
+    df = cached_frame( cache_dir, file_name, settings,
+            lambda file_name: read_topic_frame( file_name, qpost_term ) )
+
+    return ( len( df ), df )
 
      
 def main():
@@ -0,0 +1,82 @@
+################################################################
+# bench_answer_engine.py
+#
+# Timing comparison for answer-only retrieval over a post index
+# with an answer bitmap: topic queries with a '-qpost' term
+# (search_engine, k hits, all meta fields), vs. answer_engine
+# reading only 'docno' for the fetch_factor * k retrieved hits and
+# the other meta fields for the top k answers, vs. answer_engine
+# reading all meta fields for every retrieved hit. Checks that both
+# answer_engine variants return the same hits.
+#
+# Usage: python3 src/bench_answer_engine.py indexDir topicFile [-k HITS] [-r REPEATS]
+################################################################
+
+import argparse
+import timeit
+import pyterrier as pt
+
+from index_arqmath import open_index, search_engine, answer_engine, answers_only, expand_formula_groups, \
+        index_meta_fields, has_answer_filter, ANSWER_FETCH_FACTOR
+from arqmath_topics_qrels import read_topic_file
+
+def all_meta_answer_engine( index, index_dir, model, metadata_keys, token_pipeline, k ):
+    # answer_engine reading every meta field for all fetch_factor * k hits
+    fetch = ANSWER_FETCH_FACTOR * k
+    return search_engine( index, model, metadata_keys, token_pipeline, num_results=fetch ) \
+            >> expand_formula_groups( index_dir, fetch ) >> answers_only( index_dir, k )
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark answer-only retrieval ('-qpost' queries vs. answer_engine).")
+    parser.add_argument('indexDir', help='post index directory (with an answer bitmap)')
+    parser.add_argument('topicFile', help='ARQMath topic file (XML)')
+    parser.add_argument('-m', '--model', default='BM25', help='term weight model (default: BM25)')
+    parser.add_argument('-t', '--tokens', default='Stopwords,PorterStemmer',
+            help="tokenization property used for the index (none: no stemming/stopword removal)")
+    parser.add_argument('-k', '--hits', type=int, default=1000, help='hits per topic (default: 1000)')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='runs per timing (default: 3)')
+    args = parser.parse_args()
+    if args.tokens == 'none':
+        args.tokens = ''
+
+    if not pt.started():
+        pt.init()
+    if not has_answer_filter( args.indexDir ):
+        parser.error("index has no answer bitmap (re-index to compare with '-qpost' queries)")
+
+    index = open_index( args.indexDir )
+    meta_fields = index_meta_fields( args.indexDir )
+    query_columns = [ 'qid', 'query' ]
+    qpost_queries = read_topic_file( args.topicFile, qpost_term=True )[1][ query_columns ]
+    queries = read_topic_file( args.topicFile, qpost_term=False )[1][ query_columns ]
+    print("Topics: " + str( len( queries ) ) + "   Hits per topic: " + str( args.hits ) +
+            "   Meta fields: " + ', '.join( meta_fields ))
+
+    qpost_engine = search_engine( index, args.model, meta_fields, args.tokens, num_results=args.hits )
+    docno_engine = answer_engine( index, args.indexDir, args.model, meta_fields, args.tokens, k=args.hits )
+    all_meta_engine = all_meta_answer_engine( index, args.indexDir, args.model, meta_fields, args.tokens, args.hits )
+
+    # Check outputs before timing
+    expected = all_meta_engine( queries )
+    results = docno_engine( queries )
+    columns = [ 'qid', 'docno', 'rank' ] + meta_fields
+    if not expected[ columns ].reset_index( drop=True ).equals( results[ columns ].reset_index( drop=True ) ):
+        raise RuntimeError("answer_engine variants disagree: " + str( len( expected ) ) + " vs. " + str( len( results ) ) + " hits")
+    print("Answer hits: " + str( len( results ) ) + " (identical); '-qpost' hits: " + str( len( qpost_engine( qpost_queries ) ) ) + "\n")
+
+    timings = [
+        ( "'-qpost' query term", lambda: qpost_engine( qpost_queries ) ),
+        ( 'answer_engine (all meta)', lambda: all_meta_engine( queries ) ),
+        ( 'answer_engine (docno, meta top k)', lambda: docno_engine( queries ) ),
+    ]
+
+    base_time = None
+    for ( name, run ) in timings:
+        seconds = min( timeit.repeat( run, number=1, repeat=args.repeats ) )
+        if base_time is None:
+            base_time = seconds
+        print( '{:36} {:8.3f}s  {:7.2f}ms/topic   x{:.2f}'.format( name, seconds, 1000 * seconds / len( queries ),
+                base_time / seconds ) )
+
+if __name__ == "__main__":
+    main()
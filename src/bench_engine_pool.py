@@ -0,0 +1,68 @@
+################################################################
+# bench_engine_pool.py
+#
+# Throughput benchmark for concurrent search with an EnginePool
+# (engine_pool.py): the topics of an ARQMath topic file are
+# searched with one engine, then with pools of 2, 4, ... workers
+# over the same (concurrent) index, as with run_topics.py -w N.
+# Checks that every pool returns the same hits as one engine.
+#
+# Usage: python3 src/bench_engine_pool.py indexDir topicFile [-w 1,2,4,8] [-r REPEATS]
+################################################################
+
+import argparse
+import timeit
+import pyterrier as pt
+
+from index_arqmath import open_index, search_engine, answer_engine, index_meta_fields, has_answer_filter
+from arqmath_topics_qrels import read_topic_file
+from engine_pool import EnginePool
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark query throughput of an EnginePool by number of workers.")
+    parser.add_argument('indexDir', help='post index directory')
+    parser.add_argument('topicFile', help='ARQMath topic file (XML)')
+    parser.add_argument('-m', '--model', default='BM25', help='term weight model (default: BM25)')
+    parser.add_argument('-t', '--tokens', default='Stopwords,PorterStemmer',
+            help="tokenization property used for the index (none: no stemming/stopword removal)")
+    parser.add_argument('-k', '--hits', type=int, default=1000, help='hits per topic (default: 1000)')
+    parser.add_argument('-w', '--workers', default='1,2,4,8', help='worker counts, comma-separated (default: 1,2,4,8)')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='runs per timing (default: 3)')
+    args = parser.parse_args()
+    if args.tokens == 'none':
+        args.tokens = ''
+
+    if not pt.started():
+        pt.init()
+
+    # As in run_topics.py: answer_engine without '-qpost' if the index has an answer filter
+    index = open_index( args.indexDir, concurrent=True )
+    meta_fields = index_meta_fields( args.indexDir )
+    answer_filter = has_answer_filter( args.indexDir )
+    queries = read_topic_file( args.topicFile, qpost_term=not answer_filter )[1][ [ 'qid', 'query' ] ]
+
+    def make_engine():
+        if answer_filter:
+            return answer_engine( index, args.indexDir, args.model, meta_fields, args.tokens, k=args.hits )
+        return search_engine( index, args.model, meta_fields, args.tokens, num_results=args.hits )
+
+    print("Topics: " + str( len( queries ) ) + "   Hits per topic: " + str( args.hits ) + "\n")
+    expected = make_engine()( queries )[ [ 'qid', 'docno', 'rank' ] ].reset_index( drop=True )
+
+    base_time = None
+    for workers in [ int( count ) for count in args.workers.split( ',' ) ]:
+        engine = EnginePool( make_engine, workers ) if workers > 1 else make_engine()
+        results = engine( queries )[ [ 'qid', 'docno', 'rank' ] ].reset_index( drop=True )
+        if not results.equals( expected ):
+            raise RuntimeError( str( workers ) + " workers return different hits than one engine" )
+
+        seconds = min( timeit.repeat( lambda: engine( queries ), number=1, repeat=args.repeats ) )
+        if base_time is None:
+            base_time = seconds
+        print( '{:3} worker(s) {:8.3f}s  {:8.1f} queries/s   x{:.2f}'.format( workers, seconds, len( queries ) / seconds,
+                base_time / seconds ) )
+        if workers > 1:
+            engine.close()
+
+if __name__ == "__main__":
+    main()
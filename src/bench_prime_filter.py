@@ -0,0 +1,79 @@
+################################################################
+# bench_prime_filter.py
+#
+# Micro-benchmark for the prime-metric filter (select_assessed_hits
+# in run_topics.py): the original MultiIndex 'isin' test, which
+# rebuilds the qrel index for every result frame, vs. the int64 key
+# lookup built once from the qrels (qrel_key_table/assessed_mask in
+# arqmath_topics_qrels.py). Uses synthetic results and qrels sized
+# like an ARQMath run; checks both filters select the same rows.
+#
+# Usage: python3 src/bench_prime_filter.py [-q TOPICS] [-k HITS] [-r REPEATS]
+################################################################
+
+import argparse
+import timeit
+import numpy as np
+import pandas as pd
+
+from arqmath_topics_qrels import qrel_key_table, assessed_mask
+
+def synthetic_run( num_topics, hits, assessed, seed=0 ):
+    # Result frame with 'hits' ranked posts per topic, and qrels assessing
+    # 'assessed' posts per topic (about half of them also retrieved)
+    rng = np.random.default_rng( seed )
+    qids = [ 'A.' + str( topic ) for topic in range( 1, num_topics + 1 ) ]
+
+    result_rows = []
+    qrel_rows = []
+    for qid in qids:
+        docnos = rng.choice( 2000000, size=hits + assessed, replace=False ).astype( str )
+        result_rows.extend( ( qid, docno, rank ) for ( rank, docno ) in enumerate( docnos[ : hits ] ) )
+        judged = np.concatenate( ( docnos[ : assessed // 2 ], docnos[ hits : hits + assessed // 2 ] ) )
+        qrel_rows.extend( ( qid, docno, int( label ) ) for ( docno, label ) in zip( judged, rng.integers( 0, 4, len( judged ) ) ) )
+
+    result_df = pd.DataFrame( result_rows, columns=[ 'qid', 'docno', 'rank' ] )
+    qrel_df = pd.DataFrame( qrel_rows, columns=[ 'qid', 'docno', 'label' ] )
+    return ( result_df, qrel_df )
+
+def multiindex_filter( result_df, qrel_df ):
+    # Original implementation (qrel index rebuilt on every call)
+    keys = [ 'qid', 'docno' ]
+    i1 = result_df.set_index( keys ).index
+    i2 = qrel_df.set_index( keys ).index
+    return result_df[ i1.isin( i2 ) ]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the prime-metric (assessed hit) filter.")
+    parser.add_argument('-q', '--topics', type=int, default=100, help='number of topics (default: 100)')
+    parser.add_argument('-k', '--hits', type=int, default=1000, help='hits per topic (default: 1000)')
+    parser.add_argument('-a', '--assessed', type=int, default=400, help='assessed posts per topic (default: 400)')
+    parser.add_argument('-r', '--repeats', type=int, default=11, help='filter calls per timing, e.g., one per pipeline (default: 11)')
+    args = parser.parse_args()
+
+    ( result_df, qrel_df ) = synthetic_run( args.topics, args.hits, args.assessed )
+    print("Results: " + str( len( result_df ) ) + " hits   Qrels: " + str( len( qrel_df ) ) + " assessed pairs")
+
+    # Check outputs before timing
+    key_table = qrel_key_table( qrel_df )
+    expected = multiindex_filter( result_df, qrel_df )
+    selected = result_df[ assessed_mask( result_df, key_table ) ]
+    if not expected.equals( selected ):
+        raise RuntimeError("Prime filters disagree: " + str( len( expected ) ) + " vs. " + str( len( selected ) ) + " hits")
+    print("Assessed hits selected: " + str( len( selected ) ) + " (identical)\n")
+
+    timings = [
+        ( 'MultiIndex isin (per call)', lambda: multiindex_filter( result_df, qrel_df ) ),
+        ( 'int64 key table (built once)', lambda: result_df[ assessed_mask( result_df, key_table ) ] ),
+        ( 'int64 key table (incl. build)', lambda: result_df[ assessed_mask( result_df, qrel_key_table( qrel_df ) ) ] ),
+    ]
+
+    base_time = None
+    for ( name, run ) in timings:
+        seconds = min( timeit.repeat( run, number=args.repeats, repeat=3 ) )
+        if base_time is None:
+            base_time = seconds
+        print( '{:32} {:8.4f}s   x{:.1f}'.format( name, seconds, base_time / seconds ) )
+
+if __name__ == "__main__":
+    main()
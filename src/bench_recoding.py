@@ -0,0 +1,76 @@
+################################################################
+# bench_recoding.py
+#
+# Micro-benchmark for LaTeX/query symbol translation
+# (math_recoding.py) over the post titles, bodies and formulas 
+# of an ARQMath XML file. Checks that all translators produce
+# identical output before timing them.
+#
+# Usage: python3 src/bench_recoding.py [xmlFile] [-r REPEATS]
+################################################################
+
+import argparse
+import html
+import re
+import timeit
+from lxml import etree
+
+from math_recoding import *
+
+def read_texts( file_name ):
+    # Title and body strings (HTML unescaped, as indexed) for each post
+    texts = []
+    for ( _, row ) in etree.iterparse( file_name, events=('end',), tag='row', recover=True ):
+        for field in [ 'Title', 'Body' ]:
+            if field in row.attrib:
+                texts.append( html.unescape( row.attrib[ field ] ) )
+        row.clear()
+
+    return texts
+
+def one_pass_regex( map_dict ):
+    # Single-pass alternative: longest-match alternation with a lookup per match
+    keys = sorted( map_dict, key=len, reverse=True )
+    pattern = re.compile( '|'.join( re.escape( key ) for key in keys ) )
+    return lambda in_string: pattern.sub( lambda match: map_dict[ match.group(0) ], in_string )
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark symbol translation for ARQMath text.")
+    parser.add_argument('xmlFile', nargs='?', default='test/indexTest.xml', help='ARQMath XML file (default: test/indexTest.xml)')
+    parser.add_argument('-r', '--repeats', type=int, default=200, help='passes over the collection per timing (default: 200)')
+    args = parser.parse_args()
+
+    texts = read_texts( args.xmlFile )
+    formulas = re.findall( r'<span class="math-container"[^>]*>(.*?)</span>', ' '.join( texts ), re.S )
+    queries = [ '_pand ' + text for text in texts ]
+    total_chars = sum( len( text ) for text in texts + formulas )
+    print('Texts: ' + str( len( texts ) ) + '  Formulas: ' + str( len( formulas ) ) + '  Characters: ' + str( total_chars ) )
+
+    latex_regex = one_pass_regex( latex_symbol_map )
+    pyterrier_regex = one_pass_regex( pyterrier_symbol_map )
+    translators = [
+        ( 'rewrite_symbols (brute force)', 
+            lambda s: rewrite_symbols( s, latex_symbol_map ), 
+            lambda s: rewrite_symbols( rewrite_symbols( s, latex_symbol_map ), pyterrier_symbol_map ) ),
+        ( 'one-pass regex', latex_regex, lambda s: pyterrier_regex( latex_regex( s ) ) ),
+        ( 'compiled (translate_latex)', translate_latex, translate_query ) ]
+
+    # Output must be identical for every translator
+    ( _, reference_latex, reference_query ) = translators[0]
+    for ( name, latex_fn, query_fn ) in translators[1:]:
+        for text in texts + formulas:
+            assert latex_fn( text ) == reference_latex( text ), name + ' output differs: ' + repr( text )
+        for text in queries:
+            assert query_fn( text ) == reference_query( text ), name + ' query output differs: ' + repr( text )
+    print('Output identical for all translators.\n')
+
+    for ( name, latex_fn, query_fn ) in translators:
+        seconds = min( timeit.repeat( lambda: [ latex_fn( text ) for text in texts + formulas ], 
+            number=args.repeats, repeat=3 ) )
+        query_seconds = min( timeit.repeat( lambda: [ query_fn( text ) for text in queries ], 
+            number=args.repeats, repeat=3 ) )
+        mb_per_sec = total_chars * args.repeats / seconds / 1e6
+        print( "{:32s} latex: {:8.4f}s ({:6.1f} MB/s)   query: {:8.4f}s".format( name, seconds, mb_per_sec, query_seconds ) )
+
+if __name__ == "__main__":
+    main()
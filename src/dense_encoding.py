@@ -0,0 +1,236 @@
+################################################################
+# dense_encoding.py
+#
+# Offline dense (bi-encoder) representations for an index built
+# by index_arqmath.py. Each document's text (e.g., 'origtext') is
+# encoded once, into a single vector (CLS or mean pooling), and
+# stored in a float16 array with one row per Terrier docid:
+#
+#   <index>/dense/vectors.npy   float16 ( documents x dimensions )
+#   <index>/dense/docnos.txt    docno for each row (one per line)
+#   <index>/dense/dense.json    header (encoder, pooling, field, ...)
+#
+# Vectors are memory-mapped at search time. DenseScorer reranks
+# first-stage hits (which carry their 'docid') by the dot product
+# of the query vector and the stored document vectors, so only
+# queries are encoded when searching.
+#
+# Cross-encoders (e.g., the vanilla BERT reranker) read the query
+# and document together, and cannot reuse document encodings;
+# this module provides a bi-encoder alternative to them.
+#
+# Requires torch and transformers (imported when encoding).
+#
+# Usage: python3 src/dense_encoding.py indexDir [-f origtext]
+################################################################
+
+import os
+import re
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import pyterrier as pt
+from tqdm import tqdm
+
+from index_arqmath import open_index, open_doc_store, index_segments, TEXT_STORE_KEY
+from rerank import length_batches
+
+DENSE_DIR = 'dense'
+DENSE_ENCODER = 'sentence-transformers/msmarco-bert-base-dot-v5'
+DENSE_POOLING = 'cls'
+POOLING_TYPES = [ 'cls', 'mean' ]
+DENSE_MAX_LENGTH = 256
+# Documents read from the index at a time, and encoded per model call (at most)
+ENCODE_CHUNK = 4096
+ENCODE_BATCH = 32
+
+TAG_PATTERN = re.compile( r'<[^>]+>' )
+# Terrier query syntax removed before encoding queries (e.g., '-qpost', 'term^0.5')
+QUERY_SYNTAX = re.compile( r'(^|\s)-\S+|\^[0-9.]+' )
+
+def dense_paths( index_dir ):
+    dense_dir = os.path.join( index_dir, DENSE_DIR )
+    return ( os.path.join( dense_dir, 'vectors.npy' ), os.path.join( dense_dir, 'docnos.txt' ),
+            os.path.join( dense_dir, 'dense.json' ) )
+
+def has_dense_vectors( index_dir ):
+    return os.path.exists( dense_paths( index_dir )[2] )
+
+def plain_text( text ):
+    # Text without HTML tags or extra spaces
+    return ' '.join( TAG_PATTERN.sub( ' ', text ).split() )
+
+def plain_query( query ):
+    return ' '.join( QUERY_SYNTAX.sub( ' ', query ).split() )
+
+################################################################
+# Encoder
+################################################################
+class DenseEncoder:
+    # Pooled transformer encodings (float32 NumPy arrays) for lists of texts
+    def __init__( self, model_name=DENSE_ENCODER, pooling=DENSE_POOLING, max_length=DENSE_MAX_LENGTH ):
+        import torch
+        from transformers import AutoTokenizer, AutoModel
+
+        if pooling not in POOLING_TYPES:
+            raise ValueError("Unknown pooling: " + pooling )
+        self.torch = torch
+        self.model_name = model_name
+        self.pooling = pooling
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained( model_name )
+        self.model = AutoModel.from_pretrained( model_name ).eval()
+        self.dimensions = self.model.config.hidden_size
+
+    def encode_batch( self, texts ):
+        tokens = self.tokenizer( list( texts ), padding=True, truncation=True, max_length=self.max_length,
+                return_tensors='pt' )
+        with self.torch.no_grad():
+            hidden = self.model( **tokens ).last_hidden_state
+
+        if self.pooling == 'cls':
+            pooled = hidden[ :, 0 ]
+        else:
+            mask = tokens[ 'attention_mask' ].unsqueeze( -1 ).to( hidden.dtype )
+            pooled = ( hidden * mask ).sum( dim=1 ) / mask.sum( dim=1 ).clamp( min=1 )
+        return pooled.float().numpy()
+
+    def encode( self, texts, batch_size=ENCODE_BATCH ):
+        # Texts are encoded in batches of similar length (see rerank.length_batches)
+        texts = list( texts )
+        vectors = np.zeros( ( len( texts ), self.dimensions ), dtype=np.float32 )
+        lengths = np.minimum( [ len( text.split() ) for text in texts ], self.max_length )
+        for batch in length_batches( lengths, batch_size * self.max_length, batch_size ):
+            vectors[ batch ] = self.encode_batch( [ texts[ row ] for row in batch ] )
+
+        return vectors
+
+################################################################
+# Offline document encoding
+################################################################
+def read_index_texts( meta, store, field, start, end ):
+    # ( docnos, texts ) for docids start ... end - 1, from the doc store if given
+    docids = list( range( start, end ) )
+    docnos = list( meta.getItems( TEXT_STORE_KEY, docids ) )
+    if store is not None:
+        return ( docnos, store.get_many( docnos ) )
+
+    return ( docnos, list( meta.getItems( field, docids ) ) )
+
+def encode_index( index_dir, field='origtext', model_name=DENSE_ENCODER, pooling=DENSE_POOLING,
+        max_length=DENSE_MAX_LENGTH, batch_size=ENCODE_BATCH ):
+    # Encode every document of a (post) index, in docid order
+    index = open_index( index_dir )
+    meta = index.getMetaIndex()
+    store = open_doc_store( index_dir, field )
+    doc_count = index.getCollectionStatistics().getNumberOfDocuments()
+    encoder = DenseEncoder( model_name, pooling, max_length )
+
+    ( vectors_path, docnos_path, header_path ) = dense_paths( index_dir )
+    os.makedirs( os.path.dirname( vectors_path ), exist_ok=True )
+    if os.path.exists( header_path ):
+        os.remove( header_path )
+    vectors = np.lib.format.open_memmap( vectors_path, mode='w+', dtype=np.float16,
+            shape=( doc_count, encoder.dimensions ) )
+
+    with open( docnos_path, 'w' ) as docnos_file:
+        for start in tqdm( range( 0, doc_count, ENCODE_CHUNK ), desc='encoding', unit='chunk' ):
+            end = min( start + ENCODE_CHUNK, doc_count )
+            ( docnos, texts ) = read_index_texts( meta, store, field, start, end )
+            vectors[ start:end ] = encoder.encode( [ plain_text( text ) for text in texts ], batch_size )
+            docnos_file.write( ''.join( docno + '\n' for docno in docnos ) )
+    vectors.flush()
+    del vectors
+
+    # Header written last: vectors are only used once complete
+    header = { 'encoder': model_name, 'pooling': pooling, 'max_length': max_length, 'field': field,
+            'documents': doc_count, 'dimensions': encoder.dimensions, 'segments': len( index_segments( index_dir ) ) }
+    with open( header_path, 'w' ) as header_file:
+        json.dump( header, header_file, indent=2 )
+
+    return header
+
+def read_dense_header( index_dir ):
+    with open( dense_paths( index_dir )[2] ) as header_file:
+        return json.load( header_file )
+
+def check_dense_vectors( index_dir, header, vectors, index=None ):
+    # Vector rows are Terrier docids: raise an error if the index was rebuilt or updated
+    # (e.g., a segment added with -u) after encoding
+    if index is None:
+        index = open_index( index_dir )
+    documents = index.getCollectionStatistics().getNumberOfDocuments()
+    segments = len( index_segments( index_dir ) )
+    if header['documents'] != documents or header['segments'] != segments or len( vectors ) != documents:
+        raise ValueError( "Dense vectors in " + os.path.join( index_dir, DENSE_DIR ) + " were encoded for " +
+                str( header['documents'] ) + " documents in " + str( header['segments'] ) + " segment(s), but the index has " +
+                str( documents ) + " documents in " + str( segments ) + " segment(s); re-encode with: " +
+                "python3 src/dense_encoding.py " + index_dir )
+
+def load_dense_vectors( index_dir, index=None ):
+    # ( header, memory-mapped float16 vectors ) for an encoded index, checked against
+    # the index (opened if not given)
+    header = read_dense_header( index_dir )
+    vectors = np.load( dense_paths( index_dir )[0], mmap_mode='r' )
+    check_dense_vectors( index_dir, header, vectors, index )
+    return ( header, vectors )
+
+def load_dense_docnos( index_dir ):
+    with open( dense_paths( index_dir )[1] ) as docnos_file:
+        return np.array( docnos_file.read().split(), dtype=object )
+
+################################################################
+# Search-time scoring
+################################################################
+class DenseScorer( pt.Transformer ):
+    # Rescore hits (with a 'docid' column, e.g., from search_engine) by the dot product
+    # of query and stored document vectors; ranks are recomputed per query
+    def __init__( self, index_dir, encoder=None, index=None ):
+        super().__init__()
+        ( self.header, self.vectors ) = load_dense_vectors( index_dir, index )
+        self.encoder = encoder or DenseEncoder( self.header['encoder'], self.header['pooling'], self.header['max_length'] )
+        self.query_vectors = {}
+
+    def encode_queries( self, queries ):
+        # Query vectors (cached by query text)
+        missing = [ query for query in dict.fromkeys( queries ) if query not in self.query_vectors ]
+        if missing:
+            self.query_vectors.update( zip( missing, self.encoder.encode( [ plain_query( query ) for query in missing ] ) ) )
+        return np.vstack( [ self.query_vectors[ query ] for query in queries ] )
+
+    def transform( self, results ):
+        if len( results ) == 0:
+            return results
+
+        ( query_codes, queries ) = pd.factorize( results[ 'query' ] )
+        query_vectors = self.encode_queries( list( queries ) )
+        # Fancy indexing reads only the rows for the hits from the memory-mapped array
+        doc_vectors = np.asarray( self.vectors[ results[ 'docid' ].to_numpy() ], dtype=np.float32 )
+
+        results = results.assign( score=np.einsum( 'ij,ij->i', doc_vectors, query_vectors[ query_codes ] ) )
+        results = results.sort_values( [ 'qid', 'score' ], ascending=[ True, False ], kind='stable' ).reset_index( drop=True )
+        results[ 'rank' ] = results.groupby( 'qid', sort=False ).cumcount()
+        return results
+
+################################################################
+# Main program
+################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Encode the documents of an ARQMath index as dense vectors (float16, one row per docid).")
+    parser.add_argument('indexDir', help='index directory (from index_arqmath.py)')
+    parser.add_argument('-f', '--field', default='origtext', help="document text field to encode (default: origtext)" )
+    parser.add_argument('-e', '--encoder', default=DENSE_ENCODER, help="HuggingFace encoder model (default: " + DENSE_ENCODER + ")" )
+    parser.add_argument('-p', '--pooling', default=DENSE_POOLING, choices=POOLING_TYPES, help="vector pooling (default: cls)" )
+    parser.add_argument('-l', '--max-length', type=int, default=DENSE_MAX_LENGTH, help="maximum tokens per document (default: 256)" )
+    parser.add_argument('-b', '--batch-size', type=int, default=ENCODE_BATCH, help="documents per encoder call (default: 32)" )
+    args = parser.parse_args()
+
+    if not pt.started():
+        pt.init()
+    header = encode_index( args.indexDir, args.field, args.encoder, args.pooling, args.max_length, args.batch_size )
+    print("Encoded " + str( header['documents'] ) + " documents (" + str( header['dimensions'] ) + " dimensions) in " +
+            os.path.join( args.indexDir, DENSE_DIR ) )
+
+if __name__ == "__main__":
+    main()
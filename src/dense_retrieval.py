@@ -0,0 +1,178 @@
+################################################################
+# dense_retrieval.py
+#
+# Dense first-stage retrieval over the post collection, using an
+# approximate nearest neighbour (ANN) index built with faiss over
+# the vectors from dense_encoding.py (one row per Terrier docid).
+#
+# The default index ('IVF4096,PQ64', inner product) stores each
+# vector as 64 bytes, and searches nprobe of 4096 clusters, so that
+# memory stays bounded for the full collection; other faiss index
+# factory strings may be used (e.g., 'HNSW32' or 'HNSW32,SQfp16'
+# for lower latency with more memory). For small collections, the
+# number of IVF clusters is reduced to fit the vectors available
+# for training, and below ANN_MIN_VECTORS a 'Flat' (exact) index
+# is built instead.
+#
+#   <index>/dense/ann.faiss   faiss index (ids are Terrier docids)
+#   <index>/dense/ann.json    header (factory string, vectors)
+#
+# DenseRetriever is a PyTerrier transformer returning the same
+# columns as search_engine (qid, docid, docno, score, rank, plus
+# query columns), so it can be combined with BM25 engines, e.g.,
+#   (bm25_post_engine * 5) + (dense_engine * 5)
+#
+# Requires faiss (and torch/transformers to encode queries).
+#
+# Usage: python3 src/dense_retrieval.py indexDir [--factory F]
+################################################################
+
+import os
+import re
+import json
+import time
+import argparse
+import numpy as np
+import pyterrier as pt
+from tqdm import tqdm
+
+from dense_encoding import DENSE_DIR, DenseEncoder, plain_query, load_dense_vectors, load_dense_docnos
+from index_arqmath import open_index, answer_bitmap, answers_only, add_meta_fields, ANSWER_FETCH_FACTOR
+
+ANN_FACTORY = 'IVF4096,PQ64'
+ANN_NPROBE = 32
+ANN_TRAIN_SIZE = 200000
+ANN_ADD_CHUNK = 100000
+# Training vectors per IVF cluster (faiss warns below 39), and vectors needed
+# for an IVF index (fewer are searched exactly, with a 'Flat' index)
+ANN_POINTS_PER_CLUSTER = 39
+ANN_MIN_VECTORS = 10000
+
+def ann_paths( index_dir ):
+    dense_dir = os.path.join( index_dir, DENSE_DIR )
+    return ( os.path.join( dense_dir, 'ann.faiss' ), os.path.join( dense_dir, 'ann.json' ) )
+
+def has_ann_index( index_dir ):
+    return os.path.exists( ann_paths( index_dir )[1] )
+
+################################################################
+# Building the ANN index
+################################################################
+def fit_ann_factory( factory, vector_count, train_size=ANN_TRAIN_SIZE ):
+    # Factory string for vector_count vectors: 'Flat' for small collections, and
+    # otherwise 'IVF<n>' clusters capped so that each has enough training vectors
+    if vector_count < ANN_MIN_VECTORS:
+        return 'Flat'
+
+    match = re.search( r'IVF([0-9]+)', factory )
+    if match is None:
+        return factory
+    nlist = min( int( match.group(1) ), min( train_size, vector_count ) // ANN_POINTS_PER_CLUSTER )
+    return factory[ : match.start(1) ] + str( max( nlist, 1 ) ) + factory[ match.end(1): ]
+
+def build_ann_index( index_dir, factory=ANN_FACTORY, train_size=ANN_TRAIN_SIZE ):
+    # Train (on a sample of vectors, if needed) and add all vectors, a chunk at a time
+    import faiss
+
+    ( dense_header, vectors ) = load_dense_vectors( index_dir )
+    ( ann_path, header_path ) = ann_paths( index_dir )
+    if os.path.exists( header_path ):
+        os.remove( header_path )
+    factory = fit_ann_factory( factory, len( vectors ), train_size )
+
+    start = time.time()
+    ann = faiss.index_factory( vectors.shape[1], factory, faiss.METRIC_INNER_PRODUCT )
+    if not ann.is_trained:
+        sample = np.sort( np.random.default_rng( 0 ).choice( len( vectors ), min( train_size, len( vectors ) ), replace=False ) )
+        ann.train( np.asarray( vectors[ sample ], dtype=np.float32 ) )
+
+    for first in tqdm( range( 0, len( vectors ), ANN_ADD_CHUNK ), desc='adding', unit='chunk' ):
+        ann.add( np.asarray( vectors[ first : first + ANN_ADD_CHUNK ], dtype=np.float32 ) )
+    faiss.write_index( ann, ann_path )
+
+    # Header written last: the index is only used once complete
+    header = { 'factory': factory, 'vectors': int( ann.ntotal ), 'encoder': dense_header['encoder'],
+            'seconds': round( time.time() - start, 1 ) }
+    with open( header_path, 'w' ) as header_file:
+        json.dump( header, header_file, indent=2 )
+
+    return header
+
+def read_ann_index( index_dir, nprobe=ANN_NPROBE ):
+    # Memory-mapped where the index type allows it (e.g., IVF indices)
+    import faiss
+
+    ann_path = ann_paths( index_dir )[0]
+    try:
+        ann = faiss.read_index( ann_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY )
+    except RuntimeError:
+        ann = faiss.read_index( ann_path )
+
+    if 'IVF' in read_ann_header( index_dir )[ 'factory' ]:
+        faiss.ParameterSpace().set_index_parameters( ann, 'nprobe=' + str( nprobe ) )
+    return ann
+
+def read_ann_header( index_dir ):
+    with open( ann_paths( index_dir )[1] ) as header_file:
+        return json.load( header_file )
+
+################################################################
+# Dense retriever
+################################################################
+class DenseRetriever( pt.Transformer ):
+    # Top k hits for each query from the ANN index, as ( qid, query columns, docid, docno, score, rank )
+    def __init__( self, index_dir, k=1000, nprobe=ANN_NPROBE, encoder=None ):
+        super().__init__()
+        self.k = k
+        # Vectors are checked against the index, and the ANN index against the vectors
+        ( header, _ ) = load_dense_vectors( index_dir )
+        if read_ann_header( index_dir )[ 'vectors' ] != header[ 'documents' ]:
+            raise ValueError( "Dense ANN index in " + ann_paths( index_dir )[0] + " does not match the dense vectors; " +
+                    "rebuild it with: python3 src/dense_retrieval.py " + index_dir )
+        self.ann = read_ann_index( index_dir, nprobe )
+        self.docnos = load_dense_docnos( index_dir )
+        if encoder is None:
+            encoder = DenseEncoder( header['encoder'], header['pooling'], header['max_length'] )
+        self.encoder = encoder
+
+    def transform( self, queries ):
+        query_vectors = self.encoder.encode( [ plain_query( query ) for query in queries[ 'query' ] ] )
+        ( scores, docids ) = self.ann.search( np.ascontiguousarray( query_vectors, dtype=np.float32 ), self.k )
+
+        # One row per ( query, hit ); faiss marks missing hits with docid -1
+        found = docids >= 0
+        rows = np.repeat( np.arange( len( queries ) ), found.sum( axis=1 ) )
+        results = queries.iloc[ rows ].reset_index( drop=True )
+        results[ 'docid' ] = docids[ found ]
+        results[ 'docno' ] = self.docnos[ docids[ found ] ]
+        results[ 'score' ] = scores[ found ]
+        results[ 'rank' ] = results.groupby( 'qid', sort=False ).cumcount()
+        return results
+
+def dense_engine( index_dir, k=1000, nprobe=ANN_NPROBE, encoder=None ):
+    # Dense retrieval of answer posts: extra hits are retrieved and questions removed, as for
+    # answer_engine in index_arqmath.py (using 'parentno' from the meta index without a bitmap)
+    retriever = DenseRetriever( index_dir, ANSWER_FETCH_FACTOR * k, nprobe, encoder )
+    if answer_bitmap( index_dir ) is None:
+        retriever = retriever >> add_meta_fields( open_index( index_dir ), [ 'parentno' ] )
+
+    return retriever >> answers_only( index_dir, k )
+
+################################################################
+# Main program
+################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Build a faiss ANN index over dense post vectors (from src/dense_encoding.py).")
+    parser.add_argument('indexDir', help='index directory with dense vectors')
+    parser.add_argument('--factory', default=ANN_FACTORY, help="faiss index factory string (default: " + ANN_FACTORY + ")" )
+    parser.add_argument('--train-size', type=int, default=ANN_TRAIN_SIZE, help="vectors sampled for training (default: 200000)" )
+    args = parser.parse_args()
+
+    # The index is opened to check the dense vectors against it
+    if not pt.started():
+        pt.init()
+    header = build_ann_index( args.indexDir, args.factory, args.train_size )
+    print("Indexed " + str( header['vectors'] ) + " vectors (" + header['factory'] + ") in " + str( header['seconds'] ) + "s" )
+
+if __name__ == "__main__":
+    main()
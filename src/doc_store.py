@@ -0,0 +1,175 @@
+################################################################
+# doc_store.py
+#
+# External document store for long text fields (e.g., 'origtext'),
+# kept outside of the PyTerrier meta index. Text is only read
+# for the documents asked for (e.g., top-k hits), and is not
+# truncated to a fixed width.
+#
+# For each field, a store directory holds:
+#   <field>.blob     texts (UTF-8, optionally zlib-compressed), concatenated
+#   <field>.offsets  int64 start offset of each text, plus end of the blob
+#   <field>.keys     key (e.g., docno) of each text, one per line
+#   <field>.sorted.npy  keys in sorted order (fixed-width bytes)
+#   <field>.order.npy   position of each sorted key (int64)
+#   <field>.json     header (compression, number of texts)
+# The blob, offsets, and sorted key files are memory-mapped when
+# the store is opened; keys are found by binary search, so no
+# per-key Python objects are built (millions for formula stores).
+################################################################
+
+import os
+import json
+import mmap
+import zlib
+from array import array
+import numpy as np
+
+COMPRESSION_TYPES = [ 'none', 'zlib' ]
+
+def store_paths( store_dir, field ):
+    base = os.path.join( store_dir, field )
+    return ( base + '.blob', base + '.offsets', base + '.keys', base + '.json' )
+
+def sorted_key_paths( store_dir, field ):
+    base = os.path.join( store_dir, field )
+    return ( base + '.sorted.npy', base + '.order.npy' )
+
+def read_store_keys( keys_path ):
+    # Keys as a fixed-width bytes array, in store order
+    with open( keys_path, 'rb' ) as keys_file:
+        return np.array( keys_file.read().splitlines(), dtype=bytes )
+
+def sort_store_keys( keys ):
+    # ( sorted keys, positions of sorted keys )
+    order = np.argsort( keys, kind='stable' )
+    return ( keys[ order ], order.astype( np.int64 ) )
+
+
+################################################################
+# Writing
+################################################################
+class DocStoreWriter:
+    # Append ( key, text ) records for one field; call close() (or use 'with')
+    # to write the offset table and header.
+    def __init__( self, store_dir, field, compression='none' ):
+        if compression not in COMPRESSION_TYPES:
+            raise ValueError("Unknown doc store compression: " + compression )
+
+        os.makedirs( store_dir, exist_ok=True )
+        ( blob_path, self.offsets_path, self.keys_path, self.header_path ) = store_paths( store_dir, field )
+        self.sorted_paths = sorted_key_paths( store_dir, field )
+        self.field = field
+        self.compression = compression
+        self.blob_file = open( blob_path, 'wb' )
+        self.keys_file = open( self.keys_path, 'w', encoding='utf-8' )
+        self.offsets = array( 'q', [ 0 ] )
+
+    def add( self, key, text ):
+        data = text.encode( 'utf-8' )
+        if self.compression == 'zlib':
+            data = zlib.compress( data )
+
+        self.blob_file.write( data )
+        self.offsets.append( self.offsets[-1] + len( data ) )
+        self.keys_file.write( str( key ) + '\n' )
+
+    def close( self ):
+        self.blob_file.close()
+        self.keys_file.close()
+        with open( self.offsets_path, 'wb' ) as offsets_file:
+            self.offsets.tofile( offsets_file )
+        for ( path, values ) in zip( self.sorted_paths, sort_store_keys( read_store_keys( self.keys_path ) ) ):
+            np.save( path, values )
+        with open( self.header_path, 'w' ) as header_file:
+            json.dump( { 'compression': self.compression, 'count': len( self.offsets ) - 1 }, header_file )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc_info ):
+        self.close()
+
+
+################################################################
+# Reading
+################################################################
+class DocStorePart:
+    # One store directory (e.g., for one index shard or segment)
+    def __init__( self, store_dir, field ):
+        ( blob_path, offsets_path, keys_path, header_path ) = store_paths( store_dir, field )
+        with open( header_path ) as header_file:
+            header = json.load( header_file )
+        self.compression = header['compression']
+
+        self.blob = map_file( blob_path )
+        self.offsets = memoryview( map_file( offsets_path ) ).cast( 'q' )
+        ( sorted_path, order_path ) = sorted_key_paths( store_dir, field )
+        if os.path.exists( sorted_path ) and header['count'] > 0:
+            self.sorted_keys = np.load( sorted_path, mmap_mode='r' )
+            self.order = np.load( order_path, mmap_mode='r' )
+        else:
+            # Stores written before sorted keys were added (or empty stores)
+            ( self.sorted_keys, self.order ) = sort_store_keys( read_store_keys( keys_path ) )
+
+    def positions( self, keys ):
+        # Store positions for keys (a list of str), -1 for keys not in this part
+        positions = np.full( len( keys ), -1, dtype=np.int64 )
+        if len( self.sorted_keys ) == 0 or len( keys ) == 0:
+            return positions
+
+        queries = np.array( [ str( key ).encode( 'utf-8' ) for key in keys ], dtype=bytes )
+        found = np.searchsorted( self.sorted_keys, queries )
+        in_range = found < len( self.sorted_keys )
+        matched = np.zeros( len( keys ), dtype=bool )
+        matched[ in_range ] = self.sorted_keys[ found[ in_range ] ] == queries[ in_range ]
+        positions[ matched ] = self.order[ found[ matched ] ]
+        return positions
+
+    def text( self, position ):
+        data = self.blob[ self.offsets[ position ] : self.offsets[ position + 1 ] ]
+        if self.compression == 'zlib':
+            data = zlib.decompress( data )
+        return data.decode( 'utf-8' )
+
+    def get( self, key ):
+        # Returns None if the key is not in this part
+        position = self.positions( [ key ] )[0]
+        return None if position < 0 else self.text( position )
+
+def map_file( path ):
+    # Read-only memory map (empty files cannot be mapped)
+    if os.path.getsize( path ) == 0:
+        return b''
+    with open( path, 'rb' ) as in_file:
+        return mmap.mmap( in_file.fileno(), 0, access=mmap.ACCESS_READ )
+
+class DocStore:
+    # Lookup of stored text by key, over one or more store directories
+    def __init__( self, store_dirs, field ):
+        self.field = field
+        self.parts = [ DocStorePart( store_dir, field ) for store_dir in store_dirs ]
+
+    def get( self, key, default='' ):
+        for part in self.parts:
+            text = part.get( key )
+            if text is not None:
+                return text
+        return default
+
+    def get_many( self, keys, default='' ):
+        # One binary search per part for all keys; keys found in an earlier part are kept
+        keys = list( keys )
+        texts = [ None ] * len( keys )
+        for part in self.parts:
+            missing = [ i for ( i, text ) in enumerate( texts ) if text is None ]
+            if not missing:
+                break
+            for ( i, position ) in zip( missing, part.positions( [ keys[ i ] for i in missing ] ) ):
+                if position >= 0:
+                    texts[ i ] = part.text( position )
+
+        return [ default if text is None else text for text in texts ]
+
+def has_doc_store( store_dir, field ):
+    return os.path.exists( store_paths( store_dir, field )[3] )
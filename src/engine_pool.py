@@ -0,0 +1,100 @@
+################################################################
+# engine_pool.py
+#
+# Concurrent query execution over a loaded index. An EnginePool
+# holds one search engine (e.g., a BatchRetrieve pipeline from
+# search_engine or answer_engine) per worker, all over the same
+# index, and runs batches of queries on worker threads. Terrier
+# searches run in the JVM, outside the Python GIL, so threads
+# searching with separate engines run in parallel. Index
+# structures are not thread-safe: open the index with
+# open_index( index_dir, concurrent=True ).
+#
+# See bench_engine_pool.py for throughput by number of workers.
+#
+# Backpressure: at most max_pending batches are queued or running
+# at once; submit() blocks until a slot is free, so callers with
+# large topic sets do not queue every batch at once.
+#
+# An EnginePool is a PyTerrier transformer: a query frame is
+# split into batches, the batches are searched concurrently, and
+# results are returned in query order, e.g.,
+#   index = open_index( index_dir, concurrent=True )
+#   pool = EnginePool( lambda: search_engine( index, 'BM25' ), workers=8 )
+#   batch_query( pool, [ 'sqrt 2', 'proof' ] )
+################################################################
+
+import math
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import pyterrier as pt
+
+# Batches queued or running per worker (backpressure limit)
+PENDING_PER_WORKER = 2
+# Default batches per worker in transform (smaller batches balance uneven query times)
+BATCHES_PER_WORKER = 4
+
+class EnginePool( pt.Transformer ):
+    # make_engine: function returning a new engine (called once per worker)
+    # workers: engines and threads; batch_size: queries per batch in transform
+    # (default: BATCHES_PER_WORKER batches per worker); max_pending: batches queued or running
+    def __init__( self, make_engine, workers=4, batch_size=None, max_pending=None ):
+        super().__init__()
+        self.workers = max( 1, workers )
+        self.batch_size = batch_size
+        self.engines = queue.Queue()
+        for _ in range( self.workers ):
+            self.engines.put( make_engine() )
+
+        self.executor = ThreadPoolExecutor( self.workers, thread_name_prefix='engine' )
+        self.slots = threading.BoundedSemaphore( max_pending or PENDING_PER_WORKER * self.workers )
+
+    def run( self, queries ):
+        # Search with a free engine (waits for one if all are in use)
+        engine = self.engines.get()
+        try:
+            return engine( queries )
+        finally:
+            self.engines.put( engine )
+
+    def submit( self, queries ):
+        # Future for the results of a query frame; blocks while max_pending batches are pending
+        self.slots.acquire()
+        try:
+            future = self.executor.submit( self.run, queries )
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback( lambda _: self.slots.release() )
+        return future
+
+    def imap( self, batches ):
+        # Results for each query frame in batches, in order; batches are submitted as slots
+        # become free, so batches may be generated lazily
+        pending = deque()
+        for batch in batches:
+            # Yield finished results before submitting (and possibly waiting for a slot)
+            while pending and pending[0].done():
+                yield pending.popleft().result()
+            pending.append( self.submit( batch ) )
+        while pending:
+            yield pending.popleft().result()
+
+    def split( self, queries ):
+        batch_size = self.batch_size or math.ceil( len( queries ) / ( BATCHES_PER_WORKER * self.workers ) )
+        return [ queries.iloc[ start : start + batch_size ] for start in range( 0, len( queries ), batch_size ) ]
+
+    def transform( self, queries ):
+        if len( queries ) == 0:
+            return self.run( queries )
+        results = list( self.imap( self.split( queries ) ) )
+        return pd.concat( results, ignore_index=True ) if len( results ) > 1 else results[0]
+
+    def close( self ):
+        self.executor.shutdown( wait=True )
+
+    def __repr__( self ):
+        return 'EnginePool(workers=' + str( self.workers ) + ')'
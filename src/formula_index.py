@@ -0,0 +1,425 @@
+################################################################
+# formula_index.py
+#
+# Structural formula index over Presentation MathML (SLT) formulas,
+# as provided in ARQMath formula TSV files (e.g., *_formulas_slt.tsv
+# for topics, and the slt_representation TSVs for the collection).
+#
+# Each formula is converted to a Symbol Layout Tree (SLT): symbols
+# on writing lines, connected by spatial edges
+#   n: next   a: above/superscript   b: below/subscript
+#   o: over (numerator, over)   u: under (denominator, under)
+#   w: within (radicals, tables)   c: pre-superscript (root index)
+# and represented by symbol pair tuples ( ancestor, descendant,
+# edge path ) for paths up to PAIR_WINDOW edges long.
+#
+# Tuples are stored in a compact inverted index (memory-mapped
+# NumPy arrays). Formulas are scored by the Dice coefficient over
+# matched tuples, and a PyTerrier transformer (formula_engine)
+# returns posts ranked by their best-matching formulas, with
+# 'docno' holding the post id as for the math index pipelines in
+# run_topics_experiment.py.
+#
+# When the TSV files give formula types, an answer bitmap over
+# the indexed posts is saved (posts without 'title' or 'question'
+# formulas are answers), and formula_engine removes questions
+# with answers_only, as answer_engine does for Terrier indices.
+#
+# Usage: python3 src/formula_index.py indexDir tsvFile [tsvFile ...]
+################################################################
+
+import os
+import csv
+import sys
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import pyterrier as pt
+from lxml import etree
+from array import array
+from tqdm import tqdm
+
+from index_arqmath import answers_only, ANSWER_BITMAP_FILE, ANSWER_FETCH_FACTOR
+
+PAIR_WINDOW = 2
+INDEX_HEADER = 'formula_index.json'
+INDEX_ARRAYS = [ 'offsets', 'formulas', 'counts', 'lengths', 'posts' ]
+
+# Invisible operators (function application, times, separator, plus)
+INVISIBLE_OPS = { '\u2061', '\u2062', '\u2063', '\u2064', '' }
+
+# Presentation MathML layout elements: ( child edges, in order ); base is child 0
+SCRIPT_EDGES = {
+    'msup': [ 'a' ],
+    'msub': [ 'b' ],
+    'msubsup': [ 'b', 'a' ],
+    'mover': [ 'o' ],
+    'munder': [ 'u' ],
+    'munderover': [ 'u', 'o' ],
+}
+IGNORED_ELEMENTS = { 'annotation', 'annotation-xml', 'mspace', 'none', 'mprescripts', 'merror' }
+
+################################################################
+# MathML -> Symbol Layout Tree
+################################################################
+# SLT nodes are [ label, [ ( edge, node ), ... ] ]
+def slt_node( label ):
+    return [ label, [] ]
+
+def local_name( element ):
+    return etree.QName( element ).localname
+
+def element_text( element ):
+    return ( element.text or '' ).strip()
+
+def slt_line( element ):
+    # Nodes on the writing line for an element (in order, not yet linked)
+    name = local_name( element )
+    children = [ child for child in element if isinstance( child.tag, str ) ]
+
+    if name in IGNORED_ELEMENTS:
+        return []
+    if name == 'mi':
+        return [ slt_node( 'V!' + element_text( element ) ) ] if element_text( element ) else []
+    if name == 'mn':
+        return [ slt_node( 'N!' + element_text( element ) ) ]
+    if name == 'mo':
+        text = element_text( element )
+        return [] if text in INVISIBLE_OPS else [ slt_node( text ) ]
+    if name in [ 'mtext', 'ms' ]:
+        return [ slt_node( 'T!' + element_text( element ) ) ] if element_text( element ) else []
+
+    if name == 'semantics':
+        return slt_line( children[0] ) if children else []
+
+    if name in SCRIPT_EDGES and children:
+        base = slt_line( children[0] )
+        if not base:
+            base = [ slt_node( 'W!' ) ]
+        for ( edge, script ) in zip( SCRIPT_EDGES[ name ], children[1:] ):
+            attach( base[-1], edge, slt_line( script ) )
+        return base
+
+    if name == 'mfrac' and len( children ) == 2:
+        frac = slt_node( 'O!frac' )
+        attach( frac, 'o', slt_line( children[0] ) )
+        attach( frac, 'u', slt_line( children[1] ) )
+        return [ frac ]
+
+    if name == 'msqrt':
+        radical = slt_node( 'O!sqrt' )
+        attach( radical, 'w', concat_lines( children ) )
+        return [ radical ]
+
+    if name == 'mroot' and len( children ) == 2:
+        radical = slt_node( 'O!root' )
+        attach( radical, 'w', slt_line( children[0] ) )
+        attach( radical, 'c', slt_line( children[1] ) )
+        return [ radical ]
+
+    if name == 'mfenced':
+        line = [ slt_node( element.get( 'open', '(' ) ) ]
+        line += concat_lines( children )
+        line.append( slt_node( element.get( 'close', ')' ) ) )
+        return line
+
+    if name == 'mtable':
+        table = slt_node( 'M!table' )
+        attach( table, 'w', concat_lines( children ) )
+        return [ table ]
+
+    # mrow, math, mstyle, mpadded, mtr, mtd, ...: children in order
+    return concat_lines( children )
+
+def concat_lines( elements ):
+    line = []
+    for element in elements:
+        line.extend( slt_line( element ) )
+    return line
+
+def attach( parent, edge, line ):
+    # Link a line below parent (edge), with 'n' edges along the line
+    if not line:
+        return
+    parent[1].append( ( edge, line[0] ) )
+    for ( left, right ) in zip( line, line[1:] ):
+        left[1].append( ( 'n', right ) )
+
+# Recovering parser: some files have unescaped '<' in alttext attributes
+MATHML_PARSER = etree.XMLParser( recover=True )
+
+def mathml_slt( mathml ):
+    # Root node of the SLT for a Presentation MathML string (None if empty/invalid)
+    try:
+        root = etree.fromstring( mathml.strip().encode( 'utf-8' ), MATHML_PARSER )
+    except etree.XMLSyntaxError:
+        return None
+    if root is None:
+        return None
+
+    line = slt_line( root )
+    if not line:
+        return None
+    start = slt_node( 'S!' )
+    attach( start, 'n', line )
+    return start[1][0][1]
+
+################################################################
+# Symbol pair tuples
+################################################################
+def slt_tuples( root, window=PAIR_WINDOW ):
+    # Counts of ( ancestor, descendant, path ) tuples, for paths up to 'window' edges;
+    # single-symbol formulas give one ( symbol, '0!', '' ) tuple
+    counts = {}
+    stack = [ root ]
+    while stack:
+        node = stack.pop()
+        frontier = [ ( child, edge ) for ( edge, child ) in node[1] ]
+        for depth in range( window ):
+            next_frontier = []
+            for ( child, path ) in frontier:
+                key = node[0] + '\t' + child[0] + '\t' + path
+                counts[ key ] = counts.get( key, 0 ) + 1
+                if depth + 1 < window:
+                    next_frontier.extend( ( grandchild, path + edge ) for ( edge, grandchild ) in child[1] )
+            frontier = next_frontier
+        stack.extend( child for ( _, child ) in node[1] )
+
+    if not counts:
+        counts[ root[0] + '\t0!\t' ] = 1
+    return counts
+
+def mathml_tuples( mathml, window=PAIR_WINDOW ):
+    root = mathml_slt( mathml )
+    return slt_tuples( root, window ) if root is not None else {}
+
+################################################################
+# Reading formula TSV files
+################################################################
+def read_formula_tsv( file_name ):
+    # Yields ( formula id, post/thread id, topic id, type, MathML ) per row; the
+    # MathML is in the last column ('slt' or 'formula'), posts in 'post_id'
+    # (collection files) or 'thread_id' (topic files)
+    csv.field_size_limit( sys.maxsize )
+    with open( file_name, newline='', encoding='utf-8' ) as in_file:
+        reader = csv.reader( in_file, delimiter='\t' )
+        header = next( reader )
+        post_column = header.index( 'post_id' ) if 'post_id' in header else header.index( 'thread_id' )
+        topic_column = header.index( 'topic_id' ) if 'topic_id' in header else None
+        type_column = header.index( 'type' ) if 'type' in header else None
+        for row in reader:
+            if len( row ) < len( header ):
+                continue
+            yield ( row[0], row[ post_column ],
+                    row[ topic_column ] if topic_column is not None else '',
+                    row[ type_column ] if type_column is not None else '',
+                    row[-1] )
+
+def read_topic_formulas( file_name, types=( 'title', 'body' ) ):
+    # { topic id: [ MathML, ... ] } for the given formula types (e.g., 'title')
+    topic_formulas = {}
+    for ( _, _, topic, formula_type, mathml ) in read_formula_tsv( file_name ):
+        if formula_type in types:
+            topic_formulas.setdefault( topic, [] ).append( mathml )
+    return topic_formulas
+
+################################################################
+# Building the index
+################################################################
+def build_formula_index( tsv_files, index_dir, window=PAIR_WINDOW ):
+    # Postings are collected as ( tuple id, formula number, count ) arrays, then
+    # sorted by tuple id into CSR form ( offsets into formulas/counts )
+    vocabulary = {}
+    formula_ids = []
+    post_ids = {}
+    ( tuple_ids, formula_numbers, counts ) = ( array( 'i' ), array( 'i' ), array( 'H' ) )
+    ( lengths, posts ) = ( array( 'i' ), array( 'i' ) )
+    # Posts with question formulas (title or body), and whether formula types are given
+    question_posts = set()
+    typed = False
+    skipped = 0
+
+    for tsv_file in tsv_files:
+        print("Reading formulas from " + tsv_file + "...")
+        for ( formula_id, post_id, _, formula_type, mathml ) in tqdm( read_formula_tsv( tsv_file ) ):
+            tuples = mathml_tuples( mathml, window )
+            if not tuples:
+                skipped += 1
+                continue
+
+            number = len( formula_ids )
+            formula_ids.append( formula_id )
+            posts.append( post_ids.setdefault( post_id, len( post_ids ) ) )
+            typed = typed or formula_type != ''
+            if formula_type in ( 'title', 'question' ):
+                question_posts.add( posts[-1] )
+            lengths.append( sum( tuples.values() ) )
+            for ( key, count ) in tuples.items():
+                tuple_ids.append( vocabulary.setdefault( key, len( vocabulary ) ) )
+                formula_numbers.append( number )
+                counts.append( min( count, 65535 ) )
+
+    tuple_ids = np.frombuffer( tuple_ids, dtype=np.int32 )
+    order = np.argsort( tuple_ids, kind='stable' )
+    offsets = np.concatenate( ( [ 0 ], np.cumsum( np.bincount( tuple_ids, minlength=len( vocabulary ) ) ) ) )
+
+    os.makedirs( index_dir, exist_ok=True )
+    arrays = {
+        'offsets': offsets.astype( np.int64 ),
+        'formulas': np.frombuffer( formula_numbers, dtype=np.int32 )[ order ],
+        'counts': np.frombuffer( counts, dtype=np.uint16 )[ order ],
+        'lengths': np.frombuffer( lengths, dtype=np.int32 ),
+        'posts': np.frombuffer( posts, dtype=np.int32 ),
+    }
+    for ( name, values ) in arrays.items():
+        np.save( os.path.join( index_dir, name + '.npy' ), values )
+
+    answers_path = os.path.join( index_dir, ANSWER_BITMAP_FILE )
+    if os.path.exists( answers_path ):
+        os.remove( answers_path )
+    if typed:
+        # Same format as answer bitmaps for Terrier indices (index_arqmath.write_answer_bitmap)
+        answers = np.ones( len( post_ids ), dtype=bool )
+        answers[ list( question_posts ) ] = False
+        np.savez( answers_path, bits=np.packbits( answers ), count=len( post_ids ) )
+
+    write_lines( os.path.join( index_dir, 'tuples.txt' ), vocabulary )
+    write_lines( os.path.join( index_dir, 'formula_ids.txt' ), formula_ids )
+    write_lines( os.path.join( index_dir, 'post_ids.txt' ), post_ids )
+    with open( os.path.join( index_dir, INDEX_HEADER ), 'w' ) as header_file:
+        json.dump( { 'window': window, 'formulas': len( formula_ids ), 'posts': len( post_ids ),
+            'tuples': len( vocabulary ), 'postings': len( order ), 'skipped': skipped }, header_file )
+
+    print("  " + str( len( formula_ids ) ) + " formulas (" + str( skipped ) + " skipped), " +
+            str( len( vocabulary ) ) + " tuples, " + str( len( order ) ) + " postings")
+    return index_dir
+
+def write_lines( file_name, strings ):
+    # One string per line (tuples contain tabs, but no newlines)
+    with open( file_name, 'w', encoding='utf-8' ) as out_file:
+        for string in strings:
+            out_file.write( string.replace( '\n', ' ' ) + '\n' )
+
+def read_lines( file_name ):
+    with open( file_name, encoding='utf-8' ) as in_file:
+        return in_file.read().split( '\n' )[ :-1 ]
+
+################################################################
+# Retrieval
+################################################################
+def formula_answer_bitmap( index_dir ):
+    # Answer bitmap over post numbers (None for indices built from TSVs without formula types)
+    answers_path = os.path.join( index_dir, ANSWER_BITMAP_FILE )
+    if not os.path.exists( answers_path ):
+        return None
+    with np.load( answers_path ) as bitmap:
+        return np.unpackbits( bitmap['bits'], count=int( bitmap['count'] ) ).astype( bool )
+
+class FormulaIndex:
+    def __init__( self, index_dir ):
+        with open( os.path.join( index_dir, INDEX_HEADER ) ) as header_file:
+            self.header = json.load( header_file )
+        self.window = self.header[ 'window' ]
+        for name in INDEX_ARRAYS:
+            setattr( self, name, np.load( os.path.join( index_dir, name + '.npy' ), mmap_mode='r' ) )
+        self.vocabulary = { key: i for ( i, key ) in enumerate( read_lines( os.path.join( index_dir, 'tuples.txt' ) ) ) }
+        self.formula_ids = np.array( read_lines( os.path.join( index_dir, 'formula_ids.txt' ) ), dtype=object )
+        self.post_ids = np.array( read_lines( os.path.join( index_dir, 'post_ids.txt' ) ), dtype=object )
+
+    def score_formula( self, mathml ):
+        # ( formula numbers, Dice scores ) for formulas sharing a tuple with the query
+        tuples = mathml_tuples( mathml, self.window )
+        matched_parts = []
+        for ( key, query_count ) in tuples.items():
+            tuple_id = self.vocabulary.get( key )
+            if tuple_id is not None:
+                ( start, end ) = ( self.offsets[ tuple_id ], self.offsets[ tuple_id + 1 ] )
+                matched_parts.append( ( self.formulas[ start:end ],
+                    np.minimum( self.counts[ start:end ], query_count ) ) )
+        if not matched_parts:
+            return ( np.zeros( 0, dtype=np.int32 ), np.zeros( 0 ) )
+
+        formulas = np.concatenate( [ formulas for ( formulas, _ ) in matched_parts ] )
+        matches = np.concatenate( [ matched for ( _, matched ) in matched_parts ] ).astype( np.float64 )
+        ( candidates, inverse ) = np.unique( formulas, return_inverse=True )
+        matched = np.bincount( inverse, weights=matches )
+        query_length = sum( tuples.values() )
+        return ( candidates, 2 * matched / ( query_length + self.lengths[ candidates ] ) )
+
+    def search( self, mathml_list, k=1000 ):
+        # Posts ranked by the sum, over query formulas, of their best formula score.
+        # Returns a frame ( docid (post number), docno (post id), formulano, score ), best first.
+        post_scores = []
+        for mathml in mathml_list:
+            ( candidates, scores ) = self.score_formula( mathml )
+            if len( candidates ):
+                post_scores.append( pd.DataFrame( { 'post': self.posts[ candidates ],
+                    'formula': candidates, 'score': scores } ) )
+        if not post_scores:
+            return pd.DataFrame( columns=[ 'docid', 'docno', 'formulano', 'score' ] )
+
+        hits = pd.concat( post_scores, ignore_index=True )
+        best_formula = hits.sort_values( 'score', ascending=False, kind='stable' ) \
+                .drop_duplicates( 'post' ).set_index( 'post' )[ 'formula' ]
+        per_query = [ frame.groupby( 'post' )[ 'score' ].max() for frame in post_scores ]
+        totals = pd.concat( per_query, axis=1 ).fillna( 0 ).sum( axis=1 ).nlargest( k )
+
+        return pd.DataFrame( {
+            'docid': totals.index.to_numpy(),
+            'docno': self.post_ids[ totals.index.to_numpy() ],
+            'formulano': self.formula_ids[ best_formula.loc[ totals.index ].to_numpy() ],
+            'score': totals.to_numpy() } )
+
+class FormulaRetriever( pt.Transformer ):
+    # Query formulas (Presentation MathML) come from an 'slt' column (a string or list
+    # of strings), or from topic_formulas ( { qid: [ MathML, ... ] } ) by qid
+    def __init__( self, index_dir, topic_formulas=None, k=1000 ):
+        super().__init__()
+        self.index = FormulaIndex( index_dir )
+        self.topic_formulas = topic_formulas or {}
+        self.k = k
+
+    def query_formulas( self, row ):
+        if 'slt' in row and isinstance( row[ 'slt' ], ( str, list ) ):
+            return [ row[ 'slt' ] ] if isinstance( row[ 'slt' ], str ) else row[ 'slt' ]
+        return self.topic_formulas.get( row[ 'qid' ], [] )
+
+    def transform( self, queries ):
+        frames = []
+        for ( _, row ) in queries.iterrows():
+            hits = self.index.search( self.query_formulas( row ), self.k )
+            query_columns = [ column for column in queries.columns if column != 'slt' and column not in hits.columns ]
+            hits = hits.assign( **{ column: row[ column ] for column in query_columns } )
+            hits[ 'rank' ] = np.arange( len( hits ) )
+            frames.append( hits[ query_columns + [ 'docid', 'docno', 'formulano', 'score', 'rank' ] ] )
+
+        if not frames:
+            return pd.DataFrame( columns=[ 'qid', 'query', 'docid', 'docno', 'formulano', 'score', 'rank' ] )
+        return pd.concat( frames, ignore_index=True )
+
+def formula_engine( index_dir, topic_formula_file=None, k=1000, types=( 'title', 'body' ) ):
+    # Structural formula search for topics, e.g.,
+    #   formula_engine( './formula-index', 'ARQMath_Evaluation/.../2020_formulas_slt.tsv' )
+    # With an answer bitmap, extra hits are retrieved and questions removed (as for answer_engine)
+    topic_formulas = read_topic_formulas( topic_formula_file, types ) if topic_formula_file else None
+    bitmap = formula_answer_bitmap( index_dir )
+    if bitmap is None:
+        return FormulaRetriever( index_dir, topic_formulas, k )
+
+    return FormulaRetriever( index_dir, topic_formulas, ANSWER_FETCH_FACTOR * k ) >> answers_only( index_dir, k, bitmap )
+
+################################################################
+# Main program
+################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Build a structural (SLT symbol pair) formula index from ARQMath formula TSV files.")
+    parser.add_argument('indexDir', help='output index directory')
+    parser.add_argument('tsvFiles', nargs='+', help='formula TSV files with Presentation MathML (e.g., slt_representation, *_formulas_slt.tsv)')
+    parser.add_argument('-w', '--window', type=int, default=PAIR_WINDOW, help='maximum edges between symbols in a pair (default: ' + str( PAIR_WINDOW ) + ')')
+    args = parser.parse_args()
+
+    build_formula_index( args.tsvFiles, args.indexDir, args.window )
+
+if __name__ == "__main__":
+    main()
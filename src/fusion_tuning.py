@@ -0,0 +1,184 @@
+################################################################
+# fusion_tuning.py
+#
+# Grid search for math/post linear interpolation weights, i.e.,
+#   score = w * math_score + (1 - w) * post_score
+# The two BM25 runs are aligned once on ( qid, docno ), and for each
+# topic, all weights in the grid are scored together using NumPy
+# matrix operations (no PyTerrier pipelines are built or run).
+#
+# For each weight, fused results are ranked per topic, cut to the
+# top-k, filtered to assessed hits (prime metrics), and evaluated
+# with nDCG' and MAP' (relevance >= REL_THRESHOLD), following
+# trec_eval conventions (ties broken by descending docno).
+#
+# Score normalizations (per topic and engine, before fusion):
+#   none    raw scores (missing hits score 0, as for PyTerrier '+')
+#   minmax  ( s - min ) / ( max - min )  (missing hits score 0)
+#   zscore  ( s - mean ) / std           (missing hits get the topic minimum)
+################################################################
+
+import time
+import numpy as np
+import pandas as pd
+
+from arqmath_eval import REL_THRESHOLD
+
+NORMALIZATIONS = [ 'none', 'minmax', 'zscore' ]
+
+################################################################
+# Aligning runs
+################################################################
+def align_runs( math_run, post_run ):
+    # Outer join of two result frames on ( qid, docno ); returns a frame sorted by
+    # qid, then descending docno, with 'math' and 'post' score columns (NaN if missing)
+    math_scores = math_run[ [ 'qid', 'docno', 'score' ] ].drop_duplicates( [ 'qid', 'docno' ] )
+    post_scores = post_run[ [ 'qid', 'docno', 'score' ] ].drop_duplicates( [ 'qid', 'docno' ] )
+    aligned = math_scores.merge( post_scores, on=[ 'qid', 'docno' ], how='outer', suffixes=( '_math', '_post' ) )
+    aligned = aligned.rename( columns={ 'score_math': 'math', 'score_post': 'post' } )
+
+    return aligned.sort_values( [ 'qid', 'docno' ], ascending=[ True, False ] ).reset_index( drop=True )
+
+def group_stat( values, groups, num_groups, reduce ):
+    # Per-group reduction ( 'min', 'max', 'mean', 'std' ) ignoring NaN,
+    # broadcast back to rows
+    present = ~np.isnan( values )
+    if reduce == 'min':
+        out = np.full( num_groups, np.inf )
+        np.minimum.at( out, groups[ present ], values[ present ] )
+    elif reduce == 'max':
+        out = np.full( num_groups, -np.inf )
+        np.maximum.at( out, groups[ present ], values[ present ] )
+    else:
+        counts = np.maximum( np.bincount( groups[ present ], minlength=num_groups ), 1 )
+        means = np.bincount( groups[ present ], weights=values[ present ], minlength=num_groups ) / counts
+        if reduce == 'mean':
+            out = means
+        else:
+            sq_dev = ( values[ present ] - means[ groups[ present ] ] ) ** 2
+            out = np.sqrt( np.bincount( groups[ present ], weights=sq_dev, minlength=num_groups ) / counts )
+
+    return out[ groups ]
+
+def normalize_scores( scores, groups, num_groups, norm ):
+    # Normalize one engine's scores per topic; fill missing hits
+    if norm == 'none':
+        return np.nan_to_num( scores, nan=0.0 )
+
+    if norm == 'minmax':
+        low = group_stat( scores, groups, num_groups, 'min' )
+        span = group_stat( scores, groups, num_groups, 'max' ) - low
+        normalized = ( scores - low ) / np.where( span > 0, span, 1.0 )
+        return np.nan_to_num( normalized, nan=0.0 )
+
+    if norm == 'zscore':
+        spread = group_stat( scores, groups, num_groups, 'std' )
+        normalized = ( scores - group_stat( scores, groups, num_groups, 'mean' ) ) / np.where( spread > 0, spread, 1.0 )
+        floor = group_stat( normalized, groups, num_groups, 'min' )
+        return np.where( np.isnan( normalized ), np.where( np.isfinite( floor ), floor, 0.0 ), normalized )
+
+    raise ValueError("Unknown score normalization: " + norm )
+
+def normalize_run( run, norm ):
+    # Result frame with scores normalized per topic (as for tune_weights), e.g., before
+    # fusing runs with PyTerrier '+'; the order of hits within a topic is unchanged
+    ( qid_codes, qids ) = pd.factorize( run[ 'qid' ] )
+    return run.assign( score=normalize_scores( run[ 'score' ].to_numpy( dtype=float ), qid_codes, len( qids ), norm ) )
+
+################################################################
+# Scoring a weight grid
+################################################################
+def ideal_dcg( qrels_df, qids ):
+    # IDCG for each qid (all assessed documents, by decreasing label)
+    idcg = np.zeros( len( qids ) )
+    positions = { qid: i for ( i, qid ) in enumerate( qids ) }
+    for ( qid, labels ) in qrels_df.groupby( 'qid' )[ 'label' ]:
+        if qid in positions:
+            gains = np.sort( np.maximum( labels.to_numpy( dtype=float ), 0 ) )[ ::-1 ]
+            idcg[ positions[ qid ] ] = np.sum( gains / np.log2( np.arange( len( gains ) ) + 2 ) )
+    return idcg
+
+def score_topic( fused, labels, num_relevant, idcg, top_k, prime ):
+    # fused: ( hits x weights ) scores for one topic, hits in descending docno order
+    # (ties keep that order). Returns ( nDCG, AP ) arrays with one value per weight.
+    order = np.argsort( -fused, axis=0, kind='stable' )
+    ranked_labels = labels[ order ]
+
+    kept = ( np.arange( len( labels ) ) < top_k )[ :, None ]
+    if prime:
+        kept = kept & ~np.isnan( ranked_labels )
+
+    # Position of each kept hit among the kept hits (0-based)
+    position = np.cumsum( kept, axis=0 ) - kept
+    gains = np.where( kept, np.nan_to_num( np.maximum( ranked_labels, 0 ), nan=0.0 ), 0.0 )
+    dcg = np.sum( gains / np.log2( position + 2 ), axis=0 )
+
+    relevant = kept & ( np.nan_to_num( ranked_labels, nan=-1 ) >= REL_THRESHOLD )
+    precisions = np.where( relevant, np.cumsum( relevant, axis=0 ) / ( position + 1 ), 0.0 )
+    ap = np.sum( precisions, axis=0 ) / max( num_relevant, 1 )
+
+    return ( dcg / ( idcg if idcg > 0 else 1.0 ), ap )
+
+def tune_weights( math_run, post_run, qrels_df, top_k=1000, prime=True, norms=NORMALIZATIONS, step=0.01 ):
+    # Score math weights 0, step, ..., 1 (post weight = 1 - math weight) for each
+    # normalization; returns a frame with one row per ( norm, weight )
+    aligned = align_runs( math_run, post_run )
+    ( qid_codes, qids ) = pd.factorize( aligned[ 'qid' ] )
+    num_groups = len( qids )
+    bounds = np.concatenate( ( [ 0 ], np.cumsum( np.bincount( qid_codes, minlength=num_groups ) ) ) )
+
+    # Labels from qrels (NaN for unassessed), relevant counts and IDCG per topic
+    labels = aligned.merge( qrels_df[ [ 'qid', 'docno', 'label' ] ].drop_duplicates( [ 'qid', 'docno' ] ),
+            on=[ 'qid', 'docno' ], how='left' )[ 'label' ].to_numpy( dtype=float )
+    relevant_qrels = qrels_df[ qrels_df[ 'label' ] >= REL_THRESHOLD ]
+    num_relevant = relevant_qrels.groupby( 'qid' ).size().reindex( qids, fill_value=0 ).to_numpy()
+    idcg = ideal_dcg( qrels_df, qids )
+    # Mean over topics with qrels (as for pt.Experiment)
+    assessed_topics = np.flatnonzero( np.isin( qids, qrels_df[ 'qid' ].unique() ) )
+
+    weights = np.round( np.arange( 0, 1 + step / 2, step ), 6 )
+    weight_matrix = np.vstack( ( weights, 1 - weights ) )
+    rows = []
+    for norm in norms:
+        scores = np.column_stack( (
+            normalize_scores( aligned[ 'math' ].to_numpy( dtype=float ), qid_codes, num_groups, norm ),
+            normalize_scores( aligned[ 'post' ].to_numpy( dtype=float ), qid_codes, num_groups, norm ) ) )
+
+        ndcg = np.zeros( ( len( assessed_topics ), len( weights ) ) )
+        ap = np.zeros( ( len( assessed_topics ), len( weights ) ) )
+        for ( i, topic ) in enumerate( assessed_topics ):
+            ( start, end ) = ( bounds[ topic ], bounds[ topic + 1 ] )
+            ( ndcg[ i ], ap[ i ] ) = score_topic( scores[ start:end ] @ weight_matrix, labels[ start:end ],
+                    num_relevant[ topic ], idcg[ topic ], top_k, prime )
+
+        rows.extend( zip( [ norm ] * len( weights ), weights, np.round( 1 - weights, 6 ),
+            ndcg.mean( axis=0 ), ap.mean( axis=0 ) ) )
+
+    prime_string = "'" if prime else ''
+    return pd.DataFrame( rows, columns=[ 'norm', 'math_weight', 'post_weight', 'nDCG' + prime_string, 'MAP' + prime_string ] )
+
+def best_weights( results, metric ):
+    # Best row for each normalization by the given metric column
+    best = results.loc[ results.groupby( 'norm', sort=False )[ metric ].idxmax() ]
+    return best.sort_values( metric, ascending=False ).reset_index( drop=True )
+
+def report_tuning( results, seconds, prime=True ):
+    prime_string = "'" if prime else ''
+    print("[[ Math/post weight tuning ]]")
+    print(" * Weights scored: " + str( len( results ) ) + " in " + '{:.2f}'.format( seconds ) + "s")
+    for metric in [ 'nDCG' + prime_string, 'MAP' + prime_string ]:
+        print("\nBest weights by " + metric )
+        print("----------------------------------------------------------")
+        print( best_weights( results, metric ) )
+    print()
+
+def run_tuning( math_engine, post_engine, query_df, qrels_df, top_k=1000, prime=True, step=0.01 ):
+    # Retrieve both runs once, then score the weight grid; returns the results frame
+    math_run = math_engine.transform( query_df )
+    post_run = post_engine.transform( query_df )
+
+    start = time.time()
+    results = tune_weights( math_run, post_run, qrels_df, top_k, prime, step=step )
+    report_tuning( results, time.time() - start, prime )
+
+    return results
@@ -9,14 +9,25 @@
 
 import pyterrier as pt
 import pandas as pd
+import numpy as np
 from bs4 import BeautifulSoup as bsoup
+from lxml import etree
 import html
-import os, glob
+import os, glob, re
 import argparse
 from tqdm import tqdm
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import queue, threading
+import shutil
+import json
+import hashlib, pickle
 
 from math_recoding import *
 from utils import *
+from doc_store import DocStore, DocStoreWriter, has_doc_store, COMPRESSION_TYPES
 
 # Constants for indexing
 # **Warning: tag names converted to lower case by default in BSoup (e.g., <P> -> <p>)
@@ -30,8 +41,32 @@ MATH_RETRIEVAL_FIELDS = [ 'text', 'parentno' ]
 MATH_META_FIELDS = [ 'postno', 'text', 'origtext','docno','parentno']   # changed 'mathno' to 'postno'
 MATH_META_SIZES = [ 20, 1024, 1024, 20, 20]
 
+# External document store (--docstore): fields kept outside the meta index, and the
+# field used to look them up (formula id for the math index)
+STORE_FIELDS = [ 'text', 'origtext' ]
+DOC_STORE_DIR = 'docstore'
+TEXT_STORE_KEY = 'docno'
+MATH_STORE_KEY = 'postno'
+
+# Distinct formulas (--dedup): each distinct tokenized formula is indexed once, as a
+# formula group; occurrences ( group, formula id, post id, parentno ) are in a side table
+FORMULA_GROUPS_FILE = 'formula_groups.tsv'
+FORMULA_GROUP_COLUMNS = [ 'groupno', 'postno', 'docno', 'parentno' ]
+
+# Answer-only retrieval: bitmap over docids marking answer posts (and formulas in answers),
+# written to each index directory; hits retrieved per answer hit kept (see answer_engine)
+ANSWER_BITMAP_FILE = 'answers.npz'
+ANSWER_FETCH_FACTOR = 3
+
 EMPTY_DOCS = 0
 
+# Parallel document preparation (--workers): rows per task, and tasks queued per worker
+ROW_CHUNK_SIZE = 256
+QUEUE_CHUNKS_PER_WORKER = 4
+
+# Single-pass post + math indexing (-mp): document lists queued per indexer
+INDEXER_QUEUE_SIZE = 1024
+
 ################################################################
 # Index creation and properties
 ################################################################
@@ -67,111 +102,548 @@ def print_post_record( docno, title_text, modified_post_text, indexed_body,
         '\nTEXT (SEARCHABLE):',indexed_body,'\nTAGS: ',tag_text,'\nMATHNOS:',all_formula_ids,
         '\nPARENTNO:',parentno,'\nVOTES:',votes)
 
-def generate_XML_post_docs(file_name_list, formula_index=False, debug_out=False ):
-    global EMPTY_DOCS
+def read_XML_rows( file_name, segments=None ):
+    # Stream <row> elements one at a time (incremental parse), rather than
+    # building a tree for the whole file. Attribute names are lower-cased to
+    # match the keys BeautifulSoup produced (e.g., 'PostTypeId' -> 'posttypeid').
+    # Each row is cleared after use, along with preceding siblings, so that
+    # memory use does not grow with the size of the file.
+    # With segments (see split_XML_rows), only those byte ranges of the file are parsed.
+    source = XMLSegmentReader( file_name, segments ) if segments is not None else file_name
+    try:
+        for ( _, row ) in etree.iterparse( source, events=('end',), tag='row',
+                huge_tree=True, recover=True ):
+            yield { key.lower(): value for ( key, value ) in row.attrib.items() }
+
+            row.clear()
+            while row.getprevious() is not None:
+                del row.getparent()[0]
+    finally:
+        if segments is not None:
+            source.close()
+
+################################################################
+# Row ranges (for shards)
+################################################################
+# Shards of one XML file each parse a contiguous range of its rows. Row start
+# offsets are found by scanning the raw bytes once (no XML parsing): '<' cannot
+# occur unescaped in attribute values, so '<row' only starts a row element. A
+# shard reads the file prolog (XML declaration and root start tag), its own rows,
+# and the root end tag, which together form a well-formed document.
+ROW_START = re.compile( rb'<row[\s/>]' )
+ROOT_END = b'</'
+SCAN_BLOCK_SIZE = 1 << 20
+
+def XML_row_offsets( file_name ):
+    # Returns ( offsets, root_end, file_size ): byte offsets of each <row> element, and
+    # of the root end tag (the last end tag in the file)
+    offsets = []
+    root_end = 0
+    base = 0  # file offset of data[0]
+    tail = b''
+    with open( file_name, 'rb' ) as in_file:
+        for block in iter( lambda: in_file.read( SCAN_BLOCK_SIZE ), b'' ):
+            data = tail + block
+            offsets.extend( base + match.start() for match in ROW_START.finditer( data ) )
+            end_tag = data.rfind( ROOT_END )
+            if end_tag >= 0:
+                root_end = base + end_tag
+
+            # Keep the last few bytes, for a '<row' or '</' split between blocks (too short to
+            # hold a whole match, so no match is found twice)
+            tail = data[ -4: ]
+            base += len( data ) - len( tail )
+
+    return ( np.array( offsets, dtype=np.int64 ), root_end, base + len( tail ) )
+
+def split_XML_rows( file_name, parts ):
+    # Split the rows of an XML file into parts contiguous ranges of (nearly) equal size.
+    # Returns [ ( segments, ( first_row, end_row ) ) ], one per part, where segments are the
+    # ( start, end ) byte ranges read for the part (prolog, rows, root end tag).
+    ( offsets, root_end, file_size ) = XML_row_offsets( file_name )
+    if len( offsets ) == 0:
+        return [ ( [], ( 0, 0 ) ) ] * parts
+
+    starts = np.append( offsets, max( root_end, offsets[-1] ) )
+    bounds = [ len( offsets ) * part // parts for part in range( parts + 1 ) ]
+    return [ ( [ ( 0, int( offsets[0] ) ), ( int( starts[ first ] ), int( starts[ end ] ) ), ( int( starts[-1] ), file_size ) ],
+            ( first, end ) ) for ( first, end ) in zip( bounds[:-1], bounds[1:] ) ]
+
+class XMLSegmentReader:
+    # File-like reader over byte ranges of a file, read in order (for etree.iterparse)
+    def __init__( self, file_name, segments ):
+        self.file = open( file_name, 'rb' )
+        self.segments = deque( segments )
+
+    def read( self, size=-1 ):
+        while self.segments:
+            ( start, end ) = self.segments[0]
+            if start >= end:
+                self.segments.popleft()
+                continue
+
+            self.file.seek( start )
+            data = self.file.read( end - start if size < 0 else min( size, end - start ) )
+            self.segments[0] = ( start + len( data ), end )
+            return data
+        return b''
+
+    def close( self ):
+        self.file.close()
+
+def convert_post_row( row, posts=True, formulas=False, debug_out=False ):
+    # Convert one <row> (attribute dict) to post and/or formula index documents.
+    # Returns ( post_docs, formula_docs, empty_posts, empty_formulas ), where the empty
+    # counts are posts/formulas skipped because they are empty before tokenization.
+    # Top-level function (no shared state) so that it can run in worker processes.
+    post_docs = []
+    formula_docs = []
+    empty_posts = 0
+    empty_formulas = 0
+
+    # Parse post body and title content as HTML & get formulas
+    # Document number in collection, user votes
+    docno = row['id'] 
+    votes = row['score']
+
+    # Parent post for answers ('qpost' for questions)
+    parentno = 'qpost'
+    if row[ 'posttypeid' ] == '2':  
+        parentno = row['parentid'] 
+
+    # Title formulas - apply soup to recover HTML structure from attribute field value
+    title_soup = bsoup( html.unescape( row.get('title','') ), 'lxml' )
+    remove_tags( title_soup, TAGS_TO_REMOVE )
+    ( title_formulas, title_formula_ids ) = rewrite_math_tags( title_soup )
+
+    # Body formulas and simplification - again, apply soup to construct Tag tree w. bsoup
+    body_soup = bsoup( html.unescape( row.get('body','') ), 'lxml' )
+    remove_tags( body_soup, TAGS_TO_REMOVE )
+    ( body_formulas, formula_ids )= rewrite_math_tags( body_soup )
+
+    # Remove tags that we do not want to search.
+
+    # Combine title and body formulas
+    all_formulas = title_formulas + body_formulas
+    all_formula_ids = title_formula_ids + formula_ids
 
+    if formulas:
+        ## Formula index entries   
+        #  One output per formula
+        for math_tag in all_formulas:
+            raw_text = math_tag.get_text()
+            tokenized_formula = translate_latex( math_tag.get_text() )
+
+            # Skip empty formulas
+            if tokenized_formula.isspace():
+                empty_formulas += 1
+                if debug_out:
+                    if raw_text.isspace():
+                        print('!!! WARNING: Empty "text" field for retrieval, formula id: ' + math_tag['id'] )
+                    else:
+                        print('!!! WARNING: Non-empty formula tokenized into empty string, formula id: ' + math_tag['id'])
+                    ##print_formula_record(math_tag, tokenized_formula, docno, parentno )
+                continue
+            
+            elif debug_out:
+                print_formula_record( math_tag, tokenized_formula, docno, parentno )
+
+            formula_docs.append( { 'postno':     math_tag['id'],  # changed mathno to postno
+                    'text':      tokenized_formula,
+                    'origtext':  math_tag.get_text(),
+                    'docno':    docno,
+                    'parentno' : parentno
+                } )
+
+    if posts:
+        ## Post text index entries ##
+        # Remove formula ids from title and body
+        #for math_tag in all_formulas:
+        #    del math_tag['id']
+
+        # Generate strings for title, post body, and tags
+        title_text = str( title_soup )
+        modified_post_text = str( body_soup )
+        indexed_body = translate_latex( modified_post_text )
+        tag_text = row.get('tags', '').replace('<','').replace('>',', ').replace('-',' ')
+
+        # Skip posts with empty content
+        if indexed_body.isspace():
+            empty_posts += 1
+            if debug_out:
+                print('!!! WARNING: Empty "text" field for retrieval, post id: ' + docno ) 
+                #print_post_record( docno, title_text, modified_post_text, indexed_body, 
+                #    tag_text, all_formula_ids, parentno, votes)
+            return ( post_docs, formula_docs, empty_posts, empty_formulas )
+
+        elif debug_out:
+            print_post_record( docno, title_text, modified_post_text, indexed_body, 
+                tag_text, all_formula_ids, parentno, votes)
+
+        # Note: the formula ids are stored in a string currently.
+        # Concatenate post and tag text
+        # NOTE: representation for search is tokenized differently than meta/document index version for viewing hits
+        post_docs.append( { 'docno' :   docno,
+                'title' :   title_text,
+                'text' :    indexed_body,
+                'origtext': modified_post_text,
+                'tags' :    tag_text,
+                'mathnos' : all_formula_ids,
+                'parentno': parentno,
+                'votes' :   votes
+            } )
+
+    return ( post_docs, formula_docs, empty_posts, empty_formulas )
+
+def convert_row_chunk( rows, posts=True, formulas=False, debug_out=False ):
+    # Convert a list of rows in a worker process.
+    # Returns a list of ( row_id, post_docs, formula_docs, empty_posts, empty_formulas )
+    return [ ( row['id'], ) + convert_post_row( row, posts, formulas, debug_out ) for row in rows ]
+
+def read_XML_collection( file_name_list, row_filter=None ):
+    # Rows from all files, in order. If given, row_filter( position, row ) selects
+    # the rows to keep (position counts rows across all files, from 0).
+    position = 0
     for file_name in file_name_list:
         print(">> Reading File: ", file_name )
-        with open(file_name) as xml_file:
-            soup = bsoup(xml_file, 'lxml')
-            rows = soup('row')
-
-            for row in tqdm( rows ):
-                # Parse post body and title content as HTML & get formulas
-                # Document number in collection, user votes
-                docno = row['id'] 
-                votes = row['score']
-
-                # Parent post for answers ('qpost' for questions)
-                parentno = 'qpost'
-                if row[ 'posttypeid' ] == '2':  
-                    parentno = row['parentid'] 
-
-                # Title formulas - apply soup to recover HTML structure from attribute field value
-                title_soup = bsoup( html.unescape( row.get('title','') ), 'lxml' )
-                remove_tags( title_soup, TAGS_TO_REMOVE )
-                ( title_formulas, title_formula_ids ) = rewrite_math_tags( title_soup )
-
-                # Body formulas and simplification - again, apply soup to construct Tag tree w. bsoup
-                body_soup = bsoup( html.unescape( row.get('body','') ), 'lxml' )
-                remove_tags( body_soup, TAGS_TO_REMOVE )
-                ( body_formulas, formula_ids )= rewrite_math_tags( body_soup )
-
-                # Remove tags that we do not want to search.
-        
-                # Combine title and body formulas
-                all_formulas = title_formulas + body_formulas
-                all_formula_ids = title_formula_ids + formula_ids
-
-                if formula_index:
-                    ## Formula index entries   
-                    #  One output per formula
-                    for math_tag in all_formulas:
-                        raw_text = math_tag.get_text()
-                        tokenized_formula = rewrite_symbols( math_tag.get_text(), latex_symbol_map )
-
-                        # Skip empty formulas
-                        if tokenized_formula.isspace():
-                            EMPTY_DOCS += 1
-                            if debug_out:
-                                if raw_text.isspace():
-                                    print('!!! WARNING: Empty "text" field for retrieval, formula id: ' + math_tag['id'] )
-                                else:
-                                    print('!!! WARNING: Non-empty formula tokenized into empty string, formula id: ' + math_tag['id'])
-                                ##print_formula_record(math_tag, tokenized_formula, docno, parentno )
-                            continue
-                        
-                        elif debug_out:
-                            print_formula_record( math_tag, tokenized_formula, docno, parentno )
-
-                        yield { 'postno':     math_tag['id'],  # changed mathno to postno
-                                'text':      tokenized_formula,
-                                'origtext':  math_tag.get_text(),
-                                'docno':    docno,
-                                'parentno' : parentno
-                            }
-                else:
-                    ## Post text index entries ##
-                    # Remove formula ids from title and body
-                    #for math_tag in all_formulas:
-                    #    del math_tag['id']
-
-                    # Generate strings for title, post body, and tags
-                    title_text = str( title_soup )
-                    modified_post_text = str( body_soup )
-                    indexed_body = translate_latex( modified_post_text )
-                    tag_text = row.get('tags', '').replace('<','').replace('>',', ').replace('-',' ')
-
-                    # Skip posts with empty content
-                    if indexed_body.isspace():
-                        EMPTY_DOCS += 1
-                        if debug_out:
-                            print('!!! WARNING: Empty "text" field for retrieval, post id: ' + docno ) 
-                            #print_post_record( docno, title_text, modified_post_text, indexed_body, 
-                            #    tag_text, all_formula_ids, parentno, votes)
-                        continue
-
-                    elif debug_out:
-                        print_post_record( docno, title_text, modified_post_text, indexed_body, 
-                            tag_text, all_formula_ids, parentno, votes)
-
-                    # Note: the formula ids are stored in a string currently.
-                    # Concatenate post and tag text
-                    # NOTE: representation for search is tokenized differently than meta/document index version for viewing hits
-                    yield { 'docno' :   docno,
-                            'title' :   title_text,
-                            'text' :    indexed_body,
-                            'origtext': modified_post_text,
-                            'tags' :    tag_text,
-                            'mathnos' : all_formula_ids,
-                            'parentno': parentno,
-                            'votes' :   votes
-                        }
-
-
-def create_XML_index( file_list, indexName, token_pipeline="Stopwords,PorterStemmer", formulas=False, debug=False):
+        for row in tqdm( read_XML_rows( file_name ) ):
+            if row_filter is None or row_filter( position, row ):
+                yield row
+            position += 1
+
+def chunk_rows( rows, chunk_size=ROW_CHUNK_SIZE ):
+    # Group rows into lists of (at most) chunk_size rows
+    chunk = []
+    for row in rows:
+        chunk.append( row )
+        if len( chunk ) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+def convert_XML_rows( rows, posts=True, formulas=False, debug_out=False, pool=None, workers=1 ):
+    # Yields ( row_id, post_docs, formula_docs, empty_posts, empty_formulas ) for each row
+    if pool is None:
+        for row in rows:
+            yield ( row['id'], ) + convert_post_row( row, posts, formulas, debug_out )
+        return
+
+    # Parallel document preparation: row chunks are converted in a process pool.
+    # Results are consumed in submission order (deterministic output), and at most
+    # QUEUE_CHUNKS_PER_WORKER chunks per worker are in flight, so that parsing does
+    # not run ahead of the indexer (bounded memory).
+    pending = deque()
+    max_pending = QUEUE_CHUNKS_PER_WORKER * workers
+    for chunk in chunk_rows( rows ):
+        pending.append( pool.submit( convert_row_chunk, chunk, posts, formulas, debug_out ) )
+        if len( pending ) >= max_pending:
+            yield from pending.popleft().result()
+
+    while pending:
+        yield from pending.popleft().result()
+
+def prepare_XML_rows( file_name_list, posts=True, formulas=False, debug_out=False, workers=1, row_filter=None,
+        cache_dir=None, row_ranges=None ):
+    # Yields ( row_id, post_docs, formula_docs, empty_posts, empty_formulas ) for selected rows, in file order.
+    # With row_ranges (one per file, from split_XML_rows), only that range of rows is read from each file.
+    # With cache_dir, files are read from the document cache when possible; otherwise a
+    # cache file is written for each file read in full (i.e., no row_filter or row_ranges).
+    # 'spawn' is used for worker processes because the JVM is already running in this process.
+    pool = None
+    if workers > 1:
+        pool = ProcessPoolExecutor( max_workers=workers, mp_context=get_context('spawn') )
+
+    try:
+        position = 0
+        for ( file_no, file_name ) in enumerate( file_name_list ):
+            ( segments, ( first_row, end_row ) ) = row_ranges[ file_no ] if row_ranges is not None else ( None, ( 0, None ) )
+            if first_row == end_row:
+                continue
+
+            cache_path = None
+            if cache_dir is not None:
+                cache_path = doc_cache_path( cache_dir, file_name )
+
+            # Cached documents for the file
+            if cache_path is not None and os.path.exists( cache_path ):
+                print(">> Reading cached documents for: ", file_name )
+                for result in tqdm( islice( read_doc_cache( cache_path ), first_row, end_row ) ):
+                    if row_filter is None or row_filter( position, { 'id': result[0] } ):
+                        yield result
+                    position += 1
+                continue
+
+            # Parse the file; when writing the cache, both document types are generated
+            print(">> Reading File: ", file_name )
+            write_cache = cache_path is not None and row_filter is None and row_ranges is None
+            def selected_rows():
+                nonlocal position
+                for row in tqdm( read_XML_rows( file_name, segments ) ):
+                    if row_filter is None or row_filter( position, row ):
+                        yield row
+                    position += 1
+
+            results = convert_XML_rows( selected_rows(), posts or write_cache, formulas or write_cache, 
+                    debug_out, pool, workers )
+            if write_cache:
+                results = write_doc_cache( cache_path, results )
+            yield from results
+    finally:
+        if pool is not None:
+            pool.shutdown( cancel_futures=True )
+
+def generate_XML_row_docs( file_name_list, posts=True, formulas=False, debug_out=False, workers=1, row_filter=None,
+        cache_dir=None, row_ids=None, row_ranges=None ):
+    # Yields ( post_docs, formula_docs ) lists for each row, in file order. If given, the id of
+    # every row read is appended to row_ids (including rows without documents, e.g., no formulas)
+    global EMPTY_DOCS
+
+    for ( row_id, post_docs, formula_docs, empty_posts, empty_formulas ) in prepare_XML_rows( file_name_list,
+            posts, formulas, debug_out, workers, row_filter, cache_dir, row_ranges ):
+        if row_ids is not None:
+            row_ids.append( row_id )
+        if posts:
+            EMPTY_DOCS += empty_posts
+        if formulas:
+            EMPTY_DOCS += empty_formulas
+
+        yield ( post_docs if posts else [], formula_docs if formulas else [] )
+
+def generate_XML_post_docs(file_name_list, formula_index=False, debug_out=False, workers=1, row_filter=None,
+        cache_dir=None, row_ids=None, row_ranges=None ):
+    for ( post_docs, formula_docs ) in generate_XML_row_docs( file_name_list, 
+            posts=not formula_index, formulas=formula_index, debug_out=debug_out, workers=workers,
+            row_filter=row_filter, cache_dir=cache_dir, row_ids=row_ids, row_ranges=row_ranges ):
+        if formula_index:
+            yield from formula_docs
+        else:
+            yield from post_docs
+
+################################################################
+# Document cache
+################################################################
+# Prepared post and formula documents for each XML file, so that indexing runs 
+# (e.g., with different token pipelines or meta fields) can skip HTML parsing and 
+# LaTeX recoding. Cache files are named by a hash of the XML file contents and of 
+# the document preparation settings, and hold pickled lists of rows, with documents 
+# stored as tuples of values (keys below).
+POST_DOC_KEYS = ( 'docno', 'title', 'text', 'origtext', 'tags', 'mathnos', 'parentno', 'votes' )
+FORMULA_DOC_KEYS = ( 'postno', 'text', 'origtext', 'docno', 'parentno' )
+HASH_BLOCK_SIZE = 1 << 20
+
+def doc_cache_settings():
+    # Changes when document preparation changes (recoding version, LaTeX map, removed tags)
+    settings = repr( ( RECODING_VERSION, sorted( latex_symbol_map.items() ), TAGS_TO_REMOVE, 
+        POST_DOC_KEYS, FORMULA_DOC_KEYS ) )
+    return hashlib.sha1( settings.encode('utf-8') ).hexdigest()[:12]
+
+def file_hash( file_name ):
+    digest = hashlib.sha1()
+    with open( file_name, 'rb' ) as in_file:
+        for block in iter( lambda: in_file.read( HASH_BLOCK_SIZE ), b'' ):
+            digest.update( block )
+
+    return digest.hexdigest()
+
+def doc_cache_path( cache_dir, file_name ):
+    ( name, _ ) = os.path.splitext( os.path.basename( file_name ) )
+    return os.path.join( cache_dir, name + '-' + file_hash( file_name )[:16] + '-' + doc_cache_settings() + '.docs' )
+
+def read_doc_cache( cache_path ):
+    # Yields ( row_id, post_docs, formula_docs, empty_posts, empty_formulas ) for each cached row
+    with open( cache_path, 'rb' ) as cache_file:
+        while True:
+            try:
+                chunk = pickle.load( cache_file )
+            except EOFError:
+                return
+
+            for ( row_id, post_values, formula_values, empty_posts, empty_formulas ) in chunk:
+                yield ( row_id,
+                    [ dict( zip( POST_DOC_KEYS, values ) ) for values in post_values ],
+                    [ dict( zip( FORMULA_DOC_KEYS, values ) ) for values in formula_values ],
+                    empty_posts, empty_formulas )
+
+def write_doc_cache( cache_path, results ):
+    # Pass results through, while writing them to the cache. The cache file is only
+    # renamed into place once all rows have been written.
+    os.makedirs( os.path.dirname( cache_path ) or '.', exist_ok=True )
+    temp_path = cache_path + '.' + str( os.getpid() ) + '.tmp'
+    try:
+        with open( temp_path, 'wb' ) as cache_file:
+            for chunk in chunk_rows( results ):
+                pickle.dump( [ ( row_id,
+                        [ tuple( doc[ key ] for key in POST_DOC_KEYS ) for doc in post_docs ],
+                        [ tuple( doc[ key ] for key in FORMULA_DOC_KEYS ) for doc in formula_docs ],
+                        empty_posts, empty_formulas )
+                    for ( row_id, post_docs, formula_docs, empty_posts, empty_formulas ) in chunk ],
+                    cache_file, protocol=pickle.HIGHEST_PROTOCOL )
+                yield from chunk
+
+        os.replace( temp_path, cache_path )
+    finally:
+        if os.path.exists( temp_path ):
+            os.remove( temp_path )
+
+def queue_docs( doc_queue, failed ):
+    # Generator over documents placed in a queue (lists of documents, None at end).
+    # Stops with an error if the producer or the other indexer has failed.
+    while True:
+        try:
+            docs = doc_queue.get( timeout=1 )
+        except queue.Empty:
+            if failed.is_set():
+                raise RuntimeError("document producer stopped before sending all documents")
+            continue
+
+        if docs is None:
+            return
+        yield from docs
+
+def fan_out_XML_docs( file_name_list, post_queue, math_queue, failed, debug_out=False, workers=1, row_filter=None,
+        cache_dir=None, row_ids=None, row_ranges=None ):
+    # Producer for single-pass post + formula indexing: each row is parsed once, and
+    # its post and formula documents are sent to separate (bounded) indexer queues.
+    def put( doc_queue, item ):
+        # Give up if an indexer has stopped, rather than blocking on a full queue.
+        while not failed.is_set():
+            try:
+                doc_queue.put( item, timeout=1 )
+                return
+            except queue.Full:
+                pass
+        raise RuntimeError("indexer stopped before all documents were sent")
+
+    try:
+        for ( post_docs, formula_docs ) in generate_XML_row_docs( file_name_list, 
+                posts=True, formulas=True, debug_out=debug_out, workers=workers, row_filter=row_filter,
+                cache_dir=cache_dir, row_ids=row_ids, row_ranges=row_ranges ):
+            if post_docs:
+                put( post_queue, post_docs )
+            if formula_docs:
+                put( math_queue, formula_docs )
+    except BaseException:
+        failed.set()
+        raise
+    finally:
+        # End of documents for both indexers
+        for doc_queue in [ post_queue, math_queue ]:
+            try:
+                put( doc_queue, None )
+            except RuntimeError:
+                pass
+
+
+################################################################
+# Distinct formulas (--dedup)
+################################################################
+# Common formulas (e.g., x^2) occur hundreds of thousands of times. With --dedup, the
+# math index has one document per distinct tokenized formula (a 'group'), with the
+# group id in 'postno' and 'docno', and the first occurrence's 'origtext'. Each
+# occurrence is a row of FORMULA_GROUPS_FILE in the index directory; groups are
+# scored once, and hits are expanded to their occurrences by expand_formula_groups.
+def formula_group_key( formula_text ):
+    # Formulas with the same tokens (ignoring spacing) share a group
+    return ' '.join( formula_text.split() )
+
+def dedup_formula_docs( docs, groups_file ):
+    # Yields one formula document per group, writing every occurrence to groups_file
+    groups = {}
+    for doc in docs:
+        key = formula_group_key( doc['text'] )
+        group = groups.get( key )
+        if group is None:
+            group = str( len( groups ) )
+            groups[ key ] = group
+            yield { 'postno': group,
+                    'text': doc['text'],
+                    'origtext': doc['origtext'],
+                    'docno': group,
+                    'parentno': '' }
+        groups_file.write( '\t'.join( [ group, doc['postno'], doc['docno'], doc['parentno'] ] ) + '\n' )
+
+    print("  Distinct formulas: " + str( len( groups ) ) )
+
+def has_formula_groups( index_dir ):
+    return os.path.exists( os.path.join( index_dir, FORMULA_GROUPS_FILE ) )
+
+def read_formula_groups( index_dir ):
+    # Returns ( offsets, occurrences ): occurrences of group g are rows offsets[g]:offsets[g+1]
+    # of the occurrences frame ( FORMULA_GROUP_COLUMNS, in collection order within a group )
+    occurrences = pd.read_csv( os.path.join( index_dir, FORMULA_GROUPS_FILE ), sep='\t', header=None,
+            names=FORMULA_GROUP_COLUMNS, dtype=str, keep_default_na=False, quoting=3 )
+    group_ids = occurrences['groupno'].to_numpy( dtype=np.int64 )
+    order = np.argsort( group_ids, kind='stable' )
+    occurrences = occurrences.iloc[ order ].reset_index( drop=True )
+    offsets = np.concatenate( ( [ 0 ], np.cumsum( np.bincount( group_ids ) ) ) )
+
+    return ( offsets, occurrences )
+
+# Queries excluding questions with a '-qpost' term (also '_pnot qpost' after translate_query)
+QPOST_EXCLUSION = r'(?:^|\s)-\s*qpost(?:\s|$)'
+
+def expand_formula_groups( index_dir, k=None ):
+    # Transformer replacing each formula group hit by its occurrences ( formula id in 'postno',
+    # post id in 'docno', 'parentno', and the group id in 'groupno' ), with the group's score.
+    # Group documents have no 'parentno' of their own (a group may occur in questions and
+    # answers), so for queries with a '-qpost' term, only answer occurrences are returned.
+    # With k, at most k occurrences are returned per query (groups in rank order).
+    # Results are returned unchanged for indices built without --dedup.
+    if not has_formula_groups( index_dir ):
+        return pt.apply.generic( lambda result_df: result_df )
+    ( offsets, occurrences ) = read_formula_groups( index_dir )
+    answers = ( occurrences['parentno'] != 'qpost' ).to_numpy()
+    answer_occurrences = occurrences[ answers ].reset_index( drop=True )
+    group_ids = occurrences['groupno'].to_numpy( dtype=np.int64 )[ answers ]
+    answer_offsets = np.concatenate( ( [ 0 ], np.cumsum( np.bincount( group_ids, minlength=len( offsets ) - 1 ) ) ) )
+
+    def expand_hits( result_df, offsets, occurrences ):
+        group_ids = result_df['docno'].to_numpy( dtype=np.int64 )
+        sizes = offsets[ group_ids + 1 ] - offsets[ group_ids ]
+        if k is not None:
+            # Keep groups whose occurrences start within the first k for their query
+            before = pd.Series( sizes ).groupby( result_df['qid'].to_numpy(), sort=False ).cumsum().to_numpy() - sizes
+            keep = before < k
+            result_df = result_df[ keep ].reset_index( drop=True )
+            ( group_ids, sizes ) = ( group_ids[ keep ], sizes[ keep ] )
+
+        # Occurrence rows for each hit, in hit order
+        hit_rows = np.repeat( np.arange( len( result_df ) ), sizes )
+        occurrence_rows = np.repeat( offsets[ group_ids ] - np.r_[ 0, sizes.cumsum()[:-1] ], sizes ) + np.arange( sizes.sum() )
+        expanded = result_df.drop( columns=[ 'postno', 'docno', 'parentno' ], errors='ignore' ).iloc[ hit_rows ].reset_index( drop=True )
+        for column in FORMULA_GROUP_COLUMNS:
+            expanded[ column ] = occurrences[ column ].to_numpy()[ occurrence_rows ]
+        return expanded
+
+    def expand( result_df ):
+        if len( result_df ) == 0:
+            return result_df.assign( groupno=pd.Series( dtype=str ) )
+
+        result_df = result_df.sort_values( [ 'qid', 'rank' ], kind='stable' ).reset_index( drop=True )
+        if 'query' in result_df.columns:
+            answers_only = result_df['query'].astype( str ).str.contains( QPOST_EXCLUSION ).to_numpy()
+        else:
+            answers_only = np.zeros( len( result_df ), dtype=bool )
+
+        # Each query is expanded with all occurrences, or with answer occurrences only
+        parts = [ expand_hits( result_df[ ~answers_only ].reset_index( drop=True ), offsets, occurrences ),
+                expand_hits( result_df[ answers_only ].reset_index( drop=True ), answer_offsets, answer_occurrences ) ]
+        expanded = pd.concat( [ part for part in parts if len( part ) ] or parts[:1], ignore_index=True )
+        expanded = expanded.sort_values( [ 'qid' ], kind='stable' ).reset_index( drop=True )
+
+        expanded['rank'] = expanded.groupby( 'qid', sort=False ).cumcount()
+        if k is not None:
+            expanded = expanded[ expanded['rank'] < k ].reset_index( drop=True )
+        return expanded
+
+    return pt.apply.generic( expand )
+
+def XML_indexer( indexName, token_pipeline="Stopwords,PorterStemmer", formulas=False, docstore=None ):
     # Storing processed text AND original text in meta index, docs, to support neural reranking with keywords, and 
     # viewing original posts
+    # (with a doc store, the text fields are stored outside the meta index instead)
     ( meta_fields, meta_sizes ) = ( TEXT_META_FIELDS, TEXT_META_SIZES )
     field_names= TEXT_RETRIEVAL_FIELDS
 
@@ -179,6 +651,18 @@ def create_XML_index( file_list, indexName, token_pipeline="Stopwords,PorterStem
         ( meta_fields, meta_sizes ) = ( MATH_META_FIELDS, MATH_META_SIZES )
         field_names= MATH_RETRIEVAL_FIELDS
 
+    if docstore is not None:
+        ( meta_fields, meta_sizes ) = map( list, zip( *[ ( field, size ) 
+            for ( field, size ) in zip( meta_fields, meta_sizes ) if field not in STORE_FIELDS ] ) )
+
+    remove_index_manifest( indexName )
+    store_dir = os.path.join( indexName, DOC_STORE_DIR )
+    if os.path.isdir( store_dir ):
+        shutil.rmtree( store_dir )
+    for side_file in [ FORMULA_GROUPS_FILE, ANSWER_BITMAP_FILE, IDS_FILE ]:
+        if os.path.exists( os.path.join( indexName, side_file ) ):
+            os.remove( os.path.join( indexName, side_file ) )
+
     indexer = pt.IterDictIndexer( 
             indexName, 
             meta=meta_fields,
@@ -186,15 +670,473 @@ def create_XML_index( file_list, indexName, token_pipeline="Stopwords,PorterStem
             overwrite=True )
 
     indexer.setProperty( "termpipelines", token_pipeline )
-    index_ref = indexer.index( generate_XML_post_docs( file_list, formula_index=formulas, debug_out=debug ), fields=field_names )
-
+    return ( indexer, field_names )
+
+def index_XML_docs( docs, indexName, token_pipeline="Stopwords,PorterStemmer", formulas=False, docstore=None, dedup=False ):
+    # Index documents; with docstore (compression type), STORE_FIELDS are also written to
+    # the doc store in the index directory. With dedup (formulas only), one document is
+    # indexed per distinct formula (see dedup_formula_docs). An answer bitmap is written
+    # after indexing (see write_answer_bitmap). Returns the index reference.
+    ( indexer, field_names ) = XML_indexer( indexName, token_pipeline, formulas, docstore )
+    groups_file = None
+    if formulas and dedup:
+        os.makedirs( indexName, exist_ok=True )
+        groups_file = open( os.path.join( indexName, FORMULA_GROUPS_FILE ), 'w' )
+        docs = dedup_formula_docs( docs, groups_file )
+
+    try:
+        if docstore is None:
+            index_ref = indexer.index( docs, fields=field_names )
+        else:
+            key_field = MATH_STORE_KEY if formulas else TEXT_STORE_KEY
+            writers = [ DocStoreWriter( os.path.join( indexName, DOC_STORE_DIR ), field, docstore ) for field in STORE_FIELDS ]
+            def stored_docs():
+                for doc in docs:
+                    for writer in writers:
+                        writer.add( doc[ key_field ], doc[ writer.field ] )
+                    yield doc
+
+            try:
+                index_ref = indexer.index( stored_docs(), fields=field_names )
+            finally:
+                for writer in writers:
+                    writer.close()
+    finally:
+        if groups_file is not None:
+            groups_file.close()
+
+    # Formula groups are shared by questions and answers (filtered on 'parentno' after expansion)
+    if groups_file is None:
+        write_answer_bitmap( indexName, pt.IndexFactory.of( index_ref ) )
+    return index_ref
+
+def report_empty_docs():
     if EMPTY_DOCS > 0:
         count = str( EMPTY_DOCS )
         print("*** WARNING: " + count + " documents/formulas empty before tokenization, and were skipped.")
         print("    Additional documents/formulas may be empty after tokenization (PyTerrier message will report)")
-    
+
+def create_XML_index( file_list, indexName, token_pipeline="Stopwords,PorterStemmer", formulas=False, debug=False, workers=1,
+        row_filter=None, cache_dir=None, docstore=None, dedup=False, row_ranges=None ):
+    row_ids = []
+    index_ref = index_XML_docs( generate_XML_post_docs( file_list, formula_index=formulas, debug_out=debug, workers=workers,
+        row_filter=row_filter, cache_dir=cache_dir, row_ids=row_ids, row_ranges=row_ranges ), indexName, token_pipeline,
+        formulas, docstore, dedup )
+    write_row_ids( indexName, row_ids )
+
+    report_empty_docs()
+    return pt.IndexFactory.of( index_ref )
+
+def create_XML_indices( file_list, postIndexName, mathIndexName, token_pipeline="Stopwords,PorterStemmer", debug=False, workers=1,
+        row_filter=None, cache_dir=None, docstore=None, dedup=False, row_ranges=None ):
+    # Build post and math indices in a single pass over the XML files.
+    # Rows are parsed once; post and formula documents are indexed concurrently
+    # by two indexers, each reading from its own bounded queue.
+    # Returns ( post_index, math_index ).
+    post_queue = queue.Queue( maxsize=INDEXER_QUEUE_SIZE )
+    math_queue = queue.Queue( maxsize=INDEXER_QUEUE_SIZE )
+    failed = threading.Event()
+    index_refs = {}
+    errors = []
+    row_ids = []
+
+    def run_indexer( name, indexName, formulas, doc_queue ):
+        try:
+            index_refs[ name ] = index_XML_docs( queue_docs( doc_queue, failed ), indexName, token_pipeline, 
+                    formulas, docstore, dedup )
+        except BaseException as e:
+            errors.append( e )
+            failed.set()
+
+    indexer_threads = [
+            threading.Thread( target=run_indexer, args=( 'post', postIndexName, False, post_queue ) ),
+            threading.Thread( target=run_indexer, args=( 'math', mathIndexName, True, math_queue ) ) ]
+    for thread in indexer_threads:
+        thread.start()
+
+    try:
+        fan_out_XML_docs( file_list, post_queue, math_queue, failed, debug_out=debug, workers=workers, row_filter=row_filter,
+                cache_dir=cache_dir, row_ids=row_ids, row_ranges=row_ranges )
+    except RuntimeError:
+        # Producer stopped because an indexer failed; report the indexer error below
+        if not errors:
+            raise
+    finally:
+        for thread in indexer_threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+    for indexName in [ postIndexName, mathIndexName ]:
+        write_row_ids( indexName, row_ids )
+    report_empty_docs()
+    return ( pt.IndexFactory.of( index_refs['post'] ), pt.IndexFactory.of( index_refs['math'] ) )
+
+################################################################
+# Sharded indices
+################################################################
+# A sharded index is a directory with one Terrier index per shard, plus a
+# manifest listing the shards (and the source files/rows each one covers).
+# Shards are built in parallel, one process (and JVM) per shard, and are 
+# searched together as one index (Terrier MultiIndex), which provides
+# collection statistics (N, document frequencies, lengths) over all shards.
+MANIFEST_FILE = 'manifest.json'
+
+def read_index_manifest( index_dir ):
+    # Returns None for an ordinary (single) Terrier index
+    manifest_path = os.path.join( index_dir, MANIFEST_FILE )
+    if not os.path.exists( manifest_path ):
+        return None
+
+    with open( manifest_path ) as manifest_file:
+        return json.load( manifest_file )
+
+def write_index_manifest( index_dir, manifest ):
+    os.makedirs( index_dir, exist_ok=True )
+    with open( os.path.join( index_dir, MANIFEST_FILE ), 'w' ) as manifest_file:
+        json.dump( manifest, manifest_file, indent=2 )
+
+def remove_index_manifest( index_dir ):
+    # An index written directly to index_dir replaces any earlier shards
+    manifest_path = os.path.join( index_dir, MANIFEST_FILE )
+    if os.path.exists( manifest_path ):
+        os.remove( manifest_path )
+
+def load_index_ref( properties_path, concurrent=False ):
+    # With concurrent, the index is loaded with structures safe for use by several
+    # threads at once (ConcurrentIndexLoader, as for BatchRetrieve with threads > 1)
+    index_ref = pt.IndexRef.of( properties_path )
+    if concurrent:
+        ConcurrentIndexLoader = pt.autoclass( "org.terrier.structures.ConcurrentIndexLoader" )
+        if not ConcurrentIndexLoader.isConcurrent( index_ref ):
+            index_ref = ConcurrentIndexLoader.makeConcurrent( index_ref )
     return pt.IndexFactory.of( index_ref )
 
+def open_index( index_dir, concurrent=False ):
+    # Load a single or sharded index from its directory; use concurrent for an index
+    # searched by several threads (e.g., by the engines of an EnginePool)
+    manifest = read_index_manifest( index_dir )
+    if manifest is None:
+        return load_index_ref( index_dir + "/data.properties", concurrent )
+
+    shard_indices = [ load_index_ref( os.path.join( index_dir, segment['path'], "data.properties" ), concurrent )
+        for segment in manifest['segments'] ]
+    if len( shard_indices ) == 1:
+        return shard_indices[0]
+
+    # Federated index: ( indices, blocks, fields )
+    MultiIndex = pt.autoclass( "org.terrier.realtime.multi.MultiIndex" )
+    return MultiIndex( shard_indices, False, True )
+
+def shard_path( index_name, shard_no ):
+    return os.path.join( index_name, 'shard-%03d' % shard_no )
+
+def partition_shards( file_list, shard_count ):
+    # One group of files per shard if there are enough files; otherwise each shard
+    # reads its own contiguous range of rows from every file (see split_XML_rows), so
+    # that each file is parsed once over all shards.
+    # Returns list of ( files, rows ), where rows is None or a row range per file.
+    if len( file_list ) >= shard_count:
+        return [ ( file_list[ shard_no::shard_count ], None ) for shard_no in range( shard_count ) ]
+
+    file_ranges = [ split_XML_rows( file_name, shard_count ) for file_name in file_list ]
+    return [ ( file_list, [ ranges[ shard_no ] for ranges in file_ranges ] ) for shard_no in range( shard_count ) ]
+
+def build_index_shard( file_list, rows, post_shard, math_shard, token_pipeline, debug, cache_dir=None, docstore=None ):
+    # Runs in a worker process; starts its own JVM. Either shard name may be None.
+    # Returns the number of documents/formulas skipped as empty for this shard (a pool
+    # process may build several shards, so the process-wide count is reset first).
+    global EMPTY_DOCS
+    EMPTY_DOCS = 0
+    if not pt.started():
+        pt.init()
+
+    if post_shard and math_shard:
+        create_XML_indices( file_list, post_shard, math_shard, token_pipeline=token_pipeline, 
+                debug=debug, cache_dir=cache_dir, docstore=docstore, row_ranges=rows )
+    else:
+        create_XML_index( file_list, post_shard or math_shard, token_pipeline=token_pipeline,
+                formulas=( math_shard is not None ), debug=debug, cache_dir=cache_dir,
+                docstore=docstore, row_ranges=rows )
+
+    return EMPTY_DOCS
+
+def create_sharded_XML_indices( file_list, postIndexName, mathIndexName, shards, token_pipeline="Stopwords,PorterStemmer", 
+        debug=False, cache_dir=None, docstore=None ):
+    # Build post and/or math indices (index name None to skip) as shards in parallel.
+    # Returns ( post_index, math_index ), each a federated index over its shards (or None).
+    global EMPTY_DOCS
+    partitions = partition_shards( file_list, shards )
+
+    def shard_names( index_name ):
+        if index_name is None:
+            return [ None ] * shards
+        return [ shard_path( index_name, shard_no ) for shard_no in range( shards ) ]
+
+    with ProcessPoolExecutor( max_workers=shards, mp_context=get_context('spawn') ) as pool:
+        futures = [ pool.submit( build_index_shard, files, rows, post_shard, math_shard, token_pipeline, debug, 
+                cache_dir, docstore )
+            for ( ( files, rows ), post_shard, math_shard ) in 
+                zip( partitions, shard_names( postIndexName ), shard_names( mathIndexName ) ) ]
+        EMPTY_DOCS += sum( future.result() for future in futures )
+
+    indices = []
+    for index_name in [ postIndexName, mathIndexName ]:
+        if index_name is None:
+            indices.append( None )
+            continue
+
+        # Row ranges are recorded as [ first_row, end_row ] for each file
+        segments = [ { 'path': os.path.basename( shard_name ), 'files': files, 'ids': IDS_FILE,
+                'rows': rows and [ list( row_range ) for ( _, row_range ) in rows ] }
+            for ( shard_name, ( files, rows ) ) in zip( shard_names( index_name ), partitions ) ]
+        write_index_manifest( index_name, { 'segments': segments } )
+        indices.append( open_index( index_name ) )
+
+    return tuple( indices )
+
+################################################################
+# Incremental updates
+################################################################
+# New rows (posts whose Id is not yet indexed) are indexed as a new segment 
+# in the index directory, and added to its manifest. An existing single index
+# becomes the first segment ('.'). Segments are searched together, as for shards.
+IDS_FILE = 'ids.txt'
+META_READ_SIZE = 100000
+
+def write_row_ids( index_dir, row_ids ):
+    # Ids of all source rows read for an index (or segment/shard), whether or not they
+    # produced documents (e.g., posts without formulas in a math index)
+    with open( os.path.join( index_dir, IDS_FILE ), 'w' ) as ids_file:
+        ids_file.write( ''.join( row_id + '\n' for row_id in row_ids ) )
+
+def segment_row_ids( index_dir, segment ):
+    # Post ids covered by a segment: from its ids file (rows read when it was built), or
+    # for older indices without one, from the 'docno' entries in its meta index. For math
+    # indices, the meta index has no entries for posts without formulas, which are then
+    # read again by --update.
+    segment_dir = os.path.join( index_dir, segment['path'] )
+    ids_path = os.path.join( segment_dir, IDS_FILE )
+    if os.path.exists( ids_path ):
+        with open( ids_path ) as ids_file:
+            return set( ids_file.read().split() )
+
+    print("   No " + IDS_FILE + " for " + segment_dir + "; using indexed docnos")
+
+    index = pt.IndexFactory.of( pt.IndexRef.of( os.path.join( segment_dir, "data.properties" ) ) )
+    meta = index.getMetaIndex()
+    doc_count = index.getCollectionStatistics().getNumberOfDocuments()
+    row_ids = set()
+    for start in range( 0, doc_count, META_READ_SIZE ):
+        docids = list( range( start, min( start + META_READ_SIZE, doc_count ) ) )
+        row_ids.update( meta.getItems( 'docno', docids ) )
+
+    return row_ids
+
+def index_segments( index_dir ):
+    # Segments for an index directory (empty list if there is no index yet)
+    manifest = read_index_manifest( index_dir )
+    if manifest is not None:
+        return manifest['segments']
+    if os.path.exists( os.path.join( index_dir, "data.properties" ) ):
+        return [ { 'path': '.', 'files': None, 'rows': None } ]
+    return []
+
+def new_XML_row_ids( file_name_list, covered_ids ):
+    # Ids of rows not covered by an index, in file order
+    return [ row['id'] for row in read_XML_collection( file_name_list ) if row['id'] not in covered_ids ]
+
+def update_XML_indices( file_list, postIndexName, mathIndexName, token_pipeline="Stopwords,PorterStemmer", 
+        debug=False, workers=1, cache_dir=None, docstore=None ):
+    # Add rows not yet in the post and/or math index (index name None to skip) as a new segment.
+    # Returns ( post_index, math_index ) (None if skipped).
+    index_names = [ name for name in [ postIndexName, mathIndexName ] if name is not None ]
+    segments = { name: index_segments( name ) for name in index_names }
+    new_ids = {}
+    for name in index_names:
+        print(">> Finding new rows for " + name )
+        covered_ids = set()
+        for segment in segments[ name ]:
+            covered_ids.update( segment_row_ids( name, segment ) )
+        new_ids[ name ] = new_XML_row_ids( file_list, covered_ids )
+        print("   " + str( len( new_ids[ name ] ) ) + " new rows (" + str( len( covered_ids ) ) + " already indexed)")
+
+    def segment_name( name ):
+        return os.path.join( name, 'segment-%03d' % len( segments[ name ] ) )
+
+    def row_filter_for( ids ):
+        id_set = set( ids )
+        return lambda position, row: row['id'] in id_set
+
+    # Build the new segment(s); one pass for both indices if they need the same rows
+    pending = [ name for name in index_names if new_ids[ name ] ]
+    if not pending:
+        print(">> No new rows to index.")
+    if len( pending ) == 2 and new_ids[ postIndexName ] == new_ids[ mathIndexName ]:
+        create_XML_indices( file_list, segment_name( postIndexName ), segment_name( mathIndexName ),
+                token_pipeline=token_pipeline, debug=debug, workers=workers, 
+                row_filter=row_filter_for( new_ids[ postIndexName ] ), cache_dir=cache_dir, docstore=docstore )
+    else:
+        for name in pending:
+            create_XML_index( file_list, segment_name( name ), token_pipeline=token_pipeline,
+                    formulas=( name == mathIndexName ), debug=debug, workers=workers,
+                    row_filter=row_filter_for( new_ids[ name ] ), cache_dir=cache_dir, docstore=docstore )
+
+    # Record source files for each new segment in the manifest (row ids are in its IDS_FILE)
+    for name in pending:
+        segment_dir = segment_name( name )
+        numeric_ids = [ int( row_id ) for row_id in new_ids[ name ] if row_id.isdigit() ]
+        id_range = [ min( numeric_ids ), max( numeric_ids ) ] if numeric_ids else None
+        segments[ name ].append( { 'path': os.path.basename( segment_dir ), 'files': file_list, 'rows': None,
+            'ids': IDS_FILE, 'id_range': id_range, 'row_count': len( new_ids[ name ] ) } )
+        write_index_manifest( name, { 'segments': segments[ name ] } )
+
+    return tuple( open_index( name ) if name is not None and segments[ name ] else None 
+        for name in [ postIndexName, mathIndexName ] )
+
+################################################################
+# Stored text (--docstore)
+################################################################
+def index_store_dirs( index_dir ):
+    return [ os.path.join( index_dir, segment['path'], DOC_STORE_DIR ) for segment in index_segments( index_dir ) ]
+
+def has_index_doc_store( index_dir, field ):
+    # True if all segments/shards of an index store a field (checks files only)
+    store_dirs = index_store_dirs( index_dir )
+    return bool( store_dirs ) and all( has_doc_store( store_dir, field ) for store_dir in store_dirs )
+
+def open_doc_store( index_dir, field ):
+    # DocStore for a field over all segments/shards of an index (None if not stored)
+    if not has_index_doc_store( index_dir, field ):
+        return None
+
+    return DocStore( index_store_dirs( index_dir ), field )
+
+def index_meta_fields( index_dir, formulas=False ):
+    # Meta index fields available for retrieval (STORE_FIELDS are not in the meta index
+    # when the index has a doc store)
+    meta_fields = MATH_META_FIELDS if formulas else TEXT_META_FIELDS
+    if not has_index_doc_store( index_dir, STORE_FIELDS[0] ):
+        return meta_fields
+
+    return [ field for field in meta_fields if field not in STORE_FIELDS ]
+
+def add_stored_text( index_dir, formulas=False, key_field=None, k=None ):
+    # Transformer adding STORE_FIELDS from the doc store to results; apply after the
+    # top-k cutoff so that text is only read for the hits used (e.g., for display or reranking),
+    # or pass k to read text for hits with rank < k only (other hits get None).
+    # Results are returned unchanged for indices without a doc store (text is in the meta index).
+    if key_field is None:
+        key_field = MATH_STORE_KEY if formulas else TEXT_STORE_KEY
+    if formulas and has_formula_groups( index_dir ):
+        # Text is stored once per formula group (see expand_formula_groups)
+        key_field = 'groupno'
+    fields = [ field for field in STORE_FIELDS if has_index_doc_store( index_dir, field ) ]
+    stores = []
+
+    def add_text( result_df ):
+        if not fields:
+            return result_df
+        if not stores:
+            # Opened on first use (memory-mapped)
+            stores.extend( open_doc_store( index_dir, field ) for field in fields )
+
+        result_df = result_df.copy()
+        top = np.ones( len( result_df ), dtype=bool ) if k is None else ( result_df['rank'] < k ).to_numpy()
+        for store in stores:
+            texts = pd.Series( None, index=result_df.index, dtype=object )
+            texts[ top ] = store.get_many( result_df[ key_field ][ top ] )
+            result_df[ store.field ] = texts
+        return result_df
+
+    return pt.apply.generic( add_text )
+
+################################################################
+# Answer-only retrieval
+################################################################
+# Questions have 'qpost' as their parentno (formulas in questions as well). Rather than
+# adding '-qpost' to every query (a negated term Terrier evaluates over all questions),
+# answer_engine retrieves extra hits, and removes questions using a bitmap over docids.
+def write_answer_bitmap( index_dir, index ):
+    # Read 'parentno' for all documents from the meta index, and store the answer bitmap
+    meta = index.getMetaIndex()
+    doc_count = index.getCollectionStatistics().getNumberOfDocuments()
+    answers = np.zeros( doc_count, dtype=bool )
+    for start in range( 0, doc_count, META_READ_SIZE ):
+        docids = list( range( start, min( start + META_READ_SIZE, doc_count ) ) )
+        answers[ start : start + len( docids ) ] = np.array( list( meta.getItems( 'parentno', docids ) ) ) != 'qpost'
+
+    np.savez( os.path.join( index_dir, ANSWER_BITMAP_FILE ), bits=np.packbits( answers ), count=doc_count )
+
+def answer_bitmap( index_dir ):
+    # Answer bitmap over the docids of all segments/shards, in open_index order 
+    # (None if any segment has no bitmap)
+    bitmap_paths = [ os.path.join( index_dir, segment['path'], ANSWER_BITMAP_FILE ) for segment in index_segments( index_dir ) ]
+    if not bitmap_paths or not all( os.path.exists( path ) for path in bitmap_paths ):
+        return None
+
+    parts = []
+    for path in bitmap_paths:
+        with np.load( path ) as bitmap:
+            parts.append( np.unpackbits( bitmap['bits'], count=int( bitmap['count'] ) ).astype( bool ) )
+    return np.concatenate( parts )
+
+def has_answer_filter( index_dir ):
+    # True if answers_only can filter hits without a '-qpost' query term
+    return has_formula_groups( index_dir ) or answer_bitmap( index_dir ) is not None
+
+def answers_only( index_dir, k=None, bitmap=None ):
+    # Transformer removing question hits (by docid with an answer bitmap, otherwise by 'parentno',
+    # e.g., for formula groups after expand_formula_groups); ranks are renumbered, and at most
+    # k hits kept per query. A bitmap may be given for other indices (e.g., formula_index.py).
+    if bitmap is None and not has_formula_groups( index_dir ):
+        bitmap = answer_bitmap( index_dir )
+
+    def filter_answers( result_df ):
+        if bitmap is not None:
+            keep = bitmap[ result_df['docid'].to_numpy() ]
+        else:
+            keep = ( result_df['parentno'] != 'qpost' ).to_numpy()
+
+        result_df = result_df[ keep ].sort_values( [ 'qid', 'rank' ], kind='stable' ).reset_index( drop=True )
+        result_df['rank'] = result_df.groupby( 'qid', sort=False ).cumcount()
+        if k is not None:
+            result_df = result_df[ result_df['rank'] < k ].reset_index( drop=True )
+        return result_df
+
+    return pt.apply.generic( filter_answers )
+
+def add_meta_fields( index, metadata_keys ):
+    # Transformer reading meta index fields for result rows by docid (fields already in
+    # the results are not read again); used by answer_engine for the kept top k hits only
+    def add_meta( result_df ):
+        keys = [ key for key in metadata_keys if key not in result_df.columns ]
+        if not keys:
+            return result_df
+
+        meta = index.getMetaIndex()
+        docids = result_df['docid'].tolist()
+        result_df = result_df.copy()
+        for key in keys:
+            values = []
+            for start in range( 0, len( docids ), META_READ_SIZE ):
+                values.extend( meta.getItems( key, docids[ start : start + META_READ_SIZE ] ) )
+            result_df[ key ] = pd.Series( values, index=result_df.index, dtype=object )
+        return result_df
+
+    return pt.apply.generic( add_meta )
+
+def answer_engine( index, index_dir, model, metadata_keys=[], token_pipeline="", k=1000, 
+        fetch_factor=ANSWER_FETCH_FACTOR ):
+    # Top k answer hits for queries without '-qpost': fetch_factor * k hits are retrieved
+    # (fewer than k are returned if these include fewer than k answers). Only 'docno' is
+    # read for the retrieved hits; other meta fields are read for the answers kept.
+    fetch = fetch_factor * k
+    return search_engine( index, model, [ 'docno' ], token_pipeline, num_results=fetch ) \
+            >> expand_formula_groups( index_dir, fetch ) >> answers_only( index_dir, k ) \
+            >> add_meta_fields( index, metadata_keys )
+
 ## Visualization routines
 
 def show_tokens( index ):
@@ -221,10 +1163,12 @@ def view_index( indexName, index, view_tokens, view_stats ):
 def search_engine( index, 
         model, 
         metadata_keys=[], 
-        token_pipeline="" ): # Stopwords,PorterStemmer
+        token_pipeline="",  # Stopwords,PorterStemmer
+        num_results=1000 ):
     return pt.BatchRetrieve( index, wmodel=model, 
             properties={ "termpipelines" : token_pipeline }, 
-            metadata = metadata_keys )
+            metadata = metadata_keys,
+            num_results = num_results )
 
 # Run a single query
 def query( engine, query ):
@@ -289,16 +1233,16 @@ def show_result( result, field_names=[], show_table=True, show_hits=False, math=
     if show_hits:
         verbose_hit_summary( result, math_index=math )
 
-def test_retrieval( k, post_index, math_index, model, tokens, debug=False ):
+def test_retrieval( k, post_index, math_index, model, tokens, debug=False, post_index_dir=None, math_index_dir=None ):
 
     if post_index != None:
         print("[ Testing post index retrieval ]")
         
-        # Return top k results (% k)
+        # Return top k results (% k); stored text (if any) is read for the top k only
         posts_engine = search_engine( post_index, 
                 model, 
-                metadata_keys=['docno','title', 'text', 'origtext', 'tags', 'votes', 'parentno', 'mathnos' ],
-                token_pipeline=tokens ) % k
+                metadata_keys=index_meta_fields( post_index_dir ),
+                token_pipeline=tokens ) % k >> add_stored_text( post_index_dir )
         
         result = query( posts_engine, '_pand simplified _pand proof' )
         show_result( result, [], show_hits=True )
@@ -312,12 +1256,19 @@ def test_retrieval( k, post_index, math_index, model, tokens, debug=False ):
             'proof _pnot qpost' 
             # 'man +TITLE:{intuition}'  # Trouble restricting to fields (?)
             ] ), [], show_hits=True )
+
+        # Answers only, using the answer bitmap rather than '_pnot qpost'
+        if has_answer_filter( post_index_dir ):
+            answers_engine = answer_engine( post_index, post_index_dir, model, index_meta_fields( post_index_dir ), 
+                    token_pipeline=tokens, k=k ) >> add_stored_text( post_index_dir )
+            show_result( query( answers_engine, 'proof' ), [], show_hits=True )
     
     if math_index != None:
         print("[ Testing math index retrieval ]")
         
         # Return top k results (% k)
-        math_engine = search_engine( math_index, model, ['postno', 'text', 'origtext','docno', 'parentno' ], token_pipeline=tokens ) % k  # changed mathno to postno
+        math_engine = search_engine( math_index, model, index_meta_fields( math_index_dir, formulas=True ), 
+                token_pipeline=tokens ) >> expand_formula_groups( math_index_dir, k ) % k >> add_stored_text( math_index_dir, formulas=True )
         show_result( query( math_engine, '_pand sqrt _pand 2' ), show_hits=True, math=True )
         show_result( batch_query( math_engine, [ 'sqrt 2', '2' ] ), show_hits=True, math=True )
         show_result( batch_query( math_engine, [ 'sqrt 2 _pnot qpost' ] ), show_hits=True, math=True )
@@ -342,8 +1293,25 @@ def process_args():
             default='Stopwords,PorterStemmer' )
     parser.add_argument('-n', '--notest', help="skip retrieval tests after indexing", action="store_true" )
     parser.add_argument('-d', '--debug', help="include debugging outputs", action="store_true" )
+    parser.add_argument('-w', '--workers', type=int, default=1, 
+            help="processes used to prepare documents for the indexer (default: 1)" )
+    parser.add_argument('--shards', type=int, default=1, 
+            help="build the index as N shards in parallel, searched as one index (default: 1)" )
+    parser.add_argument('-u', '--update', action="store_true",
+            help="add only posts not already indexed, as a new index segment" )
+    parser.add_argument('-c', '--cache', default=None,
+            help="directory for cached documents (skips HTML parsing/LaTeX recoding for files seen before)" )
+    parser.add_argument('--docstore', default=None, choices=COMPRESSION_TYPES,
+            help="keep 'text' and 'origtext' in a separate document store, not the meta index (compression: none or zlib)" )
+    parser.add_argument('--dedup', action="store_true",
+            help="index each distinct formula once, with its occurrences in a side table (math index)" )
     
     args = parser.parse_args()
+    if args.update and args.shards > 1:
+        parser.error("--update adds a single segment, and cannot be combined with --shards")
+    if args.dedup and ( args.update or args.shards > 1 ):
+        parser.error("--dedup builds a single math index, and cannot be combined with --update or --shards")
+
     return args
 
 
@@ -373,21 +1341,60 @@ def main():
     # Initialize indices as non-existent
     post_index = None
     math_index = None
+    post_index_name = "./" + indexName + "-post-ptindex"
+    math_index_name = "./" + indexName + "-math-ptindex"
     
+    # Add new posts to existing indices (new segment)
+    if args.update:
+        ( post_index, math_index ) = update_XML_indices(
+            in_file_list, 
+            post_index_name if not args.math or args.mathpost else None,
+            math_index_name if args.math or args.mathpost else None,
+            token_pipeline=args.tokens, debug=args.debug, workers=args.workers, 
+            cache_dir=args.cache, docstore=args.docstore )
+        if post_index is not None:
+            view_index( "Post Index", post_index, args.lexicon, args.stats )
+        if math_index is not None:
+            view_index( "Math Index", math_index, args.lexicon, args.stats )
+
+    # Sharded indices, built in parallel (one process per shard)
+    elif args.shards > 1:
+        ( post_index, math_index ) = create_sharded_XML_indices(
+            in_file_list, 
+            post_index_name if not args.math or args.mathpost else None,
+            math_index_name if args.math or args.mathpost else None,
+            args.shards, token_pipeline=args.tokens, debug=args.debug, 
+            cache_dir=args.cache, docstore=args.docstore )
+        if post_index is not None:
+            view_index( "Post Index", post_index, args.lexicon, args.stats )
+        if math_index is not None:
+            view_index( "Math Index", math_index, args.lexicon, args.stats )
+
+    # Post and formula indices in a single pass (each row is parsed once)
+    elif args.mathpost:
+        ( post_index, math_index ) = create_XML_indices(
+            in_file_list, post_index_name, math_index_name,
+            token_pipeline=args.tokens, debug=args.debug, workers=args.workers, 
+            cache_dir=args.cache, docstore=args.docstore, dedup=args.dedup )
+        view_index( "Post Index", post_index, args.lexicon, args.stats )
+        view_index( "Math Index", math_index, args.lexicon, args.stats )
+
     # Post index construction
     # Store post text and ids for formulas in each post in the 'meta' (document) index
-    if not args.math or args.mathpost:
+    elif not args.math:
         post_index = create_XML_index(
-            in_file_list, "./" + indexName + "-post-ptindex", 
-            token_pipeline=args.tokens, debug=args.debug )
+            in_file_list, post_index_name, 
+            token_pipeline=args.tokens, debug=args.debug, workers=args.workers, 
+            cache_dir=args.cache, docstore=args.docstore )
         view_index( "Post Index", post_index, args.lexicon, args.stats )
 
     # Formula index construction
     # Store formula text (LaTeX) and formula ids, along with source post id for each formula
-    if args.math or args.mathpost:
+    else:
         math_index = create_XML_index( 
-            in_file_list, "./" + indexName + "-math-ptindex", formulas=True, 
-            token_pipeline=args.tokens, debug=args.debug )
+            in_file_list, math_index_name, formulas=True, 
+            token_pipeline=args.tokens, debug=args.debug, workers=args.workers, 
+            cache_dir=args.cache, docstore=args.docstore, dedup=args.dedup )
         view_index( "Math Index", math_index, args.lexicon, args.stats )
 
     print('>>> Indexing complete.\n')
@@ -396,7 +1403,8 @@ def main():
     # Top k
     k = 5
     if not args.notest:
-        test_retrieval( k, post_index, math_index, 'BM25', args.tokens, debug=args.debug )    
+        test_retrieval( k, post_index, math_index, 'BM25', args.tokens, debug=args.debug,
+            post_index_dir=post_index_name, math_index_dir=math_index_name )
 
 if __name__ == "__main__":
     main()
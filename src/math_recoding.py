@@ -9,6 +9,12 @@
 # R. Zanibbi, April 2022 (CSCI 539, Information Retrieval, RIT)
 ################################################################
 
+# Version of the recoding applied to posts and formulas for indexing.
+# Increment when translation changes in a way not visible in the maps below
+# (e.g., a change to how the translators apply rules), so that cached
+# documents (see index_arqmath.py, --cache) are rebuilt.
+RECODING_VERSION = 1
+
 ################################################################
 # LaTeX Symbol Map
 ################################################################
@@ -84,17 +90,41 @@ def rewrite_symbols( in_string, map_dict ):
 
     return out_string
 
+def compile_symbol_map( map_dict ):
+    # Build a translator function for a symbol map once, rather than on every call.
+    # Rules are ordered longest key first, so that output does not depend on the
+    # order of entries in the dictionary (e.g., '\\\\' is always rewritten before '\\').
+    # For the maps above (no replacement contains a key), this gives the same output 
+    # as a single left-to-right, longest-match pass. Rules are applied with str.replace,
+    # which is faster in CPython than a one-pass regex with a Python callback 
+    # (see src/bench_recoding.py).
+    rules = sorted( map_dict.items(), key=lambda rule: len( rule[0] ), reverse=True )
+
+    for ( _, replacement ) in rules:
+        if any( key in replacement for key in map_dict ):
+            raise ValueError("Replacement contains a symbol map key: " + repr( replacement ) )
+
+    def translate( in_string ):
+        out_string = in_string
+        for ( key, replacement ) in rules:
+            out_string = out_string.replace( key, replacement )
+
+        return out_string
+
+    return translate
+
+# Compiled translators for the maps above
+latex_translator = compile_symbol_map( latex_symbol_map )
+pyterrier_translator = compile_symbol_map( pyterrier_symbol_map )
+
 def translate_latex( TeXstring ):
     # Replace LaTeX symbols in a string by text tokens
-    return rewrite_symbols( TeXstring, latex_symbol_map )
+    return latex_translator( TeXstring )
 
 def translate_query( query):
     # Translate query string to 'arqmath pyterrier query language' representation
     # (translate TeX symbols + 'meta' operators (e.g., _pand for '+' in pyterrier query language)
-    return rewrite_symbols(
-            rewrite_symbols( query, latex_symbol_map ),
-            pyterrier_symbol_map 
-        )
+    return pyterrier_translator( latex_translator( query ) )
 
 def translate_qlist( query_list ):
     # For batch retrieval
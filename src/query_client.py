@@ -0,0 +1,79 @@
+################################################################
+# query_client.py
+#
+# Client for query_server.py. QueryClient.query and batch_query
+# return hits as pandas DataFrames, with the same columns as
+# index_arqmath.query and batch_query, without starting a JVM or
+# loading indices in the calling program.
+#
+# Usage:
+#   python3 src/query_client.py 'sqrt 2' ['x^2' ...] [-e math] [-k 10]
+################################################################
+
+import json
+import argparse
+import urllib.request
+import urllib.error
+import pandas as pd
+
+# Defaults shared with query_server.py (kept here so that clients do not import PyTerrier)
+SERVER_HOST = 'localhost'
+SERVER_PORT = 8765
+
+class QueryClient:
+    def __init__( self, host=SERVER_HOST, port=SERVER_PORT, timeout=600 ):
+        self.url = 'http://' + host + ':' + str( port )
+        self.timeout = timeout
+        self.seconds = 0.0
+
+    def request( self, path, body=None ):
+        data = None if body is None else json.dumps( body ).encode( 'utf-8' )
+        request = urllib.request.Request( self.url + path, data=data, headers={ 'Content-Type': 'application/json' } )
+        try:
+            with urllib.request.urlopen( request, timeout=self.timeout ) as response:
+                return json.loads( response.read() )
+        except urllib.error.HTTPError as error:
+            # Error messages from the server are raised as ValueErrors
+            raise ValueError( json.loads( error.read() ).get( 'error', str( error ) ) ) from None
+
+    def search( self, path, body ):
+        response = self.request( path, body )
+        self.seconds = response[ 'seconds' ]
+        results = pd.DataFrame.from_records( response[ 'results' ] )
+        if 'qid' in results:
+            results[ 'qid' ] = results[ 'qid' ].astype( str )
+        return results
+
+    def engines( self ):
+        return self.request( '/engines' )
+
+    def query( self, query, engine='post', k=10, text=False ):
+        return self.search( '/query', { 'engine': engine, 'query': query, 'k': k, 'text': text } )
+
+    def batch_query( self, query_list, engine='post', k=10, qids=None, text=False ):
+        body = { 'engine': engine, 'queries': list( query_list ), 'k': k, 'text': text }
+        if qids is not None:
+            body[ 'qids' ] = [ str( qid ) for qid in qids ]
+        return self.search( '/batch_query', body )
+
+################################################################
+# Main program
+################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Send queries to a running query server (src/query_server.py).")
+    parser.add_argument('queries', nargs='+', help='queries (ARQMath query syntax, e.g., _pand)' )
+    parser.add_argument('-e', '--engine', default='post', help="engine name: post or math (default: post)" )
+    parser.add_argument('-k', '--topk', type=int, default=10, help="hits per query (default: 10)" )
+    parser.add_argument('--text', help="include stored document text", action="store_true" )
+    parser.add_argument('--host', default=SERVER_HOST, help="server host (default: localhost)" )
+    parser.add_argument('--port', type=int, default=SERVER_PORT, help="server port (default: 8765)" )
+    args = parser.parse_args()
+
+    pd.set_option('display.max_colwidth', 150)
+    client = QueryClient( args.host, args.port )
+    results = client.batch_query( args.queries, args.engine, args.topk, text=args.text )
+    print( results )
+    print( "Search time: {:.3f}s".format( client.seconds ) )
+
+if __name__ == "__main__":
+    main()
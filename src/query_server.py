@@ -0,0 +1,240 @@
+################################################################
+# query_server.py
+#
+# Long-lived query service for ARQMath indices. PyTerrier (the
+# JVM) is started, and the post and/or math indices are loaded,
+# once; search engines then stay warm for all requests.
+#
+# HTTP endpoints (JSON, one thread per connection; with -w N, up
+# to N requests per index and depth are searched concurrently):
+#
+#   GET  /engines       engine names, index directories, model
+#   POST /query         { "engine": "post", "query": "...", "k": 10 }
+#   POST /batch_query   { "engine": "post", "queries": [ ... ], "k": 10,
+#                         "qids": [ ... ] (optional), "text": true }
+#
+# Queries are translated as for index_arqmath.query/batch_query
+# (TeX symbols, '_pand' etc.). Responses hold the hits as a list
+# of records ( qid, query, docid, docno, score, rank, meta fields )
+# and the search time in seconds. See query_client.py for a client.
+#
+# Each index has engines for several retrieval depths (10, 100,
+# 1000 and the maximum hits per query); a request for k hits is
+# searched with the smallest depth of at least k, so small
+# requests do not retrieve max_k hits.
+#
+# Usage:
+#   python3 src/query_server.py --post-index P --math-index M [--port N]
+################################################################
+
+import json
+import time
+import argparse
+import pandas as pd
+import pyterrier as pt
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from index_arqmath import open_index, search_engine, answer_engine, has_answer_filter, index_meta_fields, \
+        expand_formula_groups, add_stored_text, ANSWER_FETCH_FACTOR
+from math_recoding import translate_qlist
+from engine_pool import EnginePool
+from retrieval_cache import CachedRetriever, engine_settings
+from query_client import SERVER_HOST, SERVER_PORT
+
+# Maximum hits per query (requests may ask for fewer)
+SERVER_MAX_K = 1000
+# Retrieval depths with their own engines (plus max_k)
+SERVER_DEPTHS = [ 10, 100, 1000 ]
+
+################################################################
+# Engines
+################################################################
+def engine_depths( max_k ):
+    # Retrieval depths for an index, up to max_k
+    return sorted( { depth for depth in SERVER_DEPTHS if depth < max_k } | { max_k } )
+
+class LoadedEngine:
+    # Search engines over a loaded index, for each retrieval depth: an EnginePool with one
+    # engine per worker, so that up to 'workers' requests for a depth run concurrently (others
+    # wait for a free engine). With cache_dir, results are cached by translated query and
+    # depth (see retrieval_cache.py)
+    def __init__( self, name, index_dir, model, token_pipeline, formulas=False, max_k=SERVER_MAX_K, workers=1,
+            cache_dir=None ):
+        self.name = name
+        self.index_dir = index_dir
+        self.model = model
+        self.max_k = max_k
+        self.workers = workers
+        self.depths = engine_depths( max_k )
+        # Engines for all depths and workers search the index from their own threads
+        index = open_index( index_dir, concurrent=True )
+        meta_fields = index_meta_fields( index_dir, formulas )
+
+        if not formulas and has_answer_filter( index_dir ):
+            settings = engine_settings( 'answer_engine', meta_fields, fetch_factor=ANSWER_FETCH_FACTOR )
+        elif formulas:
+            settings = engine_settings( 'search_engine', meta_fields, expand_formula_groups=True )
+        else:
+            settings = engine_settings( 'search_engine', meta_fields )
+
+        def make_engine( depth ):
+            if not formulas and has_answer_filter( index_dir ):
+                # Answers only (questions removed by the answer bitmap)
+                return answer_engine( index, index_dir, model, meta_fields, token_pipeline, k=depth )
+            if formulas:
+                return search_engine( index, model, meta_fields, token_pipeline, num_results=depth ) \
+                        >> expand_formula_groups( index_dir, depth )
+            return search_engine( index, model, meta_fields, token_pipeline, num_results=depth )
+
+        # { depth: engine }
+        self.engines = {}
+        for depth in self.depths:
+            engine = EnginePool( lambda depth=depth: make_engine( depth ), workers )
+            if cache_dir:
+                engine = CachedRetriever( engine, index_dir, model, token_pipeline, depth,
+                        name='formulas' if formulas else '', settings=settings, cache_dir=cache_dir )
+            self.engines[ depth ] = engine
+        self.stored_text = add_stored_text( index_dir, formulas )
+
+    def search( self, query_list, k, qids=None, text=False ):
+        # Top k hits for each query (qids default to '1', '2', ...), retrieved by the
+        # engine for the smallest depth of at least k
+        k = min( k, self.max_k )
+        if qids is None:
+            qids = [ str( qid ) for qid in range( 1, len( query_list ) + 1 ) ]
+        queries = pd.DataFrame( { 'qid': [ str( qid ) for qid in qids ], 'query': translate_qlist( query_list ) } )
+
+        depth = min( depth for depth in self.depths if depth >= k )
+        results = self.engines[ depth ]( queries )
+        results = results[ results[ 'rank' ] < k ].reset_index( drop=True )
+
+        # Stored text (if any) is read for the top k only
+        return self.stored_text( results ) if text else results
+
+    def describe( self ):
+        return { 'index': self.index_dir, 'model': self.model, 'max_k': self.max_k, 'depths': self.depths,
+                'workers': self.workers }
+
+def load_engines( post_index_dir=None, math_index_dir=None, model='BM25', token_pipeline='Stopwords,PorterStemmer',
+        max_k=SERVER_MAX_K, workers=1, cache_dir=None ):
+    # { name: LoadedEngine } for the given indices ('post' and 'math')
+    engines = {}
+    if post_index_dir:
+        engines[ 'post' ] = LoadedEngine( 'post', post_index_dir, model, token_pipeline, max_k=max_k, workers=workers,
+                cache_dir=cache_dir )
+    if math_index_dir:
+        engines[ 'math' ] = LoadedEngine( 'math', math_index_dir, model, token_pipeline, formulas=True, max_k=max_k,
+                workers=workers, cache_dir=cache_dir )
+
+    return engines
+
+################################################################
+# HTTP server
+################################################################
+class QueryRequestHandler( BaseHTTPRequestHandler ):
+    # self.server.engines: { name: LoadedEngine }
+    protocol_version = 'HTTP/1.1'
+
+    def send_json( self, status, body ):
+        data = body.encode( 'utf-8' ) if isinstance( body, str ) else json.dumps( body ).encode( 'utf-8' )
+        self.send_response( status )
+        self.send_header( 'Content-Type', 'application/json' )
+        self.send_header( 'Content-Length', str( len( data ) ) )
+        self.end_headers()
+        self.wfile.write( data )
+
+    def do_GET( self ):
+        if self.path == '/engines':
+            self.send_json( 200, { name: engine.describe() for ( name, engine ) in self.server.engines.items() } )
+        else:
+            self.send_json( 404, { 'error': 'Unknown path: ' + self.path } )
+
+    def do_POST( self ):
+        try:
+            request = json.loads( self.rfile.read( int( self.headers.get( 'Content-Length', 0 ) ) ) or b'{}' )
+            if self.path == '/query':
+                query_list = [ request[ 'query' ] ]
+            elif self.path == '/batch_query':
+                query_list = list( request[ 'queries' ] )
+            else:
+                self.send_json( 404, { 'error': 'Unknown path: ' + self.path } )
+                return
+
+            name = request.get( 'engine', 'post' )
+            if name not in self.server.engines:
+                raise ValueError( "Unknown engine '" + name + "' (available: " + ', '.join( self.server.engines ) + ")" )
+        except ( ValueError, KeyError, TypeError ) as error:
+            self.send_json( 400, { 'error': str( error ) } )
+            return
+
+        start = time.time()
+        try:
+            results = self.server.engines[ name ].search( query_list, int( request.get( 'k', 10 ) ), request.get( 'qids' ),
+                    bool( request.get( 'text', False ) ) )
+        except Exception as error:
+            self.send_json( 500, { 'error': repr( error ) } )
+            return
+
+        # Records are serialized by pandas (NumPy values, NaN as null)
+        self.send_json( 200, '{"seconds": ' + json.dumps( round( time.time() - start, 6 ) ) +
+                ', "results": ' + results.to_json( orient='records' ) + '}' )
+
+    def log_message( self, format, *args ):
+        if self.server.verbose:
+            super().log_message( format, *args )
+
+def create_server( engines, host=SERVER_HOST, port=SERVER_PORT, verbose=False ):
+    server = ThreadingHTTPServer( ( host, port ), QueryRequestHandler )
+    server.daemon_threads = True
+    server.engines = engines
+    server.verbose = verbose
+    return server
+
+################################################################
+# Main program
+################################################################
+def process_args():
+    parser = argparse.ArgumentParser(description="Query server keeping ARQMath indices and search engines loaded.")
+    parser.add_argument('-p', '--post-index', default=None, help='post index directory' )
+    parser.add_argument('-x', '--math-index', default=None, help='math (formula) index directory' )
+    parser.add_argument('-m', '--model', default="BM25", help="term weight model (default: BM25)" )
+    parser.add_argument('-t', '--tokens', help="tokenization property used for the indices (none:  no stemming/stopword removal)",
+            default='Stopwords,PorterStemmer' )
+    parser.add_argument('-k', '--max-k', type=int, default=SERVER_MAX_K, help="maximum hits per query (default: 1000)" )
+    parser.add_argument('-w', '--workers', type=int, default=1,
+            help="engines (and threads) per index, for concurrent requests (default: 1)" )
+    parser.add_argument('-c', '--cache', default=None,
+            help="directory for cached results, shared with run_topics.py (default: no cache)" )
+    parser.add_argument('--host', default=SERVER_HOST, help="host name to listen on (default: localhost)" )
+    parser.add_argument('--port', type=int, default=SERVER_PORT, help="port to listen on (default: 8765)" )
+    parser.add_argument('-v', '--verbose', help="log each request", action="store_true" )
+
+    args = parser.parse_args()
+    if not args.post_index and not args.math_index:
+        parser.error("at least one of --post-index and --math-index is required")
+    if args.tokens == 'none':
+        args.tokens = ''
+
+    return args
+
+def main():
+    args = process_args()
+
+    print('\n>>> Initializing PyTerrier...')
+    if not pt.started():
+        pt.init()
+
+    print('>>> Loading indices...')
+    engines = load_engines( args.post_index, args.math_index, args.model, args.tokens, args.max_k, args.workers, args.cache )
+    server = create_server( engines, args.host, args.port, args.verbose )
+    print('>>> Serving ' + ', '.join( engines ) + ' on http://' + args.host + ':' + str( args.port ) + '/')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
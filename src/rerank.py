@@ -0,0 +1,158 @@
+################################################################
+# rerank.py
+#
+# Neural reranking stage for first-stage (e.g., BM25) results.
+# A NeuralReranker wraps a scoring transformer (e.g., the onir_pt
+# vanilla BERT reranker, or ColBERT's text_scorer()) and:
+#
+#   * reranks only the top k hits for each query (rank < k); hits
+#     below the top k follow in their first-stage order, with their
+#     scores shifted below the lowest reranked score,
+#   * sends ( query, text ) pairs to the scorer in batches of
+#     pairs with similar lengths (dynamic batch sizes, so that
+#     short pairs are not padded to the longest in the batch), and
+#   * keeps scores in memory, and optionally on disk (SQLite, see
+#     retrieval_cache.DiskCache), keyed by ( model, name, qid,
+#     query, docno ), so that repeated runs skip scoring pairs seen
+#     before. The name separates engines whose docnos may collide
+#     (e.g., 'math' and 'post'): use one reranker per engine.
+################################################################
+
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+import pyterrier as pt
+
+from retrieval_cache import DiskCache, DISK_CACHE_MB
+
+RERANK_CACHE_FILE = 'rerank-cache.sqlite'
+RERANK_K = 100
+# Batch limits: total (padded) words per batch, and pairs per batch
+BATCH_WORDS = 16384
+MAX_BATCH = 64
+
+################################################################
+# Length buckets
+################################################################
+def pair_lengths( queries, texts ):
+    # Approximate pair lengths in words (query + document text)
+    return queries.str.count( r'\S+' ).to_numpy() + texts.str.count( r'\S+' ).to_numpy()
+
+def length_batches( lengths, batch_words=BATCH_WORDS, max_batch=MAX_BATCH ):
+    # Lists of row positions, grouping rows of similar length: rows are sorted by length,
+    # and a batch is closed when ( rows + 1 ) * longest row would exceed batch_words
+    batches = []
+    batch = []
+    longest = 0
+    for row in np.argsort( lengths, kind='stable' ):
+        row_length = max( int( lengths[ row ] ), 1 )
+        if batch and ( len( batch ) >= max_batch or ( len( batch ) + 1 ) * max( longest, row_length ) > batch_words ):
+            batches.append( batch )
+            ( batch, longest ) = ( [], 0 )
+        batch.append( row )
+        longest = max( longest, row_length )
+    if batch:
+        batches.append( batch )
+
+    return batches
+
+################################################################
+# Reranker
+################################################################
+def score_key( model, name, qid, query, docno ):
+    # Query text is included, so that different queries for a topic do not share scores;
+    # name is the engine (index) the hits come from, as docnos are only unique per index
+    return hashlib.sha1( repr( ( model, name, qid, query, docno ) ).encode( 'utf-8' ) ).hexdigest()
+
+class NeuralReranker( pt.Transformer ):
+    # scorer: transformer adding a 'score' to each ( qid, query, docno, text ) row
+    # model: name for the scorer in cache keys (e.g., 'vbert', 'colbert')
+    # name: engine (index) reranked, in cache keys (e.g., 'math', 'post')
+    # k: hits reranked per query; text_field: document text column passed to the scorer
+    # cache_dir: optional directory for the on-disk score cache (shared across runs)
+    def __init__( self, scorer, model, name='', k=RERANK_K, text_field='origtext', batch_words=BATCH_WORDS,
+            max_batch=MAX_BATCH, cache_dir=None, cache_mb=DISK_CACHE_MB ):
+        super().__init__()
+        self.scorer = scorer
+        self.model = model
+        self.name = name
+        self.k = k
+        self.text_field = text_field
+        self.batch_words = batch_words
+        self.max_batch = max_batch
+
+        self.memory = {}
+        self.lock = threading.Lock()
+        self.disk = DiskCache( cache_dir, cache_mb, RERANK_CACHE_FILE ) if cache_dir else None
+        self.scored = 0
+        self.cached = 0
+
+    def lookup( self, keys ):
+        with self.lock:
+            scores = { key: self.memory[ key ] for key in keys if key in self.memory }
+        missing = [ key for key in keys if key not in scores ]
+        if missing and self.disk is not None:
+            stored = self.disk.get_many( missing )
+            with self.lock:
+                self.memory.update( stored )
+            scores.update( stored )
+        return scores
+
+    def score_pairs( self, pairs ):
+        # Scores for pairs (a frame of hits), one scorer call per length batch
+        scores = np.zeros( len( pairs ) )
+        lengths = pair_lengths( pairs[ 'query' ].astype( str ), pairs[ self.text_field ].astype( str ) )
+        for batch in length_batches( lengths, self.batch_words, self.max_batch ):
+            batch_pairs = pairs.iloc[ batch ]
+            batch_scores = self.scorer.transform( batch_pairs.drop( columns=[ 'score', 'rank' ], errors='ignore' ) )
+            # Scorers may reorder rows; align on ( qid, docno )
+            aligned = batch_pairs[ [ 'qid', 'docno' ] ].merge(
+                    batch_scores[ [ 'qid', 'docno', 'score' ] ].drop_duplicates( [ 'qid', 'docno' ] ),
+                    on=[ 'qid', 'docno' ], how='left' )
+            scores[ batch ] = aligned[ 'score' ].to_numpy( dtype=float )
+
+        return scores
+
+    def transform( self, results ):
+        # Top k hits per query reranked by the scorer's scores, followed by the other hits
+        top = results[ results[ 'rank' ] < self.k ].reset_index( drop=True )
+        if len( top ) == 0:
+            return results
+
+        keys = [ score_key( self.model, self.name, qid, query, docno )
+                for ( qid, query, docno ) in zip( top[ 'qid' ], top[ 'query' ], top[ 'docno' ] ) ]
+        scores = self.lookup( keys )
+
+        missing = [ i for ( i, key ) in enumerate( keys ) if key not in scores ]
+        self.cached += len( keys ) - len( missing )
+        self.scored += len( missing )
+        if missing:
+            new_scores = dict( zip( [ keys[ i ] for i in missing ], self.score_pairs( top.iloc[ missing ] ) ) )
+            with self.lock:
+                self.memory.update( new_scores )
+            if self.disk is not None:
+                self.disk.put_many( new_scores.items() )
+            scores.update( new_scores )
+
+        top[ 'score' ] = [ scores[ key ] for key in keys ]
+        top = top.sort_values( [ 'qid', 'score' ], ascending=[ True, False ], kind='stable' ).reset_index( drop=True )
+        top[ 'rank' ] = top.groupby( 'qid', sort=False ).cumcount()
+
+        rest = results[ results[ 'rank' ] >= self.k ]
+        if len( rest ) == 0:
+            return top
+
+        # Hits below the top k keep their order and score differences, shifted to
+        # score below the lowest reranked hit for their query
+        rest = rest.sort_values( [ 'qid', 'rank' ], kind='stable' ).reset_index( drop=True )
+        offsets = top.groupby( 'qid' )[ 'score' ].min() - rest.groupby( 'qid' )[ 'score' ].max() - 1
+        rest[ 'score' ] = rest[ 'score' ] + offsets.reindex( rest[ 'qid' ] ).fillna( 0 ).to_numpy()
+        reranked = pd.concat( [ top, rest ], ignore_index=True ).sort_values( 'qid', kind='stable' ).reset_index( drop=True )
+        reranked[ 'rank' ] = reranked.groupby( 'qid', sort=False ).cumcount()
+        if len( reranked ) != len( results ):
+            raise RuntimeError( "Reranker returned " + str( len( reranked ) ) + " of " + str( len( results ) ) + " hits" )
+        return reranked
+
+    def __repr__( self ):
+        return 'NeuralReranker(' + self.model + ( ', ' + self.name if self.name else '' ) + ', k=' + str( self.k ) + ')'
@@ -0,0 +1,265 @@
+################################################################
+# retrieval_cache.py
+#
+# Caching first-stage retrieval for PyTerrier pipelines. A
+# CachedRetriever wraps a retrieval transformer (e.g., a BM25
+# search_engine with a rank cutoff) and stores the hits for each
+# query, keyed by ( index identity, model, token pipeline, query
+# text, k, name, engine settings ). The engine settings give the
+# engine type (e.g., 'answer_engine' or 'search_engine') and the
+# parameters changing its output (meta fields, fetch_factor), so
+# that different engines over an index and model do not share
+# entries. Queries seen before are answered from memory,
+# or from an optional on-disk cache (SQLite, least-recently used
+# entries are removed beyond a size limit), without Terrier.
+#
+# The index identity is a hash of the index files describing its
+# contents (data.properties for each segment/shard, the manifest,
+# answer bitmaps and formula groups), so entries for an index are
+# no longer used once it is rebuilt or updated (and are evicted as
+# the least recently used). The query text is the text passed to
+# the engine, so programs converting queries differently (e.g.,
+# topic queries in run_topics.py and translated requests in
+# query_server.py) do not share entries, even with one cache
+# directory.
+#
+# Fusion weight sweeps, e.g.,
+#   (wA * math_engine) + (wB * post_engine)
+# then run each first-stage retrieval once, and only recompute
+# the linear combination for each weight.
+################################################################
+
+import os
+import time
+import pickle
+import hashlib
+import sqlite3
+import threading
+import pandas as pd
+import pyterrier as pt
+from collections import OrderedDict
+
+from index_arqmath import index_segments, MANIFEST_FILE, ANSWER_BITMAP_FILE, FORMULA_GROUPS_FILE
+
+DISK_CACHE_FILE = 'retrieval-cache.sqlite'
+DISK_CACHE_MB = 1024
+SQLITE_BATCH = 500  # keys per query (SQLite limits the number of parameters)
+SQLITE_TIMEOUT = 60  # seconds to wait for a lock held by another process
+# Result lists kept in memory per CachedRetriever (least recently used are removed)
+MEMORY_CACHE_ENTRIES = 10000
+# Per-segment files included in the index identity
+SEGMENT_IDENTITY_FILES = [ 'data.properties', ANSWER_BITMAP_FILE, FORMULA_GROUPS_FILE ]
+
+################################################################
+# On-disk LRU cache
+################################################################
+class DiskCache:
+    # Pickled values keyed by string, in a single SQLite file; entries
+    # used least recently are removed when the total exceeds max_mb.
+    def __init__( self, cache_dir, max_mb=DISK_CACHE_MB, file_name=DISK_CACHE_FILE ):
+        os.makedirs( cache_dir, exist_ok=True )
+        self.max_bytes = int( max_mb * 1024 * 1024 )
+        self.lock = threading.Lock()
+        # Several processes may share a cache file (e.g., run_topics_experiment.py -w): WAL mode
+        # lets readers proceed during writes, and writers wait for locks (up to SQLITE_TIMEOUT)
+        self.db = sqlite3.connect( os.path.join( cache_dir, file_name ), timeout=SQLITE_TIMEOUT, check_same_thread=False )
+        self.db.execute( 'PRAGMA journal_mode=WAL' )
+        self.db.execute( 'CREATE TABLE IF NOT EXISTS entries '
+                '( key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL )' )
+        self.db.execute( 'CREATE INDEX IF NOT EXISTS entries_last_used ON entries ( last_used )' )
+        self.db.commit()
+
+    def get( self, key ):
+        with self.lock:
+            row = self.db.execute( 'SELECT value FROM entries WHERE key = ?', ( key, ) ).fetchone()
+            if row is None:
+                return None
+            self.db.execute( 'UPDATE entries SET last_used = ? WHERE key = ?', ( time.time(), key ) )
+            self.db.commit()
+
+        return pickle.loads( row[0] )
+
+    def get_many( self, keys ):
+        # Returns { key: value } for keys found (one query and update per SQLITE_BATCH keys)
+        found = {}
+        now = time.time()
+        with self.lock:
+            for start in range( 0, len( keys ), SQLITE_BATCH ):
+                batch = list( keys[ start : start + SQLITE_BATCH ] )
+                rows = self.db.execute( 'SELECT key, value FROM entries WHERE key IN ( ' + 
+                        ','.join( '?' * len( batch ) ) + ' )', batch ).fetchall()
+                self.db.executemany( 'UPDATE entries SET last_used = ? WHERE key = ?', [ ( now, key ) for ( key, _ ) in rows ] )
+                found.update( rows )
+            self.db.commit()
+
+        return { key: pickle.loads( value ) for ( key, value ) in found.items() }
+
+    def put_many( self, items ):
+        # items: [ ( key, value ) ]
+        now = time.time()
+        rows = []
+        for ( key, value ) in items:
+            data = pickle.dumps( value, protocol=pickle.HIGHEST_PROTOCOL )
+            rows.append( ( key, data, len( data ), now ) )
+
+        with self.lock:
+            self.db.executemany( 'INSERT OR REPLACE INTO entries VALUES ( ?, ?, ?, ? )', rows )
+            self.evict()
+            self.db.commit()
+
+    def evict( self ):
+        # Remove least recently used entries until within the size limit
+        total = self.db.execute( 'SELECT COALESCE( SUM( size ), 0 ) FROM entries' ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        removed = []
+        for ( key, size ) in self.db.execute( 'SELECT key, size FROM entries ORDER BY last_used' ):
+            if total <= self.max_bytes:
+                break
+            removed.append( ( key, ) )
+            total -= size
+        self.db.executemany( 'DELETE FROM entries WHERE key = ?', removed )
+
+    def close( self ):
+        with self.lock:
+            self.db.close()
+
+
+################################################################
+# Index identity
+################################################################
+identity_lock = threading.Lock()
+identities = {}
+
+def index_identity_files( index_dir ):
+    paths = [ os.path.join( index_dir, MANIFEST_FILE ) ]
+    for segment in index_segments( index_dir ):
+        paths.extend( os.path.join( index_dir, segment['path'], file_name ) for file_name in SEGMENT_IDENTITY_FILES )
+    return [ path for path in paths if os.path.exists( path ) ]
+
+def index_identity( index_dir ):
+    # Hash of the identity files for an index; files are only read again when their
+    # size or modification time changes
+    paths = index_identity_files( index_dir )
+    signature = tuple( ( os.path.abspath( path ), os.stat( path ).st_mtime_ns, os.stat( path ).st_size ) for path in paths )
+    with identity_lock:
+        if signature in identities:
+            return identities[ signature ]
+
+    identity = hashlib.sha1()
+    for path in paths:
+        identity.update( os.path.relpath( path, index_dir ).encode( 'utf-8' ) )
+        with open( path, 'rb' ) as identity_file:
+            for block in iter( lambda: identity_file.read( 1 << 20 ), b'' ):
+                identity.update( block )
+    with identity_lock:
+        identities[ signature ] = identity.hexdigest()
+    return identities[ signature ]
+
+################################################################
+# Caching retriever
+################################################################
+def engine_settings( engine_type, metadata_keys=(), **params ):
+    # Engine description for cache keys: engine type (e.g., 'answer_engine'), meta fields
+    # in its results, and other parameters changing its results (e.g., fetch_factor)
+    return ( engine_type, tuple( metadata_keys ), tuple( sorted( params.items() ) ) )
+
+def retrieval_key( index_id, model, token_pipeline, query, k, name='', settings=() ):
+    # Key string for one query; index_id is from index_identity (so the same index
+    # shares entries under any path, and a rebuilt index gets new keys)
+    parts = ( index_id, model, token_pipeline, query, k, name, settings )
+    return hashlib.sha1( repr( parts ).encode( 'utf-8' ) ).hexdigest()
+
+class CachedRetriever( pt.Transformer ):
+    # engine: transformer producing ranked hits for a query frame ( qid, query, ... )
+    # index_path, model, token_pipeline, k: describe the engine (used in cache keys)
+    # name: distinguishes engines over the same index with different post-processing
+    # settings: engine type and parameters, from engine_settings (used in cache keys)
+    # cache_dir: optional directory for the on-disk cache (shared across runs)
+    def __init__( self, engine, index_path, model, token_pipeline='', k=1000, name='', settings=(),
+            cache_dir=None, cache_mb=DISK_CACHE_MB, memory_entries=MEMORY_CACHE_ENTRIES ):
+        super().__init__()
+        self.engine = engine
+        self.index_path = index_path
+        self.model = model
+        self.token_pipeline = token_pipeline
+        self.k = k
+        self.name = name
+        self.settings = settings
+
+        self.memory = OrderedDict()
+        self.memory_entries = memory_entries
+        self.lock = threading.Lock()
+        self.disk = DiskCache( cache_dir, cache_mb ) if cache_dir else None
+        self.hits = 0
+        self.misses = 0
+
+    def key( self, query, index_id=None ):
+        return retrieval_key( index_id or index_identity( self.index_path ), self.model, self.token_pipeline, 
+                query, self.k, self.name, self.settings )
+
+    def remember( self, entries ):
+        # Add entries to the in-memory LRU cache
+        with self.lock:
+            for ( key, results ) in entries.items():
+                self.memory[ key ] = results
+                self.memory.move_to_end( key )
+            while len( self.memory ) > self.memory_entries:
+                self.memory.popitem( last=False )
+
+    def lookup( self, key ):
+        with self.lock:
+            results = self.memory.get( key )
+            if results is not None:
+                self.memory.move_to_end( key )
+        if results is None and self.disk is not None:
+            results = self.disk.get( key )
+            if results is not None:
+                self.remember( { key: results } )
+        return results
+
+    def transform( self, queries ):
+        # Index identity checked once per request
+        index_id = index_identity( self.index_path )
+        keys = [ self.key( query, index_id ) for query in queries[ 'query' ] ]
+        cached = [ self.lookup( key ) for key in keys ]
+
+        # Retrieve missing queries together (one batch for the engine)
+        missing = [ i for ( i, results ) in enumerate( cached ) if results is None ]
+        self.hits += len( keys ) - len( missing )
+        self.misses += len( missing )
+        if missing:
+            miss_queries = queries.iloc[ missing ]
+            miss_results = self.engine.transform( miss_queries )
+            by_qid = dict( list( miss_results.groupby( 'qid', sort=False ) ) )
+
+            new_entries = {}
+            for i in missing:
+                qid = queries[ 'qid' ].iloc[ i ]
+                results = by_qid.get( qid, miss_results.iloc[ 0:0 ] )
+                # Stored without query columns (re-attached for each request)
+                cached[ i ] = results.drop( columns=queries.columns, errors='ignore' ).reset_index( drop=True )
+                new_entries[ keys[ i ] ] = cached[ i ]
+
+            self.remember( new_entries )
+            if self.disk is not None:
+                self.disk.put_many( new_entries.items() )
+
+        # Re-attach the query columns of each request, in input order
+        frames = []
+        query_columns = list( queries.columns )
+        for ( i, results ) in enumerate( cached ):
+            frame = results.assign( **{ column: queries[ column ].iloc[ i ] for column in query_columns } )
+            frames.append( frame[ query_columns + [ column for column in results.columns if column not in query_columns ] ] )
+
+        if not frames:
+            return pd.DataFrame( columns=list( queries.columns ) + [ 'docno', 'score', 'rank' ] )
+        return pd.concat( frames, ignore_index=True )
+
+    def clear( self ):
+        with self.lock:
+            self.memory = OrderedDict()
+
+    def __repr__( self ):
+        return 'CachedRetriever(' + repr( self.engine ) + ')'
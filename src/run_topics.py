@@ -10,71 +10,53 @@
 
 from index_arqmath import *
 from arqmath_topics_qrels import *
+from arqmath_eval import *
+from topic_queries import build_queries, read_formula_latex, parse_query_weights, DEFAULT_QUERY_WEIGHTS
+from engine_pool import EnginePool
+from retrieval_cache import CachedRetriever, engine_settings
 import argparse
 import pyterrier as pt
 from pyterrier.measures import *
 import os, sys
 
 # Constants
-REL_THRESHOLD=2  # ARQMath convention, treat '2' in 0-3 scale as 'relevant' for binary relevance metrics
 MAX_HITS=1000    # TREC / CLEF / NTCIR / FIRE / ARQMath convention (max of 1000 hits per query)
 
 
 ################################################################
 # Input/Output 
 ################################################################
-def load_topics( file_name ):
-    ( num_topics, topics_df ) = read_topic_file( file_name )
+def load_topics( file_name, qpost_term=True, cache_dir=None, formula_files=None, query_weights=None ):
+    # With formula_files (topic formula LaTeX TSVs), queries are weighted title/body/formula
+    # terms (see topic_queries.py); otherwise the topic title is used
+    ( num_topics, topics_df ) = read_topic_file( file_name, qpost_term, cache_dir )
+    if formula_files:
+        topics_df = build_queries( topics_df, read_formula_latex( formula_files ),
+                query_weights or DEFAULT_QUERY_WEIGHTS, qpost_term=qpost_term )
     queries = topics_df[ 'query' ]
     qids = topics_df[ 'qid' ]
     query_df = pt.new.queries( queries, qid=qids)
 
     return ( num_topics, query_df )
 
-def load_qrels_with_binary( file_name ):
-    qrels_df = load_qrels( file_name )
-    # !! Create thresholded qrels for map' and p'@10
-    qrels_thresholded = qrels_df[ qrels_df['label'] >= REL_THRESHOLD ]
-
-    return ( qrels_df, qrels_thresholded )
-
-def load_index( index_dir, lexicon, stats ):
-    index_path = index_dir + "/data.properties" 
-    print("Loading index defined at " + index_path + "...")
-    index_ref = pt.IndexRef.of( index_path )
-    index = pt.IndexFactory.of( index_ref )
+def load_index( index_dir, lexicon, stats, concurrent=False ):
+    print("Loading index defined at " + index_dir + "...")
+    index = open_index( index_dir, concurrent )
 
     # If asked, report stats and lexicon
     view_index( index_dir, index, lexicon, stats )
 
     return index
 
-def report_results( ndcg_metrics, binarized_metrics, top_k, prime ):
-    # Make clear what we're using!
-    prime_string = ''
-
-    if prime:
-        prime_string ="'"
-    print("[[ Evaluation  ]]")
-    print(" * Top-k hits evaluated: " + str(top_k ) )
-    print(" * Prime metrics ('): " + str(prime) )
-    print(" * !! Note that ARQMath uses prime metrics for official scores.")
-    print("\nResults for nDCG" + prime_string )
-    print("----------------------------------------------------------")
-    print( ndcg_metrics )
-
-    print("\nResults for binarized relevance : mAP" + prime_string + ", Precision at 10" + prime_string)
-    print("----------------------------------------------------------")
-    print( binarized_metrics )
-
-    print("\ndone.")
-
 ################################################################
 # Evaluation
 ################################################################
 # Used to remove unasessed hits in search results for prime (') metrics
 # Consider only up to MAX_HITS
 def select_assessed_hits( qrel_df, top_k=1000, prime=True ):
+    # Assessed ( qid, docno ) pairs, hashed once rather than for each result frame
+    key_table = qrel_key_table( qrel_df )
+
     def filter_results( result_df ):
         #result_df.drop_duplicates( subset='docno' )  # esp. important for formula retrieval results
         #result_df_cut = result_df.iloc[0 : MAX_HITS ]
@@ -85,11 +67,7 @@ def select_assessed_hits( qrel_df, top_k=1000, prime=True ):
         # If 'prime' is true, filter by ( qid, docno ) pairs in the qrel file, so that
         # only assessed hits are included.
         if prime:
-            keycols = qrel_df[ ['qid','docno'] ]
-            keys = list( keycols.columns.values )
-            i1 = result_df_cut.set_index(keys).index
-            i2 = qrel_df.set_index(keys).index
-            out_results = result_df_cut[ i1.isin(i2) ]
+            out_results = result_df_cut[ assessed_mask( result_df_cut, key_table ) ]
 
         return out_results
 
@@ -114,6 +92,19 @@ def process_args():
     parser.add_argument('-t', '--tokens', help="set tokenization property (none:  no stemming/stopword removal)", 
             default='Stopwords,PorterStemmer' )
     parser.add_argument('-d', '--debug', help="include debugging outputs", action="store_true" )
+    parser.add_argument('-c', '--cache', default=None,
+            help="directory for parsed topics, qrels, and BM25 results, reused across runs (default: no cache)" )
+    parser.add_argument('-b', '--batch-size', type=int, default=0,
+            help="retrieve topics in batches of this size, appending results to ./<model>.res after each batch (default: all topics at once)" )
+    parser.add_argument('-p', '--per-topic', help="with -b, pass topics through the engine one at a time within each batch, reporting latency percentiles",
+            action="store_true" )
+    parser.add_argument('-w', '--workers', type=int, default=1,
+            help="search topics concurrently with N engines (threads) over the loaded index (default: 1)" )
+
+    parser.add_argument('--query-formulas', nargs='+', default=None,
+            help="topic formula LaTeX TSVs (e.g., 2020_formulas_latex.tsv); queries use weighted title, body, and formula terms" )
+    parser.add_argument('--query-weights', default='1,0.25,0.5',
+            help="title,body,formula weights for --query-formulas (default: 1,0.25,0.5)" )
 
     args = parser.parse_args()
     
@@ -142,14 +133,18 @@ def main():
 
     # Collect topics, qrels index
     print("Loading topics (queries)...")
-    (num_topics, query_df ) = load_topics( args.xmlFile )
+    # Questions are removed using the index answer bitmap if present, otherwise by a '-qpost' query term
+    answer_filter = has_answer_filter( args.indexDir )
+    (num_topics, query_df ) = load_topics( args.xmlFile, qpost_term=not answer_filter, cache_dir=args.cache,
+            formula_files=args.query_formulas, query_weights=parse_query_weights( args.query_weights ) )
     print("    " + str(num_topics) + " topics lodaded.")
 
     print("Loading qrels...")
-    ( qrels_df, qrels_thresholded) = load_qrels_with_binary( args.qrelFile )
+    qrels_df = load_qrels( args.qrelFile, args.cache )
 
     print("Loading index defined at " + args.indexDir + "...")
-    index = load_index( args.indexDir, args.lexicon, args.stats )
+    # With -w N, the index is searched by N threads (structures made thread-safe)
+    index = load_index( args.indexDir, args.lexicon, args.stats, concurrent=args.workers > 1 )
 
     # Report tokenization
     #token_pipeline = index_ref.getProperty("termpipelines")  # does not work.
@@ -160,40 +155,32 @@ def main():
     # Compiling example to make it faster (see https://pyterrier.readthedocs.io/en/latest/transformer.html)
     # * Filtering unasessed hits (w. prime_transformer) - also enforces maximum result list length.
     prime_transformer = select_assessed_hits( qrels_df, top_k, prime )
-    bm25_engine = search_engine( index, weight_model, TEXT_META_FIELDS, token_pipeline=args.tokens )
+    def make_engine():
+        if answer_filter:
+            return answer_engine( index, args.indexDir, weight_model, index_meta_fields( args.indexDir ), 
+                    token_pipeline=args.tokens, k=MAX_HITS )
+        return search_engine( index, weight_model, index_meta_fields( args.indexDir ), token_pipeline=args.tokens )
+
+    # With -w N, topics (or each --batch-size batch) are split over N engines searching concurrently
+    bm25_engine = EnginePool( make_engine, args.workers ) if args.workers > 1 else make_engine()
+    # With -c, results are cached by ( index, model, tokens, query, k, engine settings ), shared
+    # with run_topics_experiment.py for the same engine; cached queries skip Terrier
+    if args.cache:
+        settings = engine_settings( 'answer_engine', index_meta_fields( args.indexDir ), fetch_factor=ANSWER_FETCH_FACTOR ) \
+                if answer_filter else engine_settings( 'search_engine', index_meta_fields( args.indexDir ) )
+        bm25_engine = CachedRetriever( bm25_engine, args.indexDir, weight_model, args.tokens, MAX_HITS, settings=settings,
+                cache_dir=args.cache )
     bm25_pipeline = bm25_engine >> prime_transformer
 
-    # First pass: two runs on retrieval, one for ndcg', one for binarized metrics
-    # Saves results to current directory in file <weight_model>.res.gz this prevents running
-    # the retrieval pipeline in the second call.
-    #
-    # **See warnings about accidentally reusing results and getting incorrect results here: 
-    #   https://pyterrier.readthedocs.io/en/latest/experiments.html?highlight=experiments
-    #  ('overwrite' used to create new results for each run of this program for the first retrieval)
+    # Retrieve once, keeping results in memory; nDCG' and binarized metrics
+    # (P'@10, MAP') are computed from the same run. With -b, each batch is retrieved
+    # (and timed) whole, or topic by topic with -p, for latency percentiles.
     print("Running topics...")
-    ndcg_metrics = pt.Experiment(
-        [ bm25_pipeline ],
-        query_df,
-        qrels_df,
-        eval_metrics=[ "ndcg", "mrt" ],
-        names=[ weight_model ],
-        save_dir="./",
-        save_mode="overwrite"
-        )
-
-    # This does not run the pipeline again, but does compute different metrics used the save
-    # search results.
-    binarized_metrics = pt.Experiment(
-        [ bm25_engine ],
-        query_df,
-        qrels_thresholded,
-        eval_metrics=[ "P_10", "map", "mrt" ],
-        names=[ weight_model ],
-        save_dir="./"
-        )
-    
+    ( metrics, _ ) = run_experiment( [ bm25_pipeline ], query_df, qrels_df, [ weight_model ], prime,
+            batch_size=args.batch_size, run_dir="./", per_topic=args.per_topic )
+
     # Report results at the command line.
-    report_results( ndcg_metrics, binarized_metrics, top_k, prime )
+    report_results( metrics, top_k, prime )
 
 main()
 
@@ -17,6 +17,14 @@ RUN_COLBERT=False
 import imp
 from index_arqmath import *
 from arqmath_topics_qrels import *
+from topic_queries import build_queries, read_formula_latex, parse_query_weights, DEFAULT_QUERY_WEIGHTS
+from arqmath_eval import *
+from retrieval_cache import CachedRetriever, engine_settings
+from rerank import NeuralReranker
+from dense_encoding import DenseScorer, has_dense_vectors
+from dense_retrieval import dense_engine, has_ann_index
+from fusion_tuning import run_tuning, best_weights, normalize_run, NORMALIZATIONS
+from formula_index import formula_engine
 import argparse
 import pyterrier as pt
 from pyterrier.measures import *
@@ -26,7 +34,6 @@ pd.set_option('display.max_columns', None)
 pd.set_option('display.max_rows', None)
 
 # Constants
-REL_THRESHOLD=2  # ARQMath convention, treat '2' in 0-3 scale as 'relevant' for binary relevance metrics
 MAX_HITS=1000    # TREC / CLEF / NTCIR / FIRE / ARQMath convention (max of 1000 hits per query)
 
 
@@ -50,14 +57,52 @@ def process_args():
                         help="set tokenization property (Stopwords,PorterStemmer:  no stemming/stopword removal)",
                         default='none')
     parser.add_argument('-d', '--debug', help="include debugging outputs", action="store_true", default='-d')
+    parser.add_argument('-c', '--cache', default=None,
+                        help="directory for cached BM25 results, reranker scores, and parsed topics/qrels, reused across runs (default: cache in memory only)")
+    parser.add_argument('--sweep', action="store_true",
+                        help="also run the BM25 math/post weight sweep (weights 0-10)")
+    parser.add_argument('--tune', action="store_true",
+                        help="grid search math/post weights (incl. score normalization) and use the best unnormalized weights")
+    parser.add_argument('--tune-step', type=float, default=0.01,
+                        help="math weight step for --tune (default: 0.01)")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="processes running experiment pipelines, each with its own JVM (default: 1)")
+    parser.add_argument('-b', '--topic-batches', type=int, default=1,
+                        help="with --workers, also split topics into this many batches per pipeline group (default: 1)")
+    parser.add_argument('--formula-index', default=None,
+                        help="structural formula index (src/formula_index.py); adds SLT formula search experiments")
+    parser.add_argument('--formula-topics', default=None,
+                        help="topic formulas in Presentation MathML for --formula-index (e.g., 2020_formulas_slt.tsv)")
+
+    parser.add_argument('--rerank-k', type=int, default=100,
+                        help="hits per query reranked by BERT/ColBERT (default: 100)")
+    parser.add_argument('--dense', action="store_true",
+                        help="rescore BM25 post hits with dense vectors from src/dense_encoding.py")
+    parser.add_argument('--dense-ann', action="store_true",
+                        help="retrieve posts from the dense ANN index from src/dense_retrieval.py")
+    parser.add_argument('--nprobe', type=int, default=32,
+                        help="clusters searched by IVF dense ANN indices (default: 32)")
+    parser.add_argument('--dense-weight', type=float, default=0.5,
+                        help="share of the post weight given to dense ANN hits with --dense-ann (default: 0.5)")
+    parser.add_argument('--dense-norm', default='minmax', choices=NORMALIZATIONS,
+                        help="per-topic score normalization before fusing dense ANN and BM25 hits (default: minmax)")
+    parser.add_argument('--query-formulas', nargs='+', default=None,
+                        help="topic formula LaTeX TSVs (e.g., 2020_formulas_latex.tsv); queries use weighted title, body, and formula terms")
+    parser.add_argument('--query-weights', default='1,0.25,0.5',
+                        help="title,body,formula weights for --query-formulas (default: 1,0.25,0.5)")
 
     args = parser.parse_args()
 
     return args
 
 
-def load_topics( file_name ):
-    ( num_topics, topics_df ) = read_topic_file( file_name )
+def load_topics( file_name, qpost_term=True, cache_dir=None, formula_files=None, query_weights=None ):
+    # With formula_files (topic formula LaTeX TSVs), queries are weighted title/body/formula
+    # terms (see topic_queries.py); otherwise the topic title is used
+    ( num_topics, topics_df ) = read_topic_file( file_name, qpost_term, cache_dir )
+    if formula_files:
+        topics_df = build_queries( topics_df, read_formula_latex( formula_files ),
+                query_weights or DEFAULT_QUERY_WEIGHTS, qpost_term=qpost_term )
     queries = topics_df[ 'query' ]
     qids = topics_df[ 'qid' ]
     query_df = pt.new.queries( queries, qid=qids)
@@ -65,19 +110,9 @@ def load_topics( file_name ):
     return ( num_topics, query_df )
 
 
-def load_qrels_with_binary( file_name ):
-    qrels_df = load_qrels( file_name )
-    # !! Create thresholded qrels for map' and p'@10
-    qrels_thresholded = qrels_df[ qrels_df['label'] >= REL_THRESHOLD ]
-
-    return ( qrels_df, qrels_thresholded )
-
-
 def load_index( index_dir, lexicon, stats ):
-    index_path = index_dir + "/data.properties"
-    print("Loading index defined at " + index_path + "...")
-    index_ref = pt.IndexRef.of( index_path )
-    index = pt.IndexFactory.of( index_ref )
+    print("Loading index defined at " + index_dir + "...")
+    index = open_index( index_dir )
 
     # If asked, report stats and lexicon
     view_index( index_dir, index, lexicon, stats )
@@ -85,33 +120,15 @@ def load_index( index_dir, lexicon, stats ):
     return index
 
 
-def report_results( ndcg_metrics, binarized_metrics, top_k, prime ):
-    # Make clear what we're using!
-    prime_string = ''
-
-    if prime:
-        prime_string ="'"
-    print("[[ Evaluation  ]]")
-    print(" * Top-k hits evaluated: " + str(top_k ) )
-    print(" * Prime metrics ('): " + str(prime) )
-    print(" * !! Note that ARQMath uses prime metrics for official scores.")
-    print("\nResults for nDCG" + prime_string )
-    print("----------------------------------------------------------")
-    print( ndcg_metrics )
-
-    print("\nResults for binarized relevance : mAP" + prime_string + ", Precision at 10" + prime_string)
-    print("----------------------------------------------------------")
-    print( binarized_metrics )
-
-    print("\ndone.")
-
-
 ################################################################
 # Evaluation
 ################################################################
 # Used to remove unasessed hits in search results for prime (') metrics
 # Consider only up to MAX_HITS
 def select_assessed_hits( qrel_df, top_k=1000, prime=False ):
+    # Assessed ( qid, docno ) pairs, hashed once rather than for each result frame
+    key_table = qrel_key_table( qrel_df )
+
     def filter_results( result_df ):
         #result_df.drop_duplicates( subset='docno' )  # esp. important for formula retrieval results
         #result_df_cut = result_df.iloc[0 : MAX_HITS ]
@@ -122,16 +139,14 @@ def select_assessed_hits( qrel_df, top_k=1000, prime=False ):
         # If 'prime' is true, filter by ( qid, docno ) pairs in the qrel file, so that
         # only assessed hits are included.
         if prime:
-            keycols = qrel_df[ ['qid','docno'] ]
-            keys = list( keycols.columns.values )
-            i1 = result_df_cut.set_index(keys).index
-            i2 = qrel_df.set_index(keys).index
-            out_results = result_df_cut[ i1.isin(i2) ]
+            out_results = result_df_cut[ assessed_mask( result_df_cut, key_table ) ]
 
         return out_results
 
     return pyterrier.apply.generic( filter_results )
 
+# pipelineA/B should be cached (CachedRetriever), so that only the linear combination
+# is recomputed for each weight.
 def generate_weighting_experiment(pipelineA, pipelineB, end_pipeline, nameA, nameB, prefix):
     weights = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
     result_pipelines = []
@@ -142,36 +157,17 @@ def generate_weighting_experiment(pipelineA, pipelineB, end_pipeline, nameA, nam
         result_names.append(f"{prefix}-{nameA}_{weightA}-{nameB}_{weightB}")
     return result_pipelines, result_names
 
-def main():
-    # Process arguments
-    args = process_args()
-    # Set pandas display width wider
-    pd.set_option('display.max_colwidth', 150)
+def use_answer_filter(args):
+    # Remove questions with answer bitmaps (no '-qpost' query term) if both indices support it
+    return has_answer_filter(args.mathIndexDir) and has_answer_filter(args.postIndexDir)
 
-    if args.tokens == 'none':
-        args.tokens = ''
 
-    # Set retrieval and evaluation parameters
+def build_engines(args, qrels_df):
+    # Returns (bm25_math_engine, bm25_post_engine, math_stored_text, post_stored_text, prime_transformer)
     weight_model = args.model
     prime = args.noprime
-    print(prime)
     top_k = args.topk
 
-    # Do not forget, or fields are undefined ('None' in error messages)
-    print('\n>>> Initializing PyTerrier...')
-    if not pt.started():
-        pt.init()
-
-    print("\n>>> Starting up ")
-    
-    # Collect topics, qrels index
-    print("Loading topics (queries)...")
-    (num_topics, query_df) = load_topics(args.xmlFile)
-    print("    " + str(num_topics) + " topics lodaded.")
-
-    print("Loading qrels...")
-    (qrels_df, qrels_thresholded) = load_qrels_with_binary(args.qrelFile)
-
     print("Loading math index defined at " + args.mathIndexDir + "...")
     math_index = load_index(args.mathIndexDir, args.lexicon, args.stats)
 
@@ -198,8 +194,54 @@ def main():
                 )
 
     ## Raw BM25 engines
-    bm25_math_engine = search_engine(math_index, weight_model, MATH_META_FIELDS, token_pipeline=math_token_pipeline) >> math_correct_data % 1000
-    bm25_post_engine = search_engine(post_index, weight_model, TEXT_META_FIELDS, token_pipeline=text_token_pipeline) % 1000
+    # Cached: each query is retrieved once per engine, and reused by all pipelines (e.g., weight sweeps)
+    # Answers only: via answer bitmaps when available, otherwise the '-qpost' query term (see load_topics)
+    math_meta_fields = index_meta_fields(args.mathIndexDir, formulas=True)
+    post_meta_fields = index_meta_fields(args.postIndexDir)
+    if use_answer_filter(args):
+        math_search = answer_engine(math_index, args.mathIndexDir, weight_model, math_meta_fields, math_token_pipeline, k=1000)
+        post_search = answer_engine(post_index, args.postIndexDir, weight_model, post_meta_fields, text_token_pipeline, k=1000)
+        math_settings = engine_settings('answer_engine', math_meta_fields, fetch_factor=ANSWER_FETCH_FACTOR)
+        post_settings = engine_settings('answer_engine', post_meta_fields, fetch_factor=ANSWER_FETCH_FACTOR)
+    else:
+        math_search = search_engine(math_index, weight_model, math_meta_fields, token_pipeline=math_token_pipeline) \
+            >> expand_formula_groups(args.mathIndexDir, 1000)
+        post_search = search_engine(post_index, weight_model, post_meta_fields, token_pipeline=text_token_pipeline) % 1000
+        math_settings = engine_settings('search_engine', math_meta_fields, expand_formula_groups=True)
+        post_settings = engine_settings('search_engine', post_meta_fields)
+
+    bm25_math_engine = CachedRetriever(
+        math_search >> math_correct_data % 1000,
+        args.mathIndexDir, weight_model, math_token_pipeline, 1000, name='math_correct_data', settings=math_settings,
+        cache_dir=args.cache)
+    bm25_post_engine = CachedRetriever(
+        post_search,
+        args.postIndexDir, weight_model, text_token_pipeline, 1000, settings=post_settings, cache_dir=args.cache)
+
+    ## Text for rerankers, for indices built with --docstore (no change otherwise), read for the
+    # top --rerank-k hits only (formula ids are in 'docno' after math_correct_data; formula group ids for --dedup indices)
+    math_stored_text = add_stored_text(args.mathIndexDir, formulas=True, key_field='docno', k=args.rerank_k)
+    post_stored_text = add_stored_text(args.postIndexDir, k=args.rerank_k)
+
+    return (bm25_math_engine, bm25_post_engine, math_stored_text, post_stored_text, prime_transformer)
+
+# Experiments with their own reranking stage; all other experiments combine the cached BM25 engines
+RERANKED_EXPERIMENTS = ["BM25 to ColBERT to Linear Interpolation", "BM25 to VBERT to Linear Interpolation"]
+
+def experiment_groups(experiment_names):
+    # Pipeline ids run together by one worker (--workers), so that pipelines sharing the cached
+    # BM25 engines (e.g., --sweep) retrieve each topic once per worker; rerankers run on their own
+    shared = [i for (i, name) in enumerate(experiment_names) if name not in RERANKED_EXPERIMENTS]
+    reranked = [[i] for (i, name) in enumerate(experiment_names) if name in RERANKED_EXPERIMENTS]
+    return ([shared] if shared else []) + reranked
+
+
+def build_experiments(args, qrels_df, math_engine_weight, engines=None):
+    # Returns (experiments, experiment_names); also called in each worker process with --workers
+    if engines is None:
+        engines = build_engines(args, qrels_df)
+    (bm25_math_engine, bm25_post_engine, math_stored_text, post_stored_text, prime_transformer) = engines
+    post_engine_weight = 10 - math_engine_weight
 
     #################
     ### PIPELINES ###
@@ -207,10 +249,6 @@ def main():
     experiments = []
     experiment_names = []
 
-    ## Manually set math and post weights
-    math_engine_weight = 8
-    post_engine_weight = 10 - math_engine_weight
-
     ## Baseline Experiment
     if RUN_BASELINE:
         baseline = bm25_post_engine >> prime_transformer
@@ -218,8 +256,11 @@ def main():
         experiment_names.append("Baseline")
 
     ## Experiment 1: BM25 math & post pipeline with linear interpolation
-    # following comment out was used to generate experiments to find the correct BM25 weightings for math and posts
-    #ex_1_pipelines, ex_1_titles = generate_weighting_experiment(bm25_math_engine, bm25_post_engine, prime_transformer, "math", "post", "BM25")
+    # --sweep generates the experiments used to find the BM25 weightings for math and posts
+    if args.sweep:
+        ex_1_pipelines, ex_1_titles = generate_weighting_experiment(bm25_math_engine, bm25_post_engine, prime_transformer, "math", "post", "BM25")
+        experiments.extend(ex_1_pipelines)
+        experiment_names.extend(ex_1_titles)
     if RUN_BM25:
         experiment_1 = ((bm25_post_engine * post_engine_weight) + (bm25_math_engine * math_engine_weight)) >> prime_transformer
         experiments.append(experiment_1)
@@ -230,8 +271,15 @@ def main():
         print("Initializing ColBERT base model...")
         import pyterrier_colbert.ranking
         colbert_base_factory = pyterrier_colbert.ranking.ColBERTFactory("http://www.dcs.gla.ac.uk/~craigm/colbert.dnn.zip", None, None)
-        vanilla_colbert_rerank_math_engine = (bm25_math_engine * math_engine_weight) >> colbert_base_factory.text_scorer()
-        vanilla_colbert_rerank_post_engine = (bm25_post_engine * post_engine_weight) >> colbert_base_factory.text_scorer()
+        # Top --rerank-k hits reranked (the others follow them), scored in length-bucketed batches
+        # (scores cached with --cache, one reranker per engine, as math and post docnos may collide)
+        colbert_scorer = colbert_base_factory.text_scorer()
+        colbert_math_reranker = NeuralReranker(colbert_scorer, 'colbert-base', 'math', args.rerank_k,
+                                               text_field='text', cache_dir=args.cache)
+        colbert_post_reranker = NeuralReranker(colbert_scorer, 'colbert-base', 'post', args.rerank_k,
+                                               text_field='text', cache_dir=args.cache)
+        vanilla_colbert_rerank_math_engine = (bm25_math_engine * math_engine_weight) >> math_stored_text >> colbert_math_reranker
+        vanilla_colbert_rerank_post_engine = (bm25_post_engine * post_engine_weight) >> post_stored_text >> colbert_post_reranker
         experiment_2 = ((vanilla_colbert_rerank_math_engine) + (vanilla_colbert_rerank_post_engine)) >> prime_transformer
         experiments.append(experiment_2)
         experiment_names.append("BM25 to ColBERT to Linear Interpolation")
@@ -243,43 +291,132 @@ def main():
         import onir_pt
         print("Initializing BERT base model...")
         vbert = onir_pt.reranker('vanilla_transformer', 'bert', text_field='origtext', vocab_config={'train': True})
-        vanilla_bert_rerank_math_engine = bm25_math_engine >> vbert
-        vanilla_bert_rerank_post_engine = bm25_post_engine >> vbert
+        vbert_math_reranker = NeuralReranker(vbert, 'vbert', 'math', args.rerank_k, text_field='origtext', cache_dir=args.cache)
+        vbert_post_reranker = NeuralReranker(vbert, 'vbert', 'post', args.rerank_k, text_field='origtext', cache_dir=args.cache)
+        vanilla_bert_rerank_math_engine = bm25_math_engine >> math_stored_text >> vbert_math_reranker
+        vanilla_bert_rerank_post_engine = bm25_post_engine >> post_stored_text >> vbert_post_reranker
         experiment_3 = ((vanilla_bert_rerank_math_engine * math_engine_weight) + (vanilla_bert_rerank_post_engine * post_engine_weight)) >> prime_transformer
         experiments.append(experiment_3)
         experiment_names.append("BM25 to VBERT to Linear Interpolation")
     else:
         print("########################### BERT DISABLED ###########################")
 
+    ## Experiment 4: structural formula search (SLT symbol pairs), alone and with linear interpolation
+    if args.formula_index:
+        slt_formula_engine = formula_engine(args.formula_index, args.formula_topics, k=1000)
+        experiments.append(slt_formula_engine >> prime_transformer)
+        experiment_names.append("SLT Formula Tuples")
+        experiment_4 = ((bm25_post_engine * post_engine_weight) + (slt_formula_engine * math_engine_weight)) >> prime_transformer
+        experiments.append(experiment_4)
+        experiment_names.append("BM25 Post + SLT Formula Tuples to Linear Interpolation")
+
+    ## Experiment 5: BM25 post hits rescored with precomputed dense vectors (src/dense_encoding.py), then linear interpolation
+    if args.dense:
+        if not has_dense_vectors(args.postIndexDir):
+            raise ValueError("No dense vectors for " + args.postIndexDir + " (run src/dense_encoding.py first)")
+        dense_post_engine = bm25_post_engine >> DenseScorer(args.postIndexDir)
+        experiment_5 = ((dense_post_engine * post_engine_weight) + (bm25_math_engine * math_engine_weight)) >> prime_transformer
+        experiments.append(experiment_5)
+        experiment_names.append("BM25 to Dense Rescoring to Linear Interpolation")
+
+    ## Experiment 6: dense ANN first-stage post retrieval (src/dense_retrieval.py), alone and with linear interpolation
+    if args.dense_ann:
+        if not has_ann_index(args.postIndexDir):
+            raise ValueError("No dense ANN index for " + args.postIndexDir + " (run src/dense_retrieval.py first)")
+        dense_ann_engine = dense_engine(args.postIndexDir, k=1000, nprobe=args.nprobe)
+        experiments.append(dense_ann_engine >> prime_transformer)
+        experiment_names.append("Dense ANN Post")
+        # The post weight is split between BM25 and dense hits (--dense-weight); inner products and
+        # BM25 scores differ in scale, so each run is normalized per topic first (--dense-norm)
+        normalized = lambda engine: engine >> pt.apply.generic(lambda run: normalize_run(run, args.dense_norm))
+        dense_weight = post_engine_weight * args.dense_weight
+        experiment_6 = ((normalized(bm25_post_engine) * (post_engine_weight - dense_weight)) + (normalized(dense_ann_engine) * dense_weight)
+                        + (normalized(bm25_math_engine) * math_engine_weight)) >> prime_transformer
+        experiments.append(experiment_6)
+        experiment_names.append("BM25 Post + Dense ANN Post to Linear Interpolation")
+
+    return experiments, experiment_names
+
+def main():
+    # Process arguments
+    args = process_args()
+    # Set pandas display width wider
+    pd.set_option('display.max_colwidth', 150)
+
+    if args.tokens == 'none':
+        args.tokens = ''
+
+    # Set retrieval and evaluation parameters
+    prime = args.noprime
+    print(prime)
+    top_k = args.topk
+
+    # Do not forget, or fields are undefined ('None' in error messages)
+    print('\n>>> Initializing PyTerrier...')
+    if not pt.started():
+        pt.init()
+
+    print("\n>>> Starting up ")
+    
+    # Collect topics, qrels index
+    print("Loading topics (queries)...")
+    (num_topics, query_df) = load_topics(args.xmlFile, qpost_term=not use_answer_filter(args), cache_dir=args.cache,
+                                         formula_files=args.query_formulas, query_weights=parse_query_weights(args.query_weights))
+    print("    " + str(num_topics) + " topics lodaded.")
+
+    print("Loading qrels...")
+    qrels_df = load_qrels(args.qrelFile, args.cache)
+
+    engines = build_engines(args, qrels_df)
+    (bm25_math_engine, bm25_post_engine) = engines[:2]
+
+    ## Manually set math and post weights
+    math_engine_weight = 8
+
+    ## Or tune them (--tune): pipelines add raw scores, so use the best 'none' weights by nDCG
+    if args.tune:
+        print("Tuning math/post weights...")
+        tuning = run_tuning(bm25_math_engine, bm25_post_engine, query_df, qrels_df, top_k, prime, args.tune_step)
+        best = best_weights(tuning[tuning['norm'] == 'none'], tuning.columns[3]).iloc[0]
+        math_engine_weight = 10 * best['math_weight']
+        print("Using math weight " + str(math_engine_weight) + ", post weight " + str(10 - math_engine_weight))
+
+    experiments, experiment_names = build_experiments(args, qrels_df, math_engine_weight, engines)
+
     ## Run experiments
     print("Running topics...")
-    ndcg_metrics = pt.Experiment(
-        experiments,
-        query_df,
-        qrels_df,
-        filter_by_topics=False,
-        filter_by_qrels=False,
-        baseline=0,
-        eval_metrics=["ndcg", "mrt"],
-        names=experiment_names,
-        save_dir="./",
-        save_mode="overwrite"
-    )
-    print("ran ndcg metrics")
-    binarized_metrics = pt.Experiment(
-        experiments,
-        query_df,
-        qrels_thresholded,
-        filter_by_topics=False,
-        filter_by_qrels=False,
-        baseline=0,
-        eval_metrics=["P_10", "map", "mrt"],
-        names=experiment_names,
-        save_dir="./"
-    )
-    print("ran binary experiment")
+    if args.workers > 1:
+        # Each worker loads the indices and builds the same pipelines (without index reports)
+        worker_args = argparse.Namespace(**{**vars(args), 'lexicon': False, 'stats': False})
+        (metrics, _) = run_parallel_experiment(
+            build_experiments,
+            (worker_args, qrels_df, math_engine_weight),
+            query_df,
+            qrels_df,
+            experiment_names,
+            args.workers,
+            args.topic_batches,
+            prime,
+            baseline=0,
+            groups=experiment_groups(experiment_names),
+            filter_by_topics=False,
+            filter_by_qrels=False
+        )
+    else:
+        (metrics, _) = run_experiment(
+            experiments,
+            query_df,
+            qrels_df,
+            experiment_names,
+            prime,
+            baseline=0,
+            filter_by_topics=False,
+            filter_by_qrels=False
+        )
     # Report results at the command line.
-    report_results(ndcg_metrics, binarized_metrics, top_k, prime)
+    report_results(metrics, top_k, prime)
 
 
-main()
+# Guarded: worker processes (--workers) import this module
+if __name__ == "__main__":
+    main()
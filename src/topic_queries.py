@@ -0,0 +1,123 @@
+################################################################
+# topic_queries.py
+#
+# Weighted queries for ARQMath topics, combining the topic title,
+# question body, and topic formulas from the ARQMath formula TSV
+# files (e.g., topics_task_1/formulas/2020_formulas_latex.tsv),
+# joined to topics by 'topic_id'.
+#
+# Formulas are recoded with translate_latex, as for indexing. Each
+# component is split into terms, and terms are weighted by the
+# component weights (summed over components and repeated terms),
+# giving Terrier queries of the form 'term^weight ...'. Topics are
+# processed together as long ( qid, component, term ) frames, so
+# building queries for thousands of topics takes a few pandas
+# operations rather than a loop per topic.
+################################################################
+
+import csv
+import pandas as pd
+import numpy as np
+
+from math_recoding import translate_latex
+
+# Component weights: title and body text from read_topic_file, and topic formulas
+DEFAULT_QUERY_WEIGHTS = { 'title': 1.0, 'body': 0.25, 'formula': 0.5 }
+QUERY_COMPONENTS = [ 'title', 'body', 'formula' ]
+# Topic frame columns used for text components
+COMPONENT_COLUMNS = { 'title': 'title_plain', 'body': 'body' }
+
+# Terms as split by the Terrier tokeniser (also keeps query operators out of queries)
+TERM_PATTERN = r'[a-z0-9]+'
+# Joins formulas recoded together (not in any symbol map rule)
+FORMULA_SEPARATOR = '\x00'
+
+################################################################
+# Topic formulas
+################################################################
+def read_formula_latex( file_names ):
+    # Formula TSV files with columns id, topic_id, thread_id, type, formula
+    if isinstance( file_names, str ):
+        file_names = [ file_names ]
+    return pd.concat( [ pd.read_csv( file_name, sep='\t', dtype=str, keep_default_na=False,
+            quoting=csv.QUOTE_NONE ) for file_name in file_names ], ignore_index=True )
+
+def topic_formula_text( topics_df, formulas_df, types=None ):
+    # Recoded formulas for each topic (qid), optionally for some formula types only
+    # (e.g., [ 'title' ]); returns a frame with 'qid' and 'text' columns
+    if types is not None:
+        formulas_df = formulas_df[ formulas_df[ 'type' ].isin( types ) ]
+    formulas_df = formulas_df[ formulas_df[ 'topic_id' ].isin( topics_df[ 'qid' ] ) ]
+
+    return pd.DataFrame( { 'qid': formulas_df[ 'topic_id' ].to_numpy(),
+            'text': translate_formulas( formulas_df[ 'formula' ].to_numpy() ) } )
+
+def translate_formulas( formulas ):
+    # translate_latex for an array of formulas: distinct formulas are joined and recoded
+    # in one call (each symbol map rule is applied once, rather than once per formula)
+    ( distinct, positions ) = np.unique( np.asarray( formulas, dtype=str ), return_inverse=True )
+    recoded = translate_latex( FORMULA_SEPARATOR.join( distinct ) ).split( FORMULA_SEPARATOR )
+
+    return np.array( recoded, dtype=object )[ positions ] if len( distinct ) else np.array( [], dtype=object )
+
+################################################################
+# Query construction
+################################################################
+def component_terms( qids, texts, component ):
+    # Long frame ( qid, component, term ) for one component
+    terms = pd.DataFrame( { 'qid': np.asarray( qids ), 'term': pd.Series( np.asarray( texts ), dtype=str ).str.lower().str.findall( TERM_PATTERN ) } )
+    terms = terms.explode( 'term' ).dropna( subset=[ 'term' ] )
+    terms[ 'component' ] = component
+
+    return terms
+
+def weighted_terms( topics_df, formulas_df=None, weights=DEFAULT_QUERY_WEIGHTS, formula_types=None ):
+    # Frame ( qid, term, weight ): summed component weights for each term of each topic
+    parts = [ component_terms( topics_df[ 'qid' ], topics_df[ column ], component )
+            for ( component, column ) in COMPONENT_COLUMNS.items() if weights.get( component, 0 ) ]
+    if formulas_df is not None and weights.get( 'formula', 0 ):
+        formula_text = topic_formula_text( topics_df, formulas_df, formula_types )
+        parts.append( component_terms( formula_text[ 'qid' ], formula_text[ 'text' ], 'formula' ) )
+
+    if not parts:
+        return pd.DataFrame( columns=[ 'qid', 'term', 'weight' ] )
+
+    # Sum weights by ( qid, term ) integer key; rows are ordered by qid (first appearance)
+    terms = pd.concat( parts, ignore_index=True )
+    ( qid_codes, qids ) = pd.factorize( terms[ 'qid' ] )
+    ( term_codes, term_values ) = pd.factorize( terms[ 'term' ] )
+    keys = qid_codes.astype( np.int64 ) * len( term_values ) + term_codes
+    ( distinct_keys, positions ) = np.unique( keys, return_inverse=True )
+    term_weights = np.bincount( positions, weights=terms[ 'component' ].map( weights ).to_numpy( dtype=float ) )
+
+    return pd.DataFrame( { 'qid': np.asarray( qids )[ distinct_keys // len( term_values ) ],
+            'term': np.asarray( term_values )[ distinct_keys % len( term_values ) ],
+            'weight': term_weights } )
+
+def build_queries( topics_df, formulas_df=None, weights=DEFAULT_QUERY_WEIGHTS, formula_types=None, qpost_term=True ):
+    # Query frame ( qid, query ) with weighted Terrier queries, in topic order
+    # (topics without terms get an empty query)
+    terms = weighted_terms( topics_df, formulas_df, weights, formula_types )
+    terms = terms[ terms[ 'weight' ] > 0 ]
+
+    # Format each distinct weight once, then join the clauses for each qid
+    ( weights, positions ) = np.unique( terms[ 'weight' ].round( 4 ).to_numpy(), return_inverse=True )
+    labels = np.array( [ '^{:g}'.format( weight ) for weight in weights ], dtype=object )
+    clauses = ( terms[ 'term' ].to_numpy( dtype=object ) + labels[ positions ] ) if len( terms ) else np.array( [], dtype=object )
+    qids = terms[ 'qid' ].to_numpy()
+    starts = np.flatnonzero( np.r_[ True, qids[ 1: ] != qids[ :-1 ] ] ) if len( qids ) else np.array( [], dtype=int )
+    ends = np.r_[ starts[ 1: ], len( qids ) ]
+    queries = pd.Series( [ ' '.join( clauses[ start:end ] ) for ( start, end ) in zip( starts, ends ) ], index=qids[ starts ], dtype=object )
+    queries = queries.reindex( topics_df[ 'qid' ], fill_value='' )
+
+    if qpost_term:
+        queries = '-qpost ' + queries
+    return pd.DataFrame( { 'qid': topics_df[ 'qid' ].to_numpy(), 'query': queries.to_numpy() } )
+
+def parse_query_weights( weight_string ):
+    # 'title,body,formula' weights, e.g., '1,0.25,0.5'
+    values = [ float( value ) for value in weight_string.split(',') ]
+    if len( values ) != len( QUERY_COMPONENTS ):
+        raise ValueError("Expected " + str( len( QUERY_COMPONENTS ) ) + " query weights (title,body,formula): " + weight_string )
+
+    return dict( zip( QUERY_COMPONENTS, values ) )